@@ -0,0 +1,333 @@
+'''A shelf with a bounded write-behind cache, flushed in the background'''
+
+
+# shelve_module.py shows writeback=True: every object you read or write stays
+# in memory (shelf.cache) until sync() or close(). That's what makes
+# pizzas['Italian'].append('mushroom') work, but:
+
+# - the cache never gets smaller, so touching every key in a big shelf loads
+#   the whole shelf into memory.
+# - sync() pickles and writes everything in the cache, even the objects that
+#   were only read. With a big cache, close() can take a long time.
+# - __setitem__ still pickles and writes straight away, so every assignment
+#   pays for a pickle and a database write.
+
+# CachedShelf keeps writeback's behaviour with a few changes:
+
+# 1. The cache is an LRU (an OrderedDict, moved to the end on every use) with
+#    at most maxsize entries. When it's full the least recently used entry is
+#    dropped, after writing it if it needs writing.
+# 2. Assignments only go into the cache and are marked dirty. Reads (with
+#    writeback on) are marked as maybe dirty, since they might be changed in
+#    place. Only these keys are written at flush time, not the whole cache.
+# 3. For the maybe dirty ones we keep a small hash (blake2b, 16 bytes) of the
+#    pickle we read. At flush time, if the new pickle has the same hash, the
+#    object wasn't changed and the write is skipped.
+# 4. A background thread flushes when flush_size keys are waiting or every
+#    interval seconds. It takes the lock for batch_size keys at a time, so
+#    the program using the shelf never waits for a whole flush. It's a daemon
+#    thread, so it doesn't keep the program running; any shelf that hasn't
+#    been closed is closed (and flushed) by an atexit handler instead. Still,
+#    close() it yourself: a program that's killed, or exits with os._exit(),
+#    loses whatever was waiting.
+# 5. metrics() reports hits, misses, evictions, flushes, writes and how many
+#    writes were skipped because nothing changed.
+
+# Like shelve, the values have to be picklable and the keys are strings. One
+# rule to remember: an object you change in place after it's been evicted is
+# no longer the cached one, so the change is lost, just as it would be with
+# writeback=False. Assign it back (shelf[key] = obj) to be safe.
+
+import atexit
+import dbm
+import hashlib
+import pickle
+import shelve
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+DIRTY, READ = 1, 2  # a key is dirty after an assignment, READ if only read
+
+# id: shelf, for every CachedShelf that's still open. (Shelves aren't
+# hashable, so not a WeakSet.)
+_open_shelves = weakref.WeakValueDictionary()
+
+
+@atexit.register
+def _close_open_shelves():
+    for shelf in list(_open_shelves.values()):
+        shelf.close()
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class CachedShelf(shelve.Shelf):
+
+    def __init__(self, dict, maxsize=1024, flush_size=256, interval=1.0,
+                 batch_size=64, writeback=True, protocol=None,
+                 keyencoding='utf-8'):
+        super().__init__(dict, protocol, writeback, keyencoding)
+        self.cache = OrderedDict()
+        self.maxsize = maxsize
+        self.flush_size = flush_size
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = {}   # key: DIRTY or READ, waiting to be flushed
+        self._digests = {}   # key: hash of the pickle we read
+        self._lock = threading.RLock()
+        self._wake = threading.Condition(self._lock)
+        # (dict is the database here, like in shelve.Shelf)
+        self._stats = {name: 0 for name in ('hits', 'misses', 'evictions',
+                                            'flushes', 'writes', 'unchanged')}
+        self._flush_time = 0.0
+        self._running = True
+        self._flusher = threading.Thread(target=self._background, daemon=True)
+        self._flusher.start()
+        _open_shelves[id(self)] = self
+
+    # The mapping methods
+    # -------------------------------------------------------------------------
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                value = self.cache[key]
+            except KeyError:
+                data = self.dict[key.encode(self.keyencoding)]
+                value = pickle.loads(data)
+                self._stats['misses'] += 1
+                self.cache[key] = value
+                if self.writeback:
+                    self._digests[key] = _digest(data)
+                    self._pending.setdefault(key, READ)
+                self._evict()
+            else:
+                self._stats['hits'] += 1
+                self.cache.move_to_end(key)
+                if self.writeback:
+                    self._pending.setdefault(key, READ)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            self._pending[key] = DIRTY
+            self._digests.pop(key, None)
+            self._evict()
+            if len(self._pending) >= self.flush_size:
+                self._wake.notify()
+
+    def __delitem__(self, key):
+        with self._lock:
+            # (not cache.pop(key, None), the value might be None)
+            in_cache = key in self.cache
+            self.cache.pop(key, None)
+            self._pending.pop(key, None)
+            self._digests.pop(key, None)
+            try:
+                del self.dict[key.encode(self.keyencoding)]
+            except KeyError:
+                if not in_cache:
+                    raise
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self.cache or key.encode(self.keyencoding) in self.dict
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        # new keys might only be in the cache so far
+        self.sync()
+        return super().__iter__()
+
+    def __len__(self):
+        self.sync()
+        return super().__len__()
+
+    # Writing
+    # -------------------------------------------------------------------------
+
+    def _write(self, key, state, value):
+        '''Pickles value, writes it unless it's unchanged. Holds the lock'''
+        data = pickle.dumps(value, self._protocol)
+        if self.writeback:
+            digest = _digest(data)
+            if state == READ and digest == self._digests.get(key):
+                self._stats['unchanged'] += 1
+                return
+            # remember it, in case the next read doesn't change anything
+            self._digests[key] = digest
+        self.dict[key.encode(self.keyencoding)] = data
+        self._stats['writes'] += 1
+
+    def _evict(self):
+        while len(self.cache) > self.maxsize:
+            key, value = self.cache.popitem(last=False)
+            state = self._pending.pop(key, None)
+            if state:
+                self._write(key, state, value)
+            self._digests.pop(key, None)
+            self._stats['evictions'] += 1
+
+    def flush(self):
+        '''Writes everything waiting, batch_size keys per turn of the lock'''
+        start = time.perf_counter()
+        while True:
+            with self._lock:
+                if not self._pending:
+                    break
+                for _ in range(min(self.batch_size, len(self._pending))):
+                    # oldest first: dicts keep insertion order
+                    key = next(iter(self._pending))
+                    state = self._pending.pop(key)
+                    self._write(key, state, self.cache[key])
+        with self._lock:
+            self._stats['flushes'] += 1
+            self._flush_time += time.perf_counter() - start
+
+    def sync(self):
+        '''Flushes, then asks the database to write to disk. Keeps the cache'''
+        self.flush()
+        with self._lock:
+            if hasattr(self.dict, 'sync'):
+                self.dict.sync()
+
+    def _background(self):
+        while True:
+            with self._wake:
+                self._wake.wait_for(
+                    lambda: not self._running or
+                    len(self._pending) >= self.flush_size, self.interval)
+                if not self._running:
+                    return
+                if not self._pending:
+                    continue
+            self.flush()
+
+    def close(self):
+        if not hasattr(self, '_flusher'):
+            return  # __init__ didn't get that far
+        if self.dict is None or isinstance(self.dict, shelve._ClosedDict):
+            return
+        with self._wake:
+            self._running = False
+            self._wake.notify()
+        self._flusher.join()
+        _open_shelves.pop(id(self), None)
+        super().close()  # calls our sync() once more, then closes the dict
+
+    def metrics(self):
+        with self._lock:
+            stats = self._stats.copy()
+            stats.update(cached=len(self.cache), pending=len(self._pending),
+                         flush_seconds=self._flush_time)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+def open(filename, flag='c', **kwargs):
+    '''Like shelve.open(), kwargs go to CachedShelf'''
+    return CachedShelf(dbm.open(filename, flag), **kwargs)
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+def workload(shelf, keys, ops, seed=1):
+    '''Mostly reads, skewed towards a few hot keys, with some updates'''
+    import random
+    rnd = random.Random(seed)
+    for i in range(ops):
+        # 80% of the time pick from the first 10% of the keys:
+        if rnd.random() < 0.8:
+            key = 'plant{}'.format(rnd.randrange(keys // 10))
+        else:
+            key = 'plant{}'.format(rnd.randrange(keys))
+        r = rnd.random()
+        if r < 0.1:
+            shelf[key] = {'name': key, 'leaves': ['long', 'slender'] * 20,
+                          'updated': i}
+        elif r < 0.2:
+            shelf[key]['leaves'].append('new')  # changed in place
+        else:
+            shelf[key]['name']
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+
+    keys, ops = 20000, 100000
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ('writeback=False', 'writeback=True', 'CachedShelf'):
+            filename = os.path.join(tmp, name)
+            with shelve.open(filename) as shelf:
+                for i in range(keys):
+                    key = 'plant{}'.format(i)
+                    shelf[key] = {'name': key, 'leaves': ['long', 'slender'] * 20,
+                                  'updated': 0}
+            if name == 'CachedShelf':
+                shelf = open(filename, maxsize=4000)
+            else:
+                shelf = shelve.open(filename, writeback=name.endswith('True'))
+            start = time.perf_counter()
+            workload(shelf, keys, ops)
+            elapsed = time.perf_counter() - start
+            cached = len(shelf.cache)
+            start = time.perf_counter()
+            shelf.close()
+            closing = time.perf_counter() - start
+            with shelve.open(filename) as check:
+                # did the in place appends make it to disk?
+                leaves = len(check['plant0']['leaves'])
+            print('{:<16} {:>7,.0f} ops/sec  {:>6,} cached  close() {:.3f}s'
+                  '  plant0 has {} leaves'.format(name, ops / elapsed, cached,
+                                                  closing, leaves))
+            if name == 'CachedShelf':
+                print('-' * 75)
+                for key, value in sorted(shelf.metrics().items()):
+                    print('{:>14}: {:,.3f}'.format(key, value)
+                          if isinstance(value, float) else
+                          '{:>14}: {:,}'.format(key, value))
+
+# writeback=False   52,690 ops/sec       0 cached  close() 0.046s  plant0 has 40 leaves
+# writeback=True   125,095 ops/sec  13,411 cached  close() 0.397s  plant0 has 41 leaves
+# CachedShelf       54,822 ops/sec   4,000 cached  close() 0.079s  plant0 has 41 leaves
+# ---------------------------------------------------------------------------
+#         cached: 4,000
+#      evictions: 14,681
+#  flush_seconds: 1.763
+#        flushes: 11
+#       hit_rate: 0.814
+#           hits: 73,225
+#         misses: 16,777
+#        pending: 0
+#      unchanged: 52,570
+#         writes: 18,603
+
+# These are with dbm.dumb, the only dbm this machine has. It's the slowest
+# one, so writes cost more than they would with dbm.gnu or dbm.ndbm.
+
+# writeback=False is the only one that loses the in place appends (40 leaves
+# instead of 41). writeback=True is the fastest because it never writes
+# anything until close(). But by then it holds 13,411 of the 20,000 plants in
+# memory, and touching every key would load all of them. CachedShelf holds
+# 4,000, and since it's been writing all along, close() has very little left
+# to do.
+
+# Most of CachedShelf's time goes on pickling objects that were only read, to
+# find out whether they changed (unchanged: 52,570). With writeback=False
+# those reads are never written back. If you always assign values back
+# instead of changing them in place, pass writeback=False to CachedShelf and
+# only assignments are written.
@@ -145,6 +145,10 @@ dish_queue.join()  # see below (note that dish_queue is its own process)
 # control access to a common resource by multiple processes in a concurrent
 # system such as a multiprogramming operating system.)
 
+# see also: dish_pipeline.py for this example grown into a pipeline with any
+# number of stages and workers, dishes sent in chunks, a clean shutdown (no
+# daemon) and throughput stats for each stage.
+
 
 # Daemon Processes
 # -----------------------------------------------------------------------------
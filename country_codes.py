@@ -0,0 +1,195 @@
+'''Country Code Lookup: reverse index and aliases'''
+
+
+# In pygal_json_example.py, get_country_code() loops through every item in
+# pygal's COUNTRIES dictionary (code -> name) until it finds the name. That's
+# fine once, but it's called for every row of population_data.json, so the
+# total work is (number of rows) x (number of countries).
+
+# Dictionaries are fast at looking up keys, not values. If we flip COUNTRIES
+# around once (name -> code), every lookup after that is a single hash lookup.
+
+# While we're at it, we can fix most of the 'Error –' lines. The population
+# data uses World Bank names and pygal uses ISO names, for example:
+#   'Yemen, Rep.'     vs 'Yemen'
+#   'Bolivia'         vs 'Bolivia, Plurinational State of'
+#   'Korea, Rep.'     vs 'Korea, Republic of'
+# So the index also stores:
+# 1. a normalized version of each name (lower case, no punctuation)
+# 2. the part before the comma ('yemen', 'bolivia'), but only if it's
+#    unambiguous. 'Congo, Rep.' and 'Congo, Dem. Rep.' are two countries, so
+#    'congo' on its own can't be trusted.
+# 3. a small table of aliases for the ones that don't follow any pattern.
+# The regions (Arab World) and income groups (High income) still don't match,
+# which is what we want since they aren't countries.
+
+import json
+import re
+import time
+from functools import lru_cache
+from pygal.maps.world import COUNTRIES
+
+ALIASES = {
+    'congo dem rep': 'cd',
+    'congo rep': 'cg',
+    'korea dem rep': 'kp',
+    'korea rep': 'kr',
+    'hong kong sar china': 'hk',
+    'macao sar china': 'mo',
+    'kyrgyz republic': 'kg',
+    'lao pdr': 'la',
+    'slovak republic': 'sk',
+    'vietnam': 'vn',
+    'libya': 'ly',
+    'west bank and gaza': 'ps',
+}
+
+
+def normalize(name):
+    '''Lower case, punctuation removed, words separated by one space'''
+    name = re.sub(r'[^\w\s]', ' ', name.lower())
+    return ' '.join(word for word in name.split() if word != 'the')
+
+
+def build_index(countries=COUNTRIES, aliases=ALIASES):
+    '''Returns a name -> code dict that includes normalized names'''
+    index = {}
+    bases = {}
+    for code, name in countries.items():
+        index[name] = code
+        index[normalize(name)] = code
+        base = normalize(name.split(',')[0])
+        bases.setdefault(base, set()).add(code)
+    for base, codes in bases.items():
+        if len(codes) == 1 and base not in index:
+            index[base] = codes.pop()
+    index.update(aliases)
+    return index
+
+
+INDEX = build_index()
+
+
+# Names that need normalizing (or don't match at all, like 'Arab World') turn
+# up once per year in the data, so remember the answer for each raw name:
+
+@lru_cache(maxsize=None)
+def get_country_code(country_name):
+    '''Return the Pygal 2-digit country code for a given country.'''
+    index = INDEX
+    code = index.get(country_name)
+    if code:
+        return code
+    key = normalize(country_name)
+    code = index.get(key)
+    if code:
+        return code
+    # 'Yemen, Rep.' -> 'yemen'
+    return index.get(normalize(country_name.split(',')[0]))
+
+
+def bucket_populations(rows, year='2010', limits=(10000000, 1000000000)):
+    '''One pass over rows: returns (buckets, unmatched).
+
+    buckets is a list of {code: population} dicts, one more than limits.
+    '''
+    buckets = [{} for _ in range(len(limits) + 1)]
+    unmatched = []
+    for pop_dict in rows:
+        if pop_dict['Year'] != year:
+            continue
+        country_name = pop_dict['Country Name']
+        code = get_country_code(country_name)
+        if not code:
+            unmatched.append(country_name)
+            continue
+        population = int(float(pop_dict['Value']))
+        level = 0
+        while level < len(limits) and population >= limits[level]:
+            level += 1
+        buckets[level][code] = population
+    return buckets, unmatched
+
+
+# Benchmark
+# -----------------------------------------------------------------------------
+
+def get_country_code_scan(country_name):
+    '''The original from pygal_json_example.py'''
+    for code, name in COUNTRIES.items():
+        if name == country_name:
+            return code
+    return None
+
+
+def original_pipeline(pop_data):
+    cc_populations = {}
+    for pop_dict in pop_data:
+        if pop_dict['Year'] == '2010':
+            country_name = pop_dict['Country Name']
+            population = int(float(pop_dict['Value']))
+            code = get_country_code_scan(country_name)
+            if code:
+                cc_populations[code] = population
+    cc_pop1, cc_pop2, cc_pop3 = {}, {}, {}
+    for cc, pop in cc_populations.items():
+        if pop < 10000000:
+            cc_pop1[cc] = pop
+        elif pop < 1000000000:
+            cc_pop2[cc] = pop
+        else:
+            cc_pop3[cc] = pop
+    return cc_pop1, cc_pop2, cc_pop3
+
+
+def benchmark(filename='data/population_data.json', repeat=10):
+    with open(filename) as fob:
+        pop_data = json.load(fob)
+    names = [pop_dict['Country Name'] for pop_dict in pop_data]
+
+    tests = [
+        ('scan lookup, every row', lambda: [get_country_code_scan(n) for n in names]),
+        ('index lookup, every row', lambda: [get_country_code(n) for n in names]),
+        ('original 2010 pipeline', lambda: original_pipeline(pop_data)),
+        ('bucket_populations 2010', lambda: bucket_populations(pop_data)),
+    ]
+    for label, func in tests:
+        get_country_code.cache_clear()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = (time.perf_counter() - start) / repeat
+        print('{:<25} {:>8.2f} ms'.format(label, elapsed * 1000))
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    for name in ['Canada', 'Yemen, Rep.', 'Bolivia', 'Korea, Rep.',
+                 'Congo, Dem. Rep.', 'Congo, Rep.', 'Gambia, The', 'Arab World']:
+        print('{:<18} {!s:<6} {}'.format(name, get_country_code_scan(name),
+                                         get_country_code(name)))
+    # Canada             ca     ca
+    # Yemen, Rep.        None   ye
+    # Bolivia            None   bo
+    # Korea, Rep.        None   kr
+    # Congo, Dem. Rep.   None   cd
+    # Congo, Rep.        None   cg
+    # Gambia, The        None   gm
+    # Arab World         None   None
+
+    with open('data/population_data.json') as fob:
+        pop_data = json.load(fob)
+    old = original_pipeline(pop_data)
+    new, unmatched = bucket_populations(pop_data)
+    print([len(b) for b in old], [len(b) for b in new])
+    # [85, 69, 2] [97, 78, 2]
+
+    print('-' * 75)
+    benchmark()
+
+# scan lookup, every row       73.53 ms
+# index lookup, every row        1.92 ms
+# original 2010 pipeline         2.67 ms
+# bucket_populations 2010        1.13 ms
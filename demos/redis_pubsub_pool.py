@@ -0,0 +1,212 @@
+'''Redis pub/sub: pipelined publishing and a sharded subscriber pool'''
+
+
+# redis_pub.py publishes one message per conn.publish() call, and each call is
+# a round trip to the server. redis_sub.py handles every message itself in the
+# `for msg in sub.listen()` loop, so one slow message holds up all the others,
+# on every channel.
+
+# This version:
+
+# 1. publish_many() sends the publishes through a pipeline, batch_size at a
+#    time, so hundreds of messages cost one round trip.
+# 2. Subscriber has one listener thread that only reads messages and hands
+#    them off, plus a pool of handler threads that do the actual work.
+# 3. Channels are sharded over the handlers: every message for a channel goes
+#    to handler number crc32(channel) % handlers. Messages on the same channel
+#    are still handled in order, different channels run in parallel, and
+#    thousands of channels don't need thousands of threads.
+# 4. Each handler has a bounded queue. If the handlers fall behind, the
+#    listener blocks on the full queue and stops reading (backpressure).
+#    Messages then wait in Redis's output buffer for this client instead of
+#    piling up in our memory. Keep in mind Redis disconnects subscribers whose
+#    buffer grows past client-output-buffer-limit pubsub (32MB by default).
+# 5. Subscriber.stats() reports, per channel, how many messages were handled,
+#    the messages/sec, and the average and worst latency from the listener
+#    receiving a message to the handler finishing it.
+
+# Like redis_work_queue.py, the testing section uses fakeredis so it runs
+# without a Redis server: pip install fakeredis.
+
+import queue
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+STOP = object()
+
+
+def publish_many(conn, messages, batch_size=500):
+    '''messages is an iterable of (channel, message). Returns the count'''
+    pipe = conn.pipeline(transaction=False)
+    count = 0
+    for channel, message in messages:
+        pipe.publish(channel, message)
+        count += 1
+        if count % batch_size == 0:
+            pipe.execute()
+    pipe.execute()
+    return count
+
+
+class ChannelStats():
+    __slots__ = ('count', 'total_latency', 'max_latency', 'first', 'last')
+
+    def __init__(self):
+        self.count = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.first = None
+        self.last = None
+
+
+class Subscriber():
+    '''Reads from a pubsub on one thread and handles messages on a pool'''
+
+    def __init__(self, conn, channels, handler, handlers=4, queue_size=1000):
+        self.handler = handler  # handler(channel, data)
+        self.pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(*channels)
+        self.queues = [queue.Queue(queue_size) for _ in range(handlers)]
+        self._stats = [defaultdict(ChannelStats) for _ in range(handlers)]
+        self._running = True
+        self.error = None  # what stopped the listener, if it failed
+        self._threads = [threading.Thread(target=self._handle, args=(i,))
+                         for i in range(handlers)]
+        self._threads.append(threading.Thread(target=self._listen))
+        for t in self._threads:
+            t.start()
+
+    def _shard(self, channel):
+        # channels are str with decode_responses=True, crc32 needs bytes:
+        if isinstance(channel, str):
+            channel = channel.encode()
+        # hash() of bytes changes between runs, crc32 doesn't:
+        return zlib.crc32(channel) % len(self.queues)
+
+    def _listen(self):
+        try:
+            while self._running:
+                # get_message() with a timeout instead of listen(), so that
+                # the loop can notice when it's time to stop:
+                msg = self.pubsub.get_message(timeout=0.1)
+                if msg is None or msg['type'] != 'message':
+                    continue
+                received = time.perf_counter()
+                channel = msg['channel']
+                # blocks while this shard's queue is full:
+                self.queues[self._shard(channel)].put(
+                    (channel, msg['data'], received))
+        except Exception as e:
+            # Otherwise the thread dies quietly and messages just stop
+            # arriving. close() raises it.
+            print('listener error: {!r}'.format(e))
+            self.error = e
+
+    def _handle(self, shard):
+        q = self.queues[shard]
+        stats = self._stats[shard]  # only this thread writes to it
+        while True:
+            item = q.get()
+            if item is STOP:
+                return
+            channel, data, received = item
+            try:
+                self.handler(channel, data)
+            except Exception as e:
+                print('handler error on {}: {!r}'.format(channel, e))
+            done = time.perf_counter()
+            s = stats[channel]
+            latency = done - received
+            s.count += 1
+            s.total_latency += latency
+            s.max_latency = max(s.max_latency, latency)
+            if s.first is None:
+                s.first = received
+            s.last = done
+
+    def pending(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def stats(self):
+        '''{channel: (count, messages/sec, average latency, max latency)}'''
+        result = {}
+        for shard in self._stats:
+            for channel, s in list(shard.items()):
+                elapsed = (s.last - s.first) if s.count > 1 else 0
+                rate = s.count / elapsed if elapsed else 0.0
+                result[channel] = (s.count, rate, s.total_latency / s.count,
+                                   s.max_latency)
+        return result
+
+    def close(self):
+        '''Stops listening and waits for queued messages to be handled.
+        Raises the listener's error, if it stopped with one'''
+        self._running = False
+        self._threads[-1].join()
+        for q in self.queues:
+            q.put(STOP)
+        for t in self._threads[:-1]:
+            t.join()
+        self.pubsub.close()
+        if self.error is not None:
+            raise self.error
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import random
+    import fakeredis
+
+    server = fakeredis.FakeServer()
+    connect = lambda: fakeredis.FakeStrictRedis(server=server)
+
+    cats = ['siamese', 'black', 'persian', 'main coon', 'tabby', 'norwegian']
+    hats = ['bowler', 'fedora', 'top hat', 'poor boy', 'cowboy', 'stovepipe']
+
+    def wear_hat(cat, hat):
+        time.sleep(0.0005)  # pretend this is some real work
+
+    sub = Subscriber(connect(), cats, wear_hat, handlers=4, queue_size=100)
+    count = 5000
+    messages = [(random.choice(cats), random.choice(hats)) for _ in range(count)]
+
+    conn = connect()
+    start = time.perf_counter()
+    for cat, hat in messages[:500]:
+        conn.publish(cat, hat)
+    elapsed = time.perf_counter() - start
+    print('publish():      {:>8,.0f} messages/sec'.format(500 / elapsed))
+
+    start = time.perf_counter()
+    publish_many(conn, messages)
+    elapsed = time.perf_counter() - start
+    print('publish_many(): {:>8,.0f} messages/sec'.format(count / elapsed))
+
+    while sub.pending():
+        time.sleep(0.05)
+    time.sleep(0.2)
+    sub.close()
+
+    print('-' * 75)
+    for channel, (n, rate, average, worst) in sorted(sub.stats().items()):
+        print('{:<12} {:>5} handled {:>7,.0f}/sec  latency avg {:>6.1f} ms'
+              '  max {:>6.1f} ms'.format(channel.decode(), n, rate,
+                                         average * 1000, worst * 1000))
+
+# publish():         7,919 messages/sec
+# publish_many():   17,023 messages/sec
+# ---------------------------------------------------------------------------
+# black          928 handled     376/sec  latency avg   16.2 ms  max  331.3 ms
+# main coon      972 handled     385/sec  latency avg   90.0 ms  max  356.1 ms
+# norwegian      903 handled     367/sec  latency avg    5.2 ms  max  157.0 ms
+# persian        902 handled     357/sec  latency avg   89.7 ms  max  353.7 ms
+# siamese        860 handled     349/sec  latency avg   12.0 ms  max  331.4 ms
+# tabby          935 handled     370/sec  latency avg   90.5 ms  max  357.3 ms
+
+# The channels with the highest latency share a handler. With 6 channels and
+# 4 handlers, some handlers get two busy channels. With thousands of channels
+# the load evens out.
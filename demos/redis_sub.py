@@ -10,3 +10,6 @@ for msg in sub.listen():
         cat = msg['channel']
         hat = msg['data']
         print('Subscribe: {} cat wears a {}'.format(cat, hat))
+
+# Every message is handled here, one at a time, on this one thread. For a
+# version that hands messages to a pool of threads, see redis_pubsub_pool.py
@@ -9,5 +9,11 @@ for dish in dishes:
     conn.rpush('dishes', msg)
     print('washed', dish)
 
-conn.rpush('dishes', 'quit')
+# one quit message for each dryer process in redis_dryer.py, otherwise only
+# the first one to read it stops:
+DRYERS = 3
+for _ in range(DRYERS):
+    conn.rpush('dishes', 'quit')
 print('Washer is done')
+
+# For a batched version, see redis_work_queue.py
@@ -0,0 +1,221 @@
+'''Redis work queue: batching, at-least-once delivery and poison pills'''
+
+
+# redis_washer.py and redis_dryer.py pass dishes through a Redis list one at
+# a time: one rpush per dish and one blpop per dish. Each of those is a full
+# round trip to the server, and with a fast consumer the round trips are the
+# bottleneck.
+
+# This version:
+
+# 1. Washes in batches. rpush() takes any number of values, and a pipeline
+#    sends many commands in one round trip.
+# 2. Dries in batches. A pipeline of batch_size LMOVE commands grabs up to
+#    batch_size dishes in one round trip. Only when the queue is empty does
+#    it block (with BLMOVE) until the next dish arrives.
+# 3. Doesn't lose dishes. BLPOP removes the dish from Redis, so if a dryer
+#    crashes halfway through, that dish is gone. LMOVE moves it atomically
+#    from 'dishes' into the dryer's own 'dishes:processing:<name>' list, and
+#    it's only deleted once it's been dried. When a dryer starts up, it puts
+#    anything left in its processing list back on the queue. (So a dish can
+#    be dried twice after a crash, but never zero times: "at-least-once".)
+# 4. Sends a 'quit' poison pill for every dryer. The original washer sends
+#    one, so only one of the three multiprocessing dryers ever stops. If a
+#    dryer's batch happens to contain more than one pill, it puts the extras
+#    back for its siblings.
+
+# There's also fast_dry(), which uses LPOP with a count (Redis 6.2+) to take
+# a whole batch in one command. It's quicker, but a crash loses the batch.
+
+# The benchmark uses fakeredis, an in-process stand in for a Redis server, so
+# it runs without one: pip install fakeredis. Since there's no network, the
+# difference you'll see is smaller than against a real server. Also, a
+# blocking BLMOVE in fakeredis doesn't wake up when another connection
+# pushes, so the benchmark uses a short poll time.
+
+import threading
+import time
+
+QUEUE = 'dishes'
+QUIT = b'quit'
+
+
+def wash(conn, dishes, dryers=1, batch_size=500):
+    '''Pushes dishes in batches, followed by one quit pill per dryer'''
+    batch = []
+    pipe = conn.pipeline(transaction=False)
+    for dish in dishes:
+        batch.append(dish.encode('utf-8'))
+        if len(batch) == batch_size:
+            pipe.rpush(QUEUE, *batch)
+            batch = []
+    if batch:
+        pipe.rpush(QUEUE, *batch)
+    pipe.rpush(QUEUE, *[QUIT] * dryers)
+    pipe.execute()
+
+
+def dry(conn, name, dry_one, batch_size=100, timeout=20, poll=1):
+    '''Moves batches into a processing list and removes them once dried'''
+    processing = '{}:processing:{}'.format(QUEUE, name)
+    # requeue anything a previous run with this name didn't finish:
+    while conn.lmove(processing, QUEUE, 'RIGHT', 'LEFT'):
+        pass
+    dried = 0
+    waited = 0
+    while True:
+        pipe = conn.pipeline(transaction=False)
+        for _ in range(batch_size):
+            pipe.lmove(QUEUE, processing, 'LEFT', 'RIGHT')
+        batch = [msg for msg in pipe.execute() if msg is not None]
+        if not batch:
+            # The queue is empty, so block until a dish arrives. This waits
+            # for at most poll seconds at a time and then tries again.
+            if waited >= timeout:
+                break
+            first = conn.blmove(QUEUE, processing, poll, 'LEFT', 'RIGHT')
+            if first is None:
+                waited += poll
+                continue
+            batch = [first]
+        waited = 0
+
+        pills = batch.count(QUIT)
+        for msg in batch:
+            if msg != QUIT:
+                dry_one(msg.decode('utf-8'))
+                dried += 1
+        pipe = conn.pipeline(transaction=True)
+        pipe.delete(processing)
+        if pills > 1:
+            # these belong to the other dryers:
+            pipe.rpush(QUEUE, *[QUIT] * (pills - 1))
+        pipe.execute()
+        if pills:
+            break
+    return dried
+
+
+def fast_dry(conn, dry_one, batch_size=100, timeout=20):
+    '''LPOP count: fewer commands, but at-most-once'''
+    dried = 0
+    while True:
+        batch = conn.lpop(QUEUE, batch_size)
+        if not batch:
+            # nothing there, block until something arrives:
+            msg = conn.blpop(QUEUE, timeout)
+            if msg is None:
+                break
+            batch = [msg[1]]
+        pills = batch.count(QUIT)
+        for msg in batch:
+            if msg != QUIT:
+                dry_one(msg.decode('utf-8'))
+                dried += 1
+        if pills > 1:
+            conn.rpush(QUEUE, *[QUIT] * (pills - 1))
+        if pills:
+            break
+    return dried
+
+
+# The originals, without the printing and the sleep:
+
+def original_wash(conn, dishes, dryers=1):
+    for dish in dishes:
+        conn.rpush(QUEUE, dish.encode('utf-8'))
+    for _ in range(dryers):
+        conn.rpush(QUEUE, 'quit')
+
+
+def original_dry(conn, dry_one, timeout=20):
+    dried = 0
+    while True:
+        msg = conn.blpop(QUEUE, timeout)
+        if not msg:
+            break
+        val = msg[1].decode('utf-8')
+        if val == 'quit':
+            break
+        dry_one(val)
+        dried += 1
+    return dried
+
+
+# Benchmark
+# -----------------------------------------------------------------------------
+
+def run(connect, washer, dryer, dishes, dryers):
+    conn = connect()
+    conn.delete(QUEUE)
+    counts = [0] * dryers
+
+    def work(i):
+        counts[i] = dryer(connect(), i)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(dryers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    washer(conn, dishes, dryers)
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return sum(counts), elapsed
+
+
+def benchmark(connect, count=20000, dryers=3):
+    dishes = ['dish {}'.format(i) for i in range(count)]
+    dry_one = lambda dish: None
+    modes = [
+        ('rpush / blpop', original_wash,
+         lambda conn, i: original_dry(conn, dry_one, timeout=5)),
+        ('pipeline / blmove + lmove', wash,
+         lambda conn, i: dry(conn, 'dryer{}'.format(i), dry_one, timeout=5,
+                             poll=0.01)),
+        ('pipeline / lpop count', wash,
+         lambda conn, i: fast_dry(conn, dry_one, timeout=5)),
+    ]
+    for label, washer, dryer in modes:
+        dried, elapsed = run(connect, washer, dryer, dishes, dryers)
+        print('{:<27} {} dried {:>10,.0f} dishes/sec'.format(
+            label, dried, dried / elapsed))
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import fakeredis
+
+    server = fakeredis.FakeServer()
+    connect = lambda: fakeredis.FakeStrictRedis(server=server)
+    # For a real server: import redis; connect = redis.Redis
+
+    conn = connect()
+    conn.delete(QUEUE)
+    wash(conn, ['salad', 'bread', 'main', 'side', 'dessert'], dryers=3)
+    for name in ['dryer1', 'dryer2', 'dryer3']:
+        # each dryer gets one pill, so all three stop:
+        print(name, dry(conn, name, lambda dish: print('dried', dish),
+                        batch_size=4, timeout=1, poll=0.1))
+    # dried salad
+    # dried bread
+    # dried main
+    # dried side
+    # dried dessert
+    # dryer1 5
+    # dryer2 0
+    # dryer3 0
+    print('left in queue:', conn.llen(QUEUE))  # left in queue: 0
+
+    print('-' * 75)
+    benchmark(connect)
+
+# rpush / blpop               20000 dried      4,210 dishes/sec
+# pipeline / blmove + lmove   20000 dried      9,273 dishes/sec
+# pipeline / lpop count       20000 dried    206,082 dishes/sec
+
+# fakeredis runs every command in Python, so the pipelined LMOVEs still cost
+# one (cheap) command each. Against a real server over a network, the round
+# trips they save are where most of the time goes.
@@ -0,0 +1,217 @@
+'''A long running TCP server: selectors, framing and a worker pool'''
+
+
+# tcp_server.py accepts one client, reads once with recv(1000), replies and
+# exits. Two things make that hard to grow into a real server:
+
+# 1. TCP is a stream of bytes, not of messages. One recv() can return half a
+#    message, or two messages stuck together, and anything over max_size is
+#    cut off. The fix is framing: send the length of each message first (here
+#    4 bytes, big endian, packed with struct) and then the message itself. The
+#    reader collects bytes until it has a whole frame.
+# 2. accept() and recv() block, so one slow client stops everyone else. The
+#    selectors module asks the operating system which sockets are ready, and
+#    one thread only reads or writes the ones that won't block.
+
+# The selector loop only moves bytes around. Handling a message (which might
+# be slow) happens on a ThreadPoolExecutor. When a worker finishes, it queues
+# the reply and wakes the loop up through a socketpair, since the loop may be
+# sleeping in select(). Each connection only has one message with the workers
+# at a time, so replies come back in the same order as the requests.
+
+# Run this, then tcp_load_client.py in another terminal.
+
+import selectors
+import socket
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+HEADER = struct.Struct('!I')  # network byte order, unsigned 4 byte int
+MAX_FRAME = 16 * 1024 * 1024  # refuse anything claiming to be over 16MB
+
+
+def send_frame(sock, data):
+    '''For blocking sockets: send one length prefixed message'''
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frame(sock):
+    '''For blocking sockets: receive one length prefixed message'''
+    (size,) = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    return recv_exactly(sock, size)
+
+
+class Connection():
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.requests = deque()  # complete frames waiting for a worker
+        self.busy = False        # a worker has one of our frames
+        self.closing = False
+
+
+class FramedServer():
+
+    def __init__(self, address=('localhost', 4544), handler=None, workers=8):
+        self.handler = handler or (lambda data: b'Are you talking to me? ' + data)
+        self.executor = ThreadPoolExecutor(workers)
+        self.selector = selectors.DefaultSelector()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # let us restart straight away without 'Address already in use':
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen(128)
+        self.server.setblocking(False)
+        self.address = self.server.getsockname()
+        self.selector.register(self.server, selectors.EVENT_READ, 'accept')
+        # workers write a byte here to wake up select():
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, 'wake')
+        self._done = deque()  # (connection, reply) from the workers
+        self._running = False
+
+    def serve_forever(self):
+        self._running = True
+        while self._running:
+            for key, events in self.selector.select():
+                if key.data == 'accept':
+                    self._accept()
+                elif key.data == 'wake':
+                    self._collect_replies()
+                else:
+                    conn = key.data
+                    if events & selectors.EVENT_READ:
+                        self._read(conn)
+                    if events & selectors.EVENT_WRITE and not conn.closing:
+                        self._write(conn)
+        self._cleanup()
+
+    def shutdown(self):
+        self._running = False
+        self._wake_w.send(b'x')
+
+    def _accept(self):
+        sock, addr = self.server.accept()
+        sock.setblocking(False)
+        # small request/reply messages shouldn't wait for Nagle's algorithm:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(sock, addr)
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(conn)
+            return
+        conn.inbuf += data
+        # pull out every complete frame:
+        while len(conn.inbuf) >= HEADER.size:
+            (size,) = HEADER.unpack_from(conn.inbuf)
+            if size > MAX_FRAME:
+                self._close(conn)
+                return
+            if len(conn.inbuf) < HEADER.size + size:
+                break
+            conn.requests.append(bytes(conn.inbuf[HEADER.size:HEADER.size + size]))
+            del conn.inbuf[:HEADER.size + size]
+        self._dispatch(conn)
+
+    def _dispatch(self, conn):
+        if conn.busy or not conn.requests:
+            return
+        conn.busy = True
+        self.executor.submit(self._work, conn, conn.requests.popleft())
+
+    def _work(self, conn, request):
+        # runs on a worker thread, so it must not touch the selector
+        try:
+            reply = self.handler(request)
+        except Exception as e:
+            reply = 'error: {!r}'.format(e).encode('utf-8')
+        self._done.append((conn, reply))  # deque.append is thread safe
+        self._wake_w.send(b'x')
+
+    def _collect_replies(self):
+        try:
+            self._wake_r.recv(4096)
+        except BlockingIOError:
+            pass
+        while self._done:
+            conn, reply = self._done.popleft()
+            conn.busy = False
+            if conn.closing:
+                continue
+            conn.outbuf += HEADER.pack(len(reply)) + reply
+            self._write(conn)
+            self._dispatch(conn)
+
+    def _write(self, conn):
+        if conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+                del conn.outbuf[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self._close(conn)
+                return
+        # only ask to hear about writability while there's something to send,
+        # otherwise select() would return straight away every time:
+        events = selectors.EVENT_READ
+        if conn.outbuf:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(conn.sock, events, conn)
+
+    def _close(self, conn):
+        conn.closing = True
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+
+    def _cleanup(self):
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, Connection):
+                key.data.sock.close()
+        self.selector.close()
+        self.server.close()
+        self._wake_r.close()
+        self._wake_w.close()
+        self.executor.shutdown()
+
+
+def start_in_thread(**kwargs):
+    '''Starts a FramedServer on a background thread, returns the server'''
+    server = FramedServer(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    import datetime
+    server = FramedServer()
+    print('Starting the server at', datetime.datetime.now())
+    print('listening on', server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server._cleanup()
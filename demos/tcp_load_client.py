@@ -0,0 +1,87 @@
+'''Load generator for tcp_framed_server.py'''
+
+
+# This is tcp_client.py, grown up. Each client thread opens one connection and
+# keeps it open (no handshake per request), sends a framed request, waits for
+# the framed reply and records how long the round trip took. At the end it
+# prints requests/sec and the latency percentiles. p99 is the time that 99% of
+# requests beat, which says more about how a server feels under load than the
+# average does.
+
+# By default it starts its own server on a background thread. To test a
+# separate server process, run tcp_framed_server.py and pass --external.
+
+import datetime
+import socket
+import sys
+import threading
+import time
+
+from tcp_framed_server import recv_frame, send_frame, start_in_thread
+
+address = ('localhost', 4544)
+
+
+def client(address, count, payload, latencies):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect(address)
+    for _ in range(count):
+        start = time.perf_counter()
+        send_frame(sock, payload)
+        recv_frame(sock)
+        latencies.append(time.perf_counter() - start)
+    sock.close()
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[index]
+
+
+def run(address, clients=16, count=2000, size=100):
+    payload = b'x' * size
+    latencies = []  # list.append is thread safe
+    threads = [threading.Thread(target=client,
+                                args=(address, count, payload, latencies))
+               for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print('{:>3} clients {:>8} byte messages: {:>8,.0f} requests/sec  '
+          'p50 {:.2f} ms  p99 {:.2f} ms'.format(
+              clients, size, len(latencies) / elapsed,
+              percentile(latencies, 50) * 1000,
+              percentile(latencies, 99) * 1000))
+
+
+if __name__ == '__main__':
+    print('Starting the client at', datetime.datetime.now())
+    if '--external' not in sys.argv:
+        server = start_in_thread(address=('localhost', 0))
+        address = server.address
+
+    # the original only read 1000 bytes, this is 1MB:
+    sock = socket.create_connection(address)
+    send_frame(sock, b'Hi there' * 131072)
+    print('Message:', datetime.datetime.now(), 'someone replied with',
+          len(recv_frame(sock)), 'bytes')
+    sock.close()
+
+    for clients in (1, 16, 64):
+        run(address, clients=clients, count=20000 // clients)
+    run(address, clients=16, count=200, size=65536)
+
+# Message: 2017-12-01 10:45:25.093112 someone replied with 1048599 bytes
+#   1 clients      100 byte messages:   14,762 requests/sec  p50 0.07 ms  p99 0.12 ms
+#  16 clients      100 byte messages:   20,273 requests/sec  p50 0.75 ms  p99 1.58 ms
+#  64 clients      100 byte messages:   16,811 requests/sec  p50 3.63 ms  p99 9.65 ms
+#  16 clients    65536 byte messages:    6,508 requests/sec  p50 2.31 ms  p99 6.07 ms
+
+# The client threads here all share one Python process (and one GIL), so
+# past a handful of clients they're mostly waiting on each other. Running
+# several client processes gives the server more of a workout.
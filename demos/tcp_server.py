@@ -22,3 +22,6 @@ print('Message:', datetime.datetime.now(), client, 'said', data)
 client.sendall(b'Are you talking to me?')
 client.close()
 server.close()
+
+# This server handles one message from one client and then exits. For a server
+# that keeps running and handles many clients at once, see tcp_framed_server.py
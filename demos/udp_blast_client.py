@@ -0,0 +1,88 @@
+'''Blast client for udp_ingest_server.py'''
+
+
+# This is udp_client.py, but instead of sending one 'Hello' it sends as many
+# numbered packets as it can (or as many as rate allows) and then asks the
+# receiver how many arrived. The sequence number in the first 8 bytes of each
+# packet lets the receiver work out how many went missing.
+
+# The packet is built once in a bytearray and only the sequence number is
+# rewritten with pack_into(), so the client doesn't allocate per packet
+# either.
+
+# By default the receiver runs in a separate process (started with
+# multiprocessing), so the client and server aren't fighting over one GIL.
+# Use --external to blast a udp_ingest_server.py you started yourself.
+
+import datetime
+import multiprocessing
+import socket
+import sys
+import time
+
+from udp_ingest_server import SEQUENCE, start_in_thread
+
+server_address = ('localhost', 4544)
+
+
+def blast(address, count, size=200, rate=None):
+    '''Sends count packets, rate is packets/sec (None is flat out)'''
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # connect() on a UDP socket just fixes the destination, so we can use
+    # send() and skip the address lookup on every sendto():
+    client.connect(address)
+    packet = bytearray(size)
+    start = time.perf_counter()
+    for seq in range(count):
+        SEQUENCE.pack_into(packet, 0, seq)
+        try:
+            client.send(packet)
+        except (BlockingIOError, ConnectionRefusedError):
+            pass
+        if rate and seq % 1000 == 999:
+            # sleep off any time we're ahead of schedule:
+            ahead = (seq + 1) / rate - (time.perf_counter() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    elapsed = time.perf_counter() - start
+    client.close()
+    return elapsed
+
+
+def receiver(pipe):
+    server, counter = start_in_thread(address=('localhost', 0))
+    pipe.send(server.address)
+    pipe.recv()  # wait for the client to finish sending
+    time.sleep(0.5)
+    pipe.send((counter.packets, counter.lost, server.dropped))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    print('Starting the client at', datetime.datetime.now())
+    count = 500000
+    for rate in (100000, None):
+        if '--external' in sys.argv:
+            elapsed = blast(server_address, count, rate=rate)
+            print('sent {:,} packets at {:,.0f} packets/sec'.format(
+                count, count / elapsed))
+            continue
+        parent, child = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=receiver, args=(child,))
+        p.start()
+        address = parent.recv()
+        elapsed = blast(address, count, rate=rate)
+        parent.send('done')
+        packets, lost, dropped = parent.recv()
+        p.join()
+        print('sent {:,} at {:>9,.0f}/sec  received {:,} ({:.1%} lost, '
+              '{:,} dropped by the receiver)'.format(
+                  count, count / elapsed, packets, (count - packets) / count,
+                  dropped))
+
+# sent 500,000 at    99,995/sec  received 500,000 (0.0% lost, 0 dropped by the receiver)
+# sent 500,000 at   143,178/sec  received 500,000 (0.0% lost, 0 dropped by the receiver)
+
+# Over loopback the client can rarely outrun the receiver. Across a real
+# network, or with several clients, watch the lost column: that's the kernel
+# buffer overflowing, and a bigger rcvbuf (or a faster consumer) is the fix.
@@ -0,0 +1,189 @@
+'''A high rate UDP receiver: batches, reused buffers and drop counting'''
+
+
+# udp_server.py receives one datagram with recvfrom(), replies, and exits.
+# For telemetry arriving at hundreds of thousands of packets a second, a few
+# things start to matter:
+
+# 1. recvfrom(max_size) creates a new bytes object for every packet. At high
+#    rates that's a lot of allocating and freeing. recv_into() copies the
+#    packet into a buffer we already have, so Batch below is one bytearray
+#    split into fixed size slots, allocated once and reused forever.
+# 2. Linux has a recvmmsg() system call that reads many datagrams at once, but
+#    Python's socket module doesn't expose it. The next best thing is to wait
+#    once (with select) until the socket is readable, and then keep calling
+#    recv_into() without blocking until the socket is empty or the batch is
+#    full. That's one wakeup per batch instead of one per packet.
+# 3. Whatever handles the data shouldn't slow down the receiving, so full
+#    batches go onto a queue for a consumer thread. When the consumer is done
+#    with a batch it gives it back to the receiver to reuse.
+# 4. UDP doesn't tell anyone when it drops packets. Two kinds of drops are
+#    counted here:
+#    - the kernel's receive buffer was full: the blast client puts a sequence
+#      number in each packet, so gaps in the numbers are lost packets.
+#    - every batch was still with the consumer: the receiver reads the packet
+#      (to keep the kernel buffer moving) into a scratch buffer and counts it.
+
+import array
+import queue
+import select
+import socket
+import struct
+import threading
+
+SEQUENCE = struct.Struct('!Q')  # first 8 bytes of each blast packet
+
+
+class Batch():
+    '''Up to slots datagrams of up to slot_size bytes, in one bytearray'''
+
+    def __init__(self, slots=256, slot_size=2048):
+        self.slot_size = slot_size
+        self.buffer = bytearray(slots * slot_size)
+        self.view = memoryview(self.buffer)
+        self.lengths = array.array('I', [0] * slots)
+        self.slots = slots
+        self.count = 0
+
+    def __iter__(self):
+        '''Yields a memoryview of each datagram (no copying)'''
+        for i in range(self.count):
+            start = i * self.slot_size
+            yield self.view[start:start + self.lengths[i]]
+
+
+class UDPIngestServer():
+
+    def __init__(self, address=('localhost', 4544), batches=64, slots=256,
+                 slot_size=2048, rcvbuf=8 * 1024 * 1024):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # A bigger kernel receive buffer rides out short bursts. (Linux caps
+        # this at net.core.rmem_max.)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.bind(address)
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.free = queue.Queue()           # empty batches for the receiver
+        for _ in range(batches):
+            self.free.put(Batch(slots, slot_size))
+        self.ready = queue.Queue()          # full batches for the consumer
+        self._scratch = bytearray(slot_size)
+        self.received = 0
+        self.dropped = 0                    # no free batch to put it in
+        self._running = False
+
+    def serve_forever(self, poll=0.1):
+        self._running = True
+        batch = None
+        while self._running:
+            if batch is None:
+                try:
+                    batch = self.free.get_nowait()
+                    batch.count = 0
+                except queue.Empty:
+                    pass
+            # wait until there's something to read:
+            readable, _, _ = select.select([self.sock], [], [], poll)
+            if not readable:
+                # quiet moment, send along whatever we have so far
+                if batch is not None and batch.count:
+                    self.ready.put(batch)
+                    batch = None
+                continue
+            # drain without blocking:
+            while True:
+                if batch is None:
+                    try:
+                        self.sock.recv_into(self._scratch)
+                    except BlockingIOError:
+                        break
+                    self.dropped += 1
+                    try:
+                        batch = self.free.get_nowait()
+                        batch.count = 0
+                    except queue.Empty:
+                        pass
+                    continue
+                start = batch.count * batch.slot_size
+                try:
+                    size = self.sock.recv_into(
+                        batch.view[start:start + batch.slot_size])
+                except BlockingIOError:
+                    break
+                batch.lengths[batch.count] = size
+                batch.count += 1
+                self.received += 1
+                if batch.count == batch.slots:
+                    self.ready.put(batch)
+                    try:
+                        batch = self.free.get_nowait()
+                        batch.count = 0
+                    except queue.Empty:
+                        batch = None
+            if batch is not None and batch.count:
+                self.ready.put(batch)
+                batch = None
+        self.sock.close()
+
+    def shutdown(self):
+        self._running = False
+
+    def consume(self, handle, timeout=None):
+        '''Call from the consumer thread: handle(batch) for each batch'''
+        while True:
+            try:
+                batch = self.ready.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if batch is None:
+                return
+            try:
+                handle(batch)
+            finally:
+                # hand the buffer back to the receiver
+                self.free.put(batch)
+
+
+class SequenceCounter():
+    '''A consumer that counts packets and gaps in their sequence numbers'''
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.highest = -1
+
+    def __call__(self, batch):
+        for packet in batch:
+            self.packets += 1
+            self.bytes += len(packet)
+            (seq,) = SEQUENCE.unpack_from(packet)
+            if seq > self.highest:
+                self.highest = seq
+
+    @property
+    def lost(self):
+        # packets that never arrived (assumes one sender, numbered from 0)
+        return self.highest + 1 - self.packets
+
+
+def start_in_thread(**kwargs):
+    server = UDPIngestServer(**kwargs)
+    counter = SequenceCounter()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=server.consume, args=(counter,), daemon=True).start()
+    return server, counter
+
+
+if __name__ == '__main__':
+    import datetime
+    import time
+    server, counter = start_in_thread()
+    print('Starting the server at', datetime.datetime.now())
+    print('listening on', server.address)
+    try:
+        while True:
+            time.sleep(5)
+            print('received {:,} packets ({:,} lost, {:,} dropped)'.format(
+                counter.packets, counter.lost, server.dropped))
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -24,3 +24,7 @@ server.sendto(b'Are you talking to me?', client)
 
 # and closes the connection:
 server.close()
+
+# This server reads one datagram and exits. For a receiver that keeps up with
+# a steady flood of packets (and counts the ones it loses), see
+# udp_ingest_server.py and udp_blast_client.py
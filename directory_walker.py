@@ -0,0 +1,198 @@
+'''Directory Walker: os.scandir, no recursion, optional threads'''
+
+
+# recursion.py has list_directory(), which calls os.listdir() and then
+# os.path.isdir() on every entry. os.listdir() only returns names, so every
+# isdir() is another stat system call. It's also recursive, so a deep enough
+# tree runs into Python's recursion limit.
+
+# os.scandir() returns DirEntry objects instead of names. On most systems the
+# operating system already tells us the type of each entry while listing the
+# directory, so entry.is_dir() doesn't need an extra system call. entry.stat()
+# is cached on the entry too (and on Windows it's free).
+
+# walk() below:
+# - uses os.scandir()
+# - keeps a stack of entries still to visit instead of recursing. Each
+#   directory's contents come right after the directory itself, the same
+#   order as recursion.py, so the depth can be used to print a tree
+# - is a generator, so you can start using entries straight away and stop
+#   whenever you like
+# - can filter with glob patterns. include only yields matching files (every
+#   directory is still walked). exclude skips files and directories, and an
+#   excluded directory isn't visited at all.
+# - can collect size and modification time
+# - with workers > 0 it lists directories in a thread pool. Listing a
+#   directory is I/O, and Python releases the GIL while waiting on I/O, so
+#   on network drives or cold caches several threads can keep the disk busy.
+#   Entries then come out in whatever order the threads finish.
+
+import fnmatch
+import os
+import re
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+Entry = namedtuple('Entry', 'path name is_dir depth size mtime')
+
+
+def _compile(patterns):
+    '''Turns one or more glob patterns into a single compiled regex'''
+    if not patterns:
+        return None
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    # fnmatch.fnmatch() would translate the pattern on every call:
+    return re.compile('|'.join(fnmatch.translate(p) for p in patterns))
+
+
+def _scan(path, depth, include, exclude, stats):
+    '''Lists one directory. Returns a list of (entry, subdirectory) in the
+    order they were listed: entry is None for a directory that include hides,
+    and subdirectory is None for anything that isn't one'''
+    items = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if exclude and exclude.match(entry.name):
+                    continue
+                try:
+                    # don't follow symlinks, they can loop back on themselves
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                subdir = (entry.path, depth + 1) if is_dir else None
+                if is_dir and include:
+                    # still walk it, but only yield matching files
+                    items.append((None, subdir))
+                    continue
+                if not is_dir and include and not include.match(entry.name):
+                    continue
+                size = mtime = None
+                if stats:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                        size, mtime = st.st_size, st.st_mtime
+                    except OSError:
+                        pass
+                items.append((Entry(entry.path, entry.name, is_dir, depth,
+                                    size, mtime), subdir))
+    except OSError:
+        # permission denied, or it was deleted while we were walking
+        pass
+    return items
+
+
+def walk(top, include=None, exclude=None, stats=False, workers=0):
+    '''Yields an Entry for everything under top'''
+    include = _compile(include)
+    exclude = _compile(exclude)
+    if not workers:
+        stack = [(None, (top, 0))]
+        while stack:
+            entry, subdir = stack.pop()
+            if entry is not None:
+                yield entry
+            if subdir is not None:
+                # a directory's contents go on top, so they come out before
+                # its siblings. Reversed, so the first one is popped first:
+                stack.extend(reversed(_scan(*subdir, include, exclude, stats)))
+        return
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(_scan, top, 0, include, exclude, stats)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for entry, subdir in future.result():
+                    if subdir is not None:
+                        pending.add(executor.submit(_scan, *subdir, include,
+                                                    exclude, stats))
+                    if entry is not None:
+                        yield entry
+
+
+def list_directory(s):
+    '''recursion.list_directory, using walk()'''
+    if not os.path.exists(s):
+        print(s + ' does not exist')
+        return
+    print('Directory listing of ' + s)
+    for entry in walk(s):
+        if entry.is_dir:
+            print('\t' * entry.depth + 'Directory: ' + entry.name)
+        else:
+            print('\t' * entry.depth + entry.name)
+
+
+# Benchmark
+# -----------------------------------------------------------------------------
+
+def listdir_walk(top):
+    '''The os.listdir + os.path.isdir approach from recursion.py'''
+    count = 0
+    for f in os.listdir(top):
+        path = os.path.join(top, f)
+        count += 1
+        if os.path.isdir(path):
+            count += listdir_walk(path)
+    return count
+
+
+def make_tree(top, dirs=200, files=100):
+    for d in range(dirs):
+        path = os.path.join(top, 'dir{:03}'.format(d // 20), 'sub{:03}'.format(d))
+        os.makedirs(path)
+        for f in range(files):
+            ext = '.py' if f % 10 == 0 else '.txt'
+            with open(os.path.join(path, 'file{:03}{}'.format(f, ext)), 'w'):
+                pass
+
+
+def benchmark():
+    with tempfile.TemporaryDirectory() as tmp:
+        make_tree(tmp)
+        tests = [
+            ('listdir + isdir', lambda: listdir_walk(tmp)),
+            ('os.walk', lambda: sum(len(d) + len(f) for _, d, f in os.walk(tmp))),
+            ('walk', lambda: sum(1 for e in walk(tmp))),
+            ('walk, 8 threads', lambda: sum(1 for e in walk(tmp, workers=8))),
+            ('walk, stats', lambda: sum(1 for e in walk(tmp, stats=True))),
+            ("walk, '*.py'", lambda: sum(1 for e in walk(tmp, include='*.py'))),
+        ]
+        for label, func in tests:
+            start = time.perf_counter()
+            count = func()
+            elapsed = time.perf_counter() - start
+            print('{:<18} {:>6} entries {:>10,.0f} entries/sec'.format(
+                label, count, count / elapsed))
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    list_directory('./data/music')
+    # Directory listing of ./data/music
+    # Directory: Beatles ...
+
+    for entry in walk('./data', include='*.csv', stats=True):
+        print(entry.path, entry.size)
+        # ./data/volcanoes.csv 8057 ...
+
+    print('-' * 75)
+    benchmark()
+
+# Warm disk cache, so the threads don't have much waiting to overlap:
+# listdir + isdir     20210 entries    233,138 entries/sec
+# os.walk             20210 entries  1,733,142 entries/sec
+# walk                20210 entries    849,222 entries/sec
+# walk, 8 threads     20210 entries    367,247 entries/sec
+# walk, stats         20210 entries    197,761 entries/sec
+# walk, '*.py'         2000 entries     67,082 entries/sec
+
+# os.walk() looks fastest because it only hands back lists of names, it
+# doesn't build an object per entry. The threads only pay off when listing a
+# directory actually has to wait on the disk or the network.
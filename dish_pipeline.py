@@ -0,0 +1,436 @@
+'''A reusable producer/consumer pipeline: the dishwasher, N stages long'''
+
+
+# concurrency.py washes dishes in the main program and dries them in one
+# process, passing one dish at a time through a JoinableQueue. A few things
+# get in the way of using that for real work:
+
+# 1. Every put() pickles one dish and writes it down a pipe, and every get()
+#    reads and unpickles it. When the work per item is small, that overhead
+#    is most of the time. Here items move between stages in chunks (a list of
+#    chunk_size items), so it's one pickle and one pipe write per chunk.
+# 2. The dryer loops forever, so it has to be a daemon or the program never
+#    exits. Here nothing is a daemon (so a stage function can start processes
+#    of its own, which a daemon process isn't allowed to). Instead each stage
+#    gets one sentinel (STOP) per worker after the last chunk. A worker that
+#    reads STOP returns, every process and thread is join()ed, and nothing is
+#    killed half way through a dish. If you stop reading the results early
+#    (break, or an exception), the feeder stops, the workers throw away
+#    what's left in their queues, and everything is shut down the same way.
+#    Only a worker process that's still stuck after SHUTDOWN_TIMEOUT seconds
+#    gets terminated. A thread can't be killed, so a stuck thread worker is
+#    left to finish in the background (and Python waits for it on exit).
+# 3. Only one washer and one dryer. A Stage says how many workers it gets, so
+#    a slow stage can have more of them.
+# 4. No way to see what's going on. Each stage counts the items it has
+#    finished, the time its workers spent busy, and the deepest its input
+#    queue has been. stats() reads them at any time, even while running.
+
+# Pipeline(stages, backend) runs on 'process' (multiprocessing, for CPU bound
+# work), 'thread' (for I/O bound work) or 'asyncio' (for I/O bound work that's
+# written as coroutines). In the asyncio backend a plain function runs in the
+# event loop and blocks it, so give it async def functions.
+
+import asyncio
+import multiprocessing as mp
+import queue
+import threading
+import time
+from collections import namedtuple
+
+STOP = None
+SHUTDOWN_TIMEOUT = 5.0
+
+StageStats = namedtuple('StageStats',
+                        'name workers items busy rate queued peak_queued')
+
+
+class Stage():
+    def __init__(self, func, workers=1, name=None):
+        self.func = func
+        self.workers = workers
+        self.name = name or func.__name__
+
+
+class StageError(Exception):
+    pass
+
+
+class _Failed():
+    '''Passed down the pipeline in place of a chunk that raised'''
+
+    def __init__(self, stage, error):
+        self.stage = stage
+        self.error = error
+
+
+def _qsize(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:  # multiprocessing on macOS
+        return 0
+
+
+def _process_chunk(stage, chunk, counters):
+    '''Returns the output chunk (or _Failed) and updates the counters'''
+    if isinstance(chunk, _Failed):
+        return chunk
+    start = time.perf_counter()
+    try:
+        out = [stage.func(item) for item in chunk]
+    except Exception as e:
+        out = _Failed(stage.name, repr(e))
+    busy = time.perf_counter() - start
+    with counters.get_lock():
+        counters[0] += len(chunk)
+        counters[1] += busy
+    return out
+
+
+def _worker(stage, inbox, outbox, counters, stop):
+    while True:
+        chunk = inbox.get()
+        if chunk is STOP:
+            return
+        if stop.is_set():
+            continue  # nobody wants the results any more, skip to STOP
+        queued = _qsize(inbox)
+        if queued > counters[2]:
+            counters[2] = queued  # a rough high water mark, no lock needed
+        outbox.put(_process_chunk(stage, chunk, counters))
+
+
+async def _async_worker(stage, inbox, outbox, counters, stop):
+    while True:
+        chunk = await inbox.get()
+        if chunk is STOP:
+            return
+        if stop.is_set():
+            continue
+        counters[2] = max(counters[2], inbox.qsize())
+        if isinstance(chunk, _Failed):
+            await outbox.put(chunk)
+            continue
+        start = time.perf_counter()
+        try:
+            out = []
+            for item in chunk:
+                result = stage.func(item)
+                if asyncio.iscoroutine(result):
+                    result = await result
+                out.append(result)
+        except Exception as e:
+            out = _Failed(stage.name, repr(e))
+        counters[0] += len(chunk)
+        counters[1] += time.perf_counter() - start
+        await outbox.put(out)
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Pipeline():
+    '''Runs items through each stage in turn, with workers for each stage'''
+
+    def __init__(self, stages, backend='process', chunk_size=100,
+                 queue_size=16):
+        if backend not in ('process', 'thread', 'asyncio'):
+            raise ValueError('unknown backend: {!r}'.format(backend))
+        self.stages = stages
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size  # in chunks, for backpressure
+        # [items, busy seconds, peak queue depth] per stage. mp.Array lives in
+        # shared memory, so the workers can update it from any process:
+        self.counters = [mp.Array('d', 3) for _ in stages]
+        self._queues = []
+        self._started = self._finished = None
+
+    def run(self, items):
+        '''Yields the results (unordered when a stage has several workers)'''
+        for c in self.counters:
+            c[:] = [0, 0, 0]
+        self._started = time.perf_counter()
+        self._finished = None
+        failures = []
+        if self.backend == 'asyncio':
+            results = self._run_async(items)
+        else:
+            results = self._run_workers(items)
+        try:
+            for chunk in results:
+                if isinstance(chunk, _Failed):
+                    failures.append(chunk)
+                    continue
+                yield from chunk
+        finally:
+            # shuts everything down, even if the caller stopped early
+            results.close()
+            self._finished = time.perf_counter()
+        if failures:
+            raise StageError('{} chunk(s) failed, first in {}: {}'.format(
+                len(failures), failures[0].stage, failures[0].error))
+
+    def _run_workers(self, items):
+        if self.backend == 'process':
+            Queue, Worker, Event = mp.Queue, mp.Process, mp.Event
+        else:
+            Queue, Worker, Event = queue.Queue, threading.Thread, threading.Event
+        self._queues = [Queue(self.queue_size) for _ in self.stages]
+        results = Queue()
+        stop = Event()
+        outboxes = self._queues[1:] + [results]
+        workers = []
+        for stage, inbox, outbox, counters in zip(
+                self.stages, self._queues, outboxes, self.counters):
+            group = [Worker(target=_worker,
+                            args=(stage, inbox, outbox, counters, stop))
+                     for _ in range(stage.workers)]
+            for w in group:
+                w.start()
+            workers.append(group)
+        errors = []
+        # set when run() gives up waiting for a clean shutdown:
+        abandoned = threading.Event()
+
+        def put(q, item):
+            # A put() that can't block forever on a queue whose workers were
+            # terminated. Returns False if it gave up.
+            while True:
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    if abandoned.is_set():
+                        return False
+
+        def feed():
+            # The washer. Once everything's in, shut the stages down in
+            # order: a stage only gets its STOPs after every worker in the
+            # stage before it has finished, so nothing is left behind.
+            try:
+                for chunk in chunked(items, self.chunk_size):
+                    if stop.is_set() or not put(self._queues[0], chunk):
+                        break
+            except BaseException as e:
+                errors.append(e)  # items raised, re-raised by run()
+                stop.set()
+            for inbox, group in zip(self._queues, workers):
+                for _ in group:
+                    put(inbox, STOP)
+                for w in group:
+                    w.join()
+            results.put(STOP)
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        try:
+            # read results while the feeder works: a process doesn't finish
+            # until what it put on a queue has been read, so join() would
+            # wait forever if we read them afterwards
+            while True:
+                chunk = results.get()
+                if chunk is STOP:
+                    break
+                yield chunk
+        finally:
+            stop.set()
+            deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+            while feeder.is_alive() and time.monotonic() < deadline:
+                try:
+                    results.get(timeout=0.05)  # thrown away, see above
+                except queue.Empty:
+                    pass
+            if feeder.is_alive():
+                abandoned.set()
+                if self.backend == 'process':
+                    for group in workers:
+                        for w in group:
+                            w.terminate()
+                    feeder.join()
+        if errors:
+            raise errors[0]
+
+    def _run_async(self, items):
+        # A plain generator driving its own event loop, so results can be
+        # yielded as they arrive, the same as the other backends.
+        loop = asyncio.new_event_loop()
+        try:
+            self._queues = [asyncio.Queue(self.queue_size)
+                            for _ in self.stages]
+            results = asyncio.Queue()
+            stop = threading.Event()
+            outboxes = self._queues[1:] + [results]
+            groups = []
+            for stage, inbox, outbox, counters in zip(
+                    self.stages, self._queues, outboxes, self.counters):
+                groups.append([loop.create_task(
+                    _async_worker(stage, inbox, outbox, counters, stop))
+                    for _ in range(stage.workers)])
+            feeder = loop.create_task(self._feed_async(items, groups, results,
+                                                       stop))
+            while True:
+                chunk = loop.run_until_complete(results.get())
+                if chunk is STOP:
+                    break
+                yield chunk
+            loop.run_until_complete(feeder)  # raises if items raised
+        finally:
+            stop.set()
+            pending = [t for t in asyncio.all_tasks(loop) if not t.done()]
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(
+                    *pending, return_exceptions=True))
+            loop.close()
+
+    async def _feed_async(self, items, groups, results, stop):
+        error = None
+        try:
+            for chunk in chunked(items, self.chunk_size):
+                await self._queues[0].put(chunk)
+        except Exception as e:
+            # (but not CancelledError: then run() is shutting us down)
+            error = e
+            stop.set()
+        for inbox, group in zip(self._queues, groups):
+            for _ in group:
+                await inbox.put(STOP)
+            await asyncio.gather(*group)
+        await results.put(STOP)
+        if error:
+            raise error
+
+    def stats(self):
+        '''A StageStats per stage. rate is items/sec since run() started'''
+        end = self._finished or time.perf_counter()
+        elapsed = end - self._started if self._started else 0
+        result = []
+        for i, (stage, c) in enumerate(zip(self.stages, self.counters)):
+            items, busy, peak = c[:]
+            queued = _qsize(self._queues[i]) if self._queues else 0
+            result.append(StageStats(stage.name, stage.workers, int(items),
+                                     busy, items / elapsed if elapsed else 0.0,
+                                     queued, int(peak)))
+        return result
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# The stage functions are at the top level of the module so the process
+# backend can pickle them. scrub/dry stand in for CPU bound work, soak/rack
+# for I/O bound work (waiting on a disk or the network).
+
+def scrub(dish):
+    return dish, sum(i * i for i in range(300))
+
+
+def dry(washed):
+    dish, _ = washed
+    return dish
+
+
+def soak(dish):
+    time.sleep(0.001)
+    return dish
+
+
+def rack(dish):
+    time.sleep(0.0005)
+    return dish
+
+
+async def async_soak(dish):
+    await asyncio.sleep(0.001)
+    return dish
+
+
+async def async_rack(dish):
+    await asyncio.sleep(0.0005)
+    return dish
+
+
+def benchmark(label, stages, items, **kwargs):
+    pipeline = Pipeline(stages, **kwargs)
+    start = time.perf_counter()
+    count = sum(1 for _ in pipeline.run(items))
+    elapsed = time.perf_counter() - start
+    assert count == len(items)
+    print('{:<36} {:>8,.0f} dishes/sec'.format(label, count / elapsed))
+    return pipeline
+
+
+if __name__ == '__main__':
+    dishes = ['dish {}'.format(i) for i in range(20000)]
+
+    print('CPU bound (scrub x4 workers, dry x1)')
+    cpu = [Stage(scrub, workers=4), Stage(dry)]
+    benchmark('  thread', cpu, dishes, backend='thread')
+    benchmark('  process, chunk_size=1', cpu, dishes, backend='process',
+              chunk_size=1)
+    pipeline = benchmark('  process, chunk_size=100', cpu, dishes,
+                         backend='process')
+    benchmark('  asyncio', cpu, dishes, backend='asyncio')
+
+    print('I/O bound (soak x32 workers, rack x16)')
+    dishes = dishes[:4000]
+    io = [Stage(soak, workers=32), Stage(rack, workers=16)]
+    benchmark('  thread, chunk_size=10', io, dishes, backend='thread',
+              chunk_size=10)
+    benchmark('  process, chunk_size=10', io, dishes, backend='process',
+              chunk_size=10)
+    aio = [Stage(async_soak, workers=32, name='soak'),
+           Stage(async_rack, workers=16, name='rack')]
+    benchmark('  asyncio, chunk_size=10', aio, dishes, backend='asyncio',
+              chunk_size=10)
+
+    print('-' * 75)
+    print('stats from the process run with chunk_size=100:')
+    for s in pipeline.stats():
+        print('  {:<6} x{}  {:>6,} items  busy {:>5.2f}s  {:>8,.0f}/sec  '
+              'queue peak {} chunks'.format(s.name, s.workers, s.items,
+                                           s.busy, s.rate, s.peak_queued))
+
+    # a stage that raises doesn't hang the pipeline:
+    try:
+        list(Pipeline([Stage(int)], backend='process').run(['1', 'two', '3']))
+    except StageError as e:
+        print('StageError:', e)
+
+# CPU bound (scrub x4 workers, dry x1)
+#   thread                               33,267 dishes/sec
+#   process, chunk_size=1                 7,423 dishes/sec
+#   process, chunk_size=100              29,304 dishes/sec
+#   asyncio                              34,712 dishes/sec
+# I/O bound (soak x32 workers, rack x16)
+#   thread, chunk_size=10                19,428 dishes/sec
+#   process, chunk_size=10                5,054 dishes/sec
+#   asyncio, chunk_size=10                6,233 dishes/sec
+# ---------------------------------------------------------------------------
+# stats from the process run with chunk_size=100:
+#   scrub  x4  20,000 items  busy  1.81s    29,306/sec  queue peak 16 chunks
+#   dry    x1  20,000 items  busy  0.00s    29,306/sec  queue peak 8 chunks
+# StageError: 1 chunk(s) failed, first in int: ValueError("invalid literal for int() with base 10: 'two'")
+
+# These numbers are from a machine with a single CPU, so the 4 scrub
+# processes can't run at the same time and the process backend only pays the
+# overhead. With 4 or more cores it's the only backend where scrub gets
+# faster, since threads and asyncio share one GIL. Either way, compare the two
+# process runs: sending one dish at a time (like the JoinableQueue example)
+# is about 4 times slower than sending 100 at a time.
+
+# The scrub queue peaking at 16 (queue_size) means the washer was waiting on
+# the scrubbers: that's the stage to give more workers.
+
+# For the I/O bound stages the work is waiting, so threads do well and
+# processes just add overhead. Items within a chunk are handled one after the
+# other, so smaller chunks (or more workers) keep more of them waiting at once.
@@ -0,0 +1,202 @@
+'''Fibonacci: memoization, fast doubling and resumable generators'''
+
+
+# recursion.py has three ways of calculating Fibonacci numbers:
+# fib_r - recursive, O(2^n) because it calculates the same values over and
+#         over again. fib_r(35) already takes seconds.
+# fib_i - iterative, O(n) additions.
+# fib_g - a generator, also O(n) additions.
+
+# This module adds:
+# fib_memo - the recursive version with functools.lru_cache, so each value is
+#            only calculated once.
+# fib      - "fast doubling", which needs O(log n) steps.
+# fib_g    - a generator that can start part way through the sequence by
+#            resuming from a saved checkpoint instead of starting at 0.
+
+# Keep in mind these numbers get big. fib(1000000) has 208,988 digits, and
+# adding or multiplying numbers that size isn't free. Fast doubling wins
+# because it needs about 20 big multiplications instead of a million big
+# additions.
+
+import bisect
+import time
+from functools import lru_cache
+
+
+# Memoization
+# -----------------------------------------------------------------------------
+# lru_cache stores the result for each argument. fib_r(n) calls fib_r(n - 1)
+# and fib_r(n - 2), and with the cache, the second call is just a lookup.
+# maxsize=None means the cache never throws anything away. That's what we want
+# here, but remember every cached value stays in memory.
+
+@lru_cache(maxsize=None)
+def fib_memo(n):
+    '''Calculates fibonacci recursively, with memoization'''
+    if n < 2:
+        return n
+    return fib_memo(n - 1) + fib_memo(n - 2)
+
+# The cache doesn't remove the recursion though. The first call to
+# fib_memo(5000) still recurses 5000 levels deep and hits the recursion limit
+# (1000 by default). Filling the cache in order keeps each call shallow:
+
+def fib_memo_warm(n, step=100):
+    for i in range(0, n, step):
+        fib_memo(i)
+    return fib_memo(n)
+
+
+# Fast doubling
+# -----------------------------------------------------------------------------
+# Given F(k) and F(k+1) you can jump straight to:
+# F(2k)   = F(k) * (2*F(k+1) - F(k))
+# F(2k+1) = F(k)^2 + F(k+1)^2
+# Walking through the bits of n from the top, each bit doubles k (and adds
+# one if the bit is set), so it takes len(bin(n)) steps to get to F(n). This
+# is the same as raising the matrix [[1, 1], [1, 0]] to the nth power, but
+# without the redundant multiplications.
+
+def fib_pair(n):
+    '''Returns the tuple (F(n), F(n + 1))'''
+    a, b = 0, 1  # F(0), F(1)
+    for bit in bin(n)[2:]:
+        c = a * (2 * b - a)
+        d = a * a + b * b
+        if bit == '1':
+            a, b = d, c + d
+        else:
+            a, b = c, d
+    return a, b
+
+
+def fib(n):
+    '''Calculates fibonacci in O(log n) steps'''
+    if n < 0:
+        raise ValueError('n must be >= 0')
+    return fib_pair(n)[0]
+
+
+# Resumable generator
+# -----------------------------------------------------------------------------
+# fib_g(n) from recursion.py always starts from 0. This one takes a start and
+# picks up from the closest checkpoint it has saved at or before start. Every
+# CHECKPOINT values it saves (F(k), F(k+1)) so later calls can reuse the work.
+# If there is no checkpoint close enough, it jumps there with fast doubling.
+
+CHECKPOINT = 10000
+_checkpoints = {0: (0, 1)}
+_checkpoint_keys = [0]  # kept sorted for bisect
+
+
+def _save_checkpoint(k, pair):
+    if k not in _checkpoints:
+        _checkpoints[k] = pair
+        bisect.insort(_checkpoint_keys, k)
+
+
+def fib_g(n, start=0):
+    '''Generates F(start) ... F(n - 1)'''
+    k = _checkpoint_keys[bisect.bisect_right(_checkpoint_keys, start) - 1]
+    if start - k > CHECKPOINT:
+        k = start - start % CHECKPOINT
+        _save_checkpoint(k, fib_pair(k))
+    a, b = _checkpoints[k]
+    while k < n:
+        if k % CHECKPOINT == 0:
+            _save_checkpoint(k, (a, b))
+        if k >= start:
+            yield a
+        a, b = b, a + b
+        k += 1
+
+
+# Benchmark
+# -----------------------------------------------------------------------------
+
+def fib_i(n):
+    '''fib_i from recursion.py'''
+    a, b = 0, 1
+    for i in range(n):
+        a, b = b, a + b
+    return a
+
+
+def fib_r(n):
+    '''fib_r from recursion.py'''
+    if n < 2:
+        return n
+    else:
+        return fib_r(n - 1) + fib_r(n - 2)
+
+
+def last(iterable):
+    value = None
+    for value in iterable:
+        pass
+    return value
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark(sizes=(25, 1000, 10000, 100000, 1000000)):
+    variants = [
+        # (name, function, largest sensible n)
+        ('fib_r', fib_r, 25),
+        # a cache holding every value up to 10^6 would need ~40GB:
+        ('fib_memo', fib_memo_warm, 10000),
+        ('fib_i', fib_i, None),
+        ('fib_g', lambda n: last(fib_g(n + 1)), None),
+        ('fib_g resume', lambda n: last(fib_g(n + 1, n)), None),
+        ('fib', fib, None),
+    ]
+    print('{:>10}'.format('n') + ''.join('{:>14}'.format(v[0]) for v in variants))
+    for n in sizes:
+        expected = fib(n)
+        row = '{:>10}'.format(n)
+        for name, func, limit in variants:
+            if limit is not None and n > limit:
+                row += '{:>14}'.format('-')
+                continue
+            fib_memo.cache_clear()
+            result, elapsed = timed(func, n)
+            assert result == expected, name
+            row += '{:>14.6f}'.format(elapsed)
+        print(row)
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    print([fib(i) for i in range(10)])
+    # [0, 1, 1, 2, 3, 5, 8, 13, 21, 34]
+    print([fib_memo(i) for i in range(10)])
+    # [0, 1, 1, 2, 3, 5, 8, 13, 21, 34]
+    print(list(fib_g(10)))
+    # [0, 1, 1, 2, 3, 5, 8, 13, 21, 34]
+    print(list(fib_g(15, 10)))
+    # [55, 89, 144, 233, 377]
+
+    try:
+        fib_memo(5000)
+    except RecursionError as e:
+        print(e)  # maximum recursion depth exceeded
+    print(len(str(fib_memo_warm(5000))))  # 1045
+
+    print('-' * 75)
+    benchmark()
+
+# Seconds on a laptop. fib_g resume runs after fib_g, so it starts from the
+# checkpoint fib_g saved on its way past n:
+#  n        fib_r  fib_memo     fib_i     fib_g  fib_g resume       fib
+#  25       0.019  0.000046  0.000005  0.000023      0.000007  0.000014
+#  1000         -  0.000578  0.000075  0.000277      0.000165  0.000015
+#  10000        -  0.011519  0.002673  0.003950      0.000007  0.000109
+#  100000       -         -  0.185761  0.197011      0.000020  0.002782
+#  1000000      -         - 16.324967 14.403290      0.000040  0.076570
@@ -88,6 +88,9 @@ print(next(search_generator))  # Mama, life had just begun
 print(next(search_generator))  # Mama, ooo
 print(next(search_generator))  # Mama, ooo (anyway the wind blows)
 
+# Every call to search() reads the whole file again. If you need to search the
+# same large file many times, see search_index.py for an indexed version.
+
 
 # Another Generator example
 # -----------------------------------------------------------------------------
@@ -0,0 +1,206 @@
+'''Concurrent API Fetching: sessions, threads, retries and a cache'''
+
+
+# pygal_hn_api_example.py makes 100 API calls, one after the other, with
+# requests.get(). Each one opens a new connection (a TCP handshake plus a TLS
+# handshake for https), waits for the response, and closes the connection
+# again. Almost all of that time is spent waiting on the network.
+
+# HNFetcher speeds that up in four ways:
+
+# 1. requests.Session() keeps connections open and reuses them (keep-alive),
+#    so only the first request to a host pays for the handshakes.
+# 2. A ThreadPoolExecutor runs several requests at once. While one thread is
+#    waiting for a response, the others can send theirs. max_workers is the
+#    concurrency limit, so we don't hammer the server.
+# 3. Failed requests (connection errors, timeouts, 429 and 5xx responses) are
+#    retried with exponential backoff: wait 0.5s, then 1s, then 2s...
+# 4. Each item is saved to cache_dir/<id>.json. Running the script again only
+#    fetches the ids that aren't in the cache yet.
+
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HN_API = 'https://hacker-news.firebaseio.com/v0/'
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class HNFetcher():
+
+    def __init__(self, base_url=HN_API, cache_dir=None, max_workers=10,
+                 retries=3, backoff=0.5, timeout=10, max_age=None):
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_age = max_age  # seconds, None means cached items never expire
+        self.session = requests.Session()
+        # By default a session keeps 10 connections per host. Match that to
+        # the number of threads so none of them have to open extra ones:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.stats = {'fetched': 0, 'cached': 0, 'retries': 0, 'failed': 0}
+        self._lock = threading.Lock()  # protects self.stats
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def get_json(self, path):
+        '''GETs base_url + path, retrying with exponential backoff'''
+        url = self.base_url + path
+        for attempt in range(self.retries + 1):
+            try:
+                r = self.session.get(url, timeout=self.timeout)
+                if r.status_code not in RETRY_STATUS:
+                    r.raise_for_status()
+                    return r.json()
+                error = requests.HTTPError('{} for {}'.format(r.status_code, url))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt == self.retries:
+                raise error
+            self._count('retries')
+            # Exponential backoff with a little randomness (jitter), so that a
+            # group of threads that failed together don't all retry together:
+            delay = self.backoff * 2 ** attempt
+            time.sleep(delay + random.uniform(0, delay / 2))
+
+    def top_stories(self):
+        return self.get_json('topstories.json')
+
+    def _cache_file(self, item_id):
+        return os.path.join(self.cache_dir, '{}.json'.format(item_id))
+
+    def _read_cache(self, item_id):
+        if not self.cache_dir:
+            return None
+        filename = self._cache_file(item_id)
+        try:
+            if self.max_age is not None:
+                if time.time() - os.path.getmtime(filename) > self.max_age:
+                    return None
+            with open(filename) as fob:
+                return json.load(fob)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, item_id, item):
+        if not self.cache_dir:
+            return
+        # Write to a temporary file and then rename it. A rename is atomic,
+        # so a crash can't leave half a JSON file in the cache:
+        filename = self._cache_file(item_id)
+        with open(filename + '.tmp', 'w') as fob:
+            json.dump(item, fob)
+        os.replace(filename + '.tmp', filename)
+
+    def fetch_item(self, item_id):
+        item = self._read_cache(item_id)
+        if item is not None:
+            self._count('cached')
+            return item
+        try:
+            item = self.get_json('item/{}.json'.format(item_id))
+        except requests.RequestException:
+            self._count('failed')
+            return None
+        self._count('fetched')
+        # deleted items come back as null, don't cache those:
+        if item is not None:
+            self._write_cache(item_id, item)
+        return item
+
+    def fetch_items(self, item_ids):
+        '''Returns a list of item dicts (or None) in the same order as ids'''
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            return list(executor.map(self.fetch_item, item_ids))
+
+    def close(self):
+        self.session.close()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# A local stand in for the HN API, so this runs without the internet. Each
+# request sleeps for 20ms to act like a network round trip, and about 1 in 10
+# item requests fail with a 503 to show off the retries.
+
+if __name__ == '__main__':
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StubHN(BaseHTTPRequestHandler):
+        # HTTP/1.1 so that connections are kept alive:
+        protocol_version = 'HTTP/1.1'
+        connections = set()
+
+        def do_GET(self):
+            StubHN.connections.add(self.client_address)
+            time.sleep(0.02)
+            if self.path == '/v0/topstories.json':
+                body = list(range(1000, 1100))
+            elif self.path.startswith('/v0/item/'):
+                if random.random() < 0.1:
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                item_id = int(self.path.split('/')[-1].split('.')[0])
+                body = {'id': item_id, 'title': 'Story {}'.format(item_id),
+                        'descendants': item_id % 97}
+            else:
+                body = None
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', 0), StubHN)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://localhost:{}/v0/'.format(server.server_address[1])
+
+    # The original approach:
+    ids = requests.get(base_url + 'topstories.json').json()
+    start = time.perf_counter()
+    for item_id in ids[:20]:
+        requests.get(base_url + 'item/{}.json'.format(item_id))
+    elapsed = time.perf_counter() - start
+    print('requests.get():      {:.2f} sec for 20 items'.format(elapsed))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for run in ('first run', 'second run'):
+            fetcher = HNFetcher(base_url, cache_dir=tmp, backoff=0.05)
+            StubHN.connections.clear()
+            start = time.perf_counter()
+            items = fetcher.fetch_items(fetcher.top_stories())
+            elapsed = time.perf_counter() - start
+            print('HNFetcher, {}: {:.2f} sec for {} items, {} connections'
+                  .format(run, elapsed, len(items), len(StubHN.connections)))
+            print('   ', fetcher.stats)
+            fetcher.close()
+
+    server.shutdown()
+
+# requests.get():      0.51 sec for 20 items
+# HNFetcher, first run: 0.78 sec for 100 items, 10 connections
+#     {'fetched': 100, 'cached': 0, 'retries': 8, 'failed': 0}
+# HNFetcher, second run: 0.03 sec for 100 items, 1 connections
+#     {'fetched': 0, 'cached': 100, 'retries': 0, 'failed': 0}
@@ -0,0 +1,440 @@
+'''An indexed binary heap: change or remove any item in O(log n)'''
+
+
+# queues.py puts (priority, item) tuples in a PriorityQueue. That's fine until
+# something's priority changes, like a scheduler moving a job up or a timer
+# being pushed back. A heap can't find an item without looking at every
+# element, so the usual trick is to push a second copy with the new priority
+# and ignore the old one when it comes out. With lots of changes the heap
+# fills up with stale copies that take memory and slow every push and pop.
+
+# IndexedHeap keeps every entry's position in the heap inside the entry. push()
+# returns the entry as a handle, and with the handle:
+# - update_priority(handle, p) moves the entry up or down from where it is,
+#   O(log n), no copies.
+# - remove(handle) swaps the entry with the last one, drops it, and fixes up
+#   the swapped one, O(log n).
+# - cancel(handle) is the lazy version of remove: O(1), the entry is just
+#   marked and skipped when it reaches the top. When more than half the heap
+#   is cancelled entries it's rebuilt without them (compact()), so they can't
+#   pile up.
+
+# Entries with the same priority come out in the order they were pushed, like
+# heapq's (priority, count, item) recipe.
+
+# heapq is written in C, and this is pure Python, so plain push/pop is slower.
+# It pays off when priorities change a lot. See the benchmark at the end.
+
+import heapq
+import itertools
+import threading
+import time
+from queue import PriorityQueue
+
+
+class Entry():
+    __slots__ = ('priority', 'count', 'item', 'index', 'cancelled')
+
+    def __init__(self, priority, count, item):
+        self.priority = priority
+        self.count = count
+        self.item = item
+        self.index = None  # position in the heap list, None once it's out
+        self.cancelled = False
+
+    def __repr__(self):
+        return 'Entry({!r}, {!r})'.format(self.priority, self.item)
+
+
+class IndexedHeap():
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cancelled = 0
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def __contains__(self, handle):
+        return handle.index is not None and not handle.cancelled
+
+    def push(self, item, priority):
+        '''Adds item, returns the handle for changing or removing it'''
+        entry = Entry(priority, next(self._counter), item)
+        entry.index = len(self._heap)
+        self._heap.append(entry)
+        self._sift_up(entry.index)
+        return entry
+
+    def _pop_head(self):
+        heap = self._heap
+        entry = heap[0]
+        last = heap.pop()
+        if heap:
+            heap[0] = last
+            last.index = 0
+            self._sift_down(0)
+        entry.index = None
+        return entry
+
+    def _discard_cancelled(self):
+        '''Pops cancelled entries off the top until a live one is there'''
+        while self._heap and self._heap[0].cancelled:
+            self._pop_head()
+            self._cancelled -= 1
+
+    def pop(self):
+        '''Removes and returns the lowest (priority, item)'''
+        self._discard_cancelled()
+        if not self._heap:
+            raise IndexError('pop from an empty heap')
+        entry = self._pop_head()
+        return entry.priority, entry.item
+
+    def peek(self):
+        self._discard_cancelled()
+        if not self._heap:
+            raise IndexError('peek at an empty heap')
+        entry = self._heap[0]
+        return entry.priority, entry.item
+
+    def update_priority(self, handle, priority):
+        if handle not in self:
+            raise KeyError(handle)
+        old = handle.priority
+        handle.priority = priority
+        if priority < old:
+            self._sift_up(handle.index)
+        else:
+            self._sift_down(handle.index)
+
+    def remove(self, handle):
+        if handle not in self:
+            raise KeyError(handle)
+        heap = self._heap
+        index = handle.index
+        last = heap.pop()
+        handle.index = None
+        if last is not handle:
+            heap[index] = last
+            last.index = index
+            # the moved entry might belong above or below its new spot:
+            self._sift_up(index)
+            self._sift_down(last.index)
+        return handle.item
+
+    def cancel(self, handle):
+        '''Lazy remove: O(1) now, the entry is dropped later'''
+        if handle not in self:
+            raise KeyError(handle)
+        handle.cancelled = True
+        self._cancelled += 1
+        if self._cancelled > len(self._heap) // 2:
+            self.compact()
+        return handle.item
+
+    def compact(self):
+        '''Rebuilds the heap without cancelled entries, O(n)'''
+        live = []
+        for entry in self._heap:
+            if entry.cancelled:
+                entry.index = None
+            else:
+                entry.index = len(live)
+                live.append(entry)
+        self._heap = live
+        self._cancelled = 0
+        for i in reversed(range(len(live) // 2)):
+            self._sift_down(i)
+
+    # The same sifting heapq does, but every move also updates entry.index.
+
+    def _sift_up(self, index):
+        heap = self._heap
+        entry = heap[index]
+        priority, count = entry.priority, entry.count
+        while index > 0:
+            parent_index = (index - 1) >> 1
+            parent = heap[parent_index]
+            # comparing the fields is quicker than building tuples:
+            if priority > parent.priority or (
+                    priority == parent.priority and count > parent.count):
+                break
+            heap[index] = parent
+            parent.index = index
+            index = parent_index
+        heap[index] = entry
+        entry.index = index
+
+    def _sift_down(self, index):
+        heap = self._heap
+        size = len(heap)
+        entry = heap[index]
+        priority, count = entry.priority, entry.count
+        child_index = 2 * index + 1
+        while child_index < size:
+            child = heap[child_index]
+            right_index = child_index + 1
+            if right_index < size:
+                right = heap[right_index]
+                if right.priority < child.priority or (
+                        right.priority == child.priority and
+                        right.count < child.count):
+                    child, child_index = right, right_index
+            if priority < child.priority or (
+                    priority == child.priority and count < child.count):
+                break
+            heap[index] = child
+            child.index = index
+            index = child_index
+            child_index = 2 * index + 1
+        heap[index] = entry
+        entry.index = index
+
+
+class SynchronizedHeap():
+    '''An IndexedHeap for several threads. pop() can wait like Queue.get()'''
+
+    def __init__(self, heap=None):
+        self.heap = heap if heap is not None else IndexedHeap()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+
+    def __len__(self):
+        with self._lock:
+            return len(self.heap)
+
+    def push(self, item, priority):
+        with self._lock:
+            handle = self.heap.push(item, priority)
+            self._not_empty.notify()
+            return handle
+
+    def pop(self, block=True, timeout=None):
+        with self._not_empty:
+            if block and not self._not_empty.wait_for(lambda: len(self.heap),
+                                                      timeout):
+                raise IndexError('pop timed out')
+            return self.heap.pop()
+
+    def update_priority(self, handle, priority):
+        with self._lock:
+            self.heap.update_priority(handle, priority)
+
+    def remove(self, handle):
+        with self._lock:
+            return self.heap.remove(handle)
+
+    def cancel(self, handle):
+        with self._lock:
+            return self.heap.cancel(handle)
+
+
+# heapq and PriorityQueue versions of the same thing
+# -----------------------------------------------------------------------------
+# This is the recipe from the heapq docs: entries are lists, a dict finds the
+# entry for an item, and a changed or removed entry is marked REMOVED and
+# left in the heap.
+
+REMOVED = '<removed>'
+
+
+class HeapqScheduler():
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def push(self, item, priority):
+        if item in self.entries:
+            self.entries.pop(item)[-1] = REMOVED
+        entry = [priority, next(self.counter), item]
+        self.entries[item] = entry
+        heapq.heappush(self.heap, entry)
+
+    update_priority = push
+
+    def remove(self, item):
+        self.entries.pop(item)[-1] = REMOVED
+
+    def size(self):
+        return len(self.heap)
+
+    def pop(self):
+        while self.heap:
+            priority, _, item = heapq.heappop(self.heap)
+            if item is not REMOVED:
+                del self.entries[item]
+                return priority, item
+        raise IndexError('pop from an empty heap')
+
+
+class QueueScheduler():
+    '''PriorityQueue can't mark entries, so it compares against a dict'''
+
+    def __init__(self):
+        self.queue = PriorityQueue()
+        self.current = {}
+        self.counter = itertools.count()
+
+    def push(self, item, priority):
+        count = next(self.counter)
+        self.current[item] = count
+        self.queue.put((priority, count, item))
+
+    update_priority = push
+
+    def remove(self, item):
+        del self.current[item]
+
+    def size(self):
+        return self.queue.qsize()
+
+    def pop(self):
+        while not self.queue.empty():
+            priority, count, item = self.queue.get()
+            if self.current.get(item) == count:
+                del self.current[item]
+                return priority, item
+        raise IndexError('pop from an empty queue')
+
+
+class IndexedScheduler():
+    '''IndexedHeap with a dict of item -> handle, for the same API'''
+
+    def __init__(self):
+        self.heap = IndexedHeap()
+        self.handles = {}
+
+    def push(self, item, priority):
+        self.handles[item] = self.heap.push(item, priority)
+
+    def update_priority(self, item, priority):
+        self.heap.update_priority(self.handles[item], priority)
+
+    def remove(self, item):
+        self.heap.remove(self.handles.pop(item))
+
+    def size(self):
+        return len(self.heap._heap)
+
+    def pop(self):
+        priority, item = self.heap.pop()
+        del self.handles[item]
+        return priority, item
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+def churn(scheduler, ops, jobs, seed=1):
+    '''A scheduler workload: many reschedules and cancels for each pop'''
+    import random
+    rnd = random.Random(seed)
+    live = []       # job ids, with position telling us where each one is
+    position = {}
+    next_job = 0
+    peak = 0
+
+    def forget(job):
+        i = position.pop(job)
+        last = live.pop()
+        if last != job:
+            live[i] = last
+            position[last] = i
+
+    for n in range(ops):
+        r = rnd.random()
+        if r < 0.2 or len(live) < jobs:
+            scheduler.push(next_job, rnd.random())
+            position[next_job] = len(live)
+            live.append(next_job)
+            next_job += 1
+        elif r < 0.8:
+            scheduler.update_priority(rnd.choice(live), rnd.random())
+        elif r < 0.9:
+            job = rnd.choice(live)
+            scheduler.remove(job)
+            forget(job)
+        else:
+            _, job = scheduler.pop()
+            forget(job)
+        if n % 100 == 0:
+            peak = max(peak, scheduler.size())
+    return peak
+
+
+if __name__ == '__main__':
+    h = IndexedHeap()
+    medium = h.push('medium-level task', 2)
+    h.push('important task 1', 1)
+    low = h.push('low-level task', 3)
+    h.push('important task 2', 1)
+    h.update_priority(low, 0)
+    h.remove(medium)
+    while h:
+        print(h.pop())
+    print('-' * 75)
+
+    # check against sorted() with lots of random changes:
+    import random
+    h = IndexedHeap()
+    expected = {}
+    handles = []
+    for i in range(5000):
+        p = random.random()
+        handles.append(h.push(i, p))
+        expected[i] = p
+    for handle in random.sample(handles, 2000):
+        p = random.random()
+        h.update_priority(handle, p)
+        expected[handle.item] = p
+    for handle in random.sample(handles, 2000):
+        (h.remove if handle.count % 2 else h.cancel)(handle)
+        del expected[handle.item]
+    assert [h.pop() for _ in range(len(h))] == sorted(
+        (p, i) for i, p in expected.items())
+
+    # SynchronizedHeap: the worker thread waits in pop() until there's
+    # something to do:
+    timers = SynchronizedHeap()
+    fired = []
+    first = timers.push('first', 1)
+    timers.push('second', 2)
+    timers.update_priority(first, 3)
+    worker = threading.Thread(
+        target=lambda: [fired.append(timers.pop()[1]) for _ in range(3)])
+    worker.start()
+    time.sleep(0.1)
+    timers.push('third', 4)
+    worker.join()
+    print('fired:', fired)
+
+    ops = 200000
+    for name, Scheduler in (('PriorityQueue', QueueScheduler),
+                            ('heapq + REMOVED', HeapqScheduler),
+                            ('IndexedHeap', IndexedScheduler)):
+        scheduler = Scheduler()
+        start = time.perf_counter()
+        peak = churn(scheduler, ops, jobs=10000)
+        elapsed = time.perf_counter() - start
+        print('{:<16} {:>8,.0f} ops/sec  heap peaked at {:>7,} entries'.format(
+            name, ops / elapsed, peak))
+
+# (0, 'low-level task')
+# (1, 'important task 1')
+# (1, 'important task 2')
+# ---------------------------------------------------------------------------
+# fired: ['second', 'first', 'third']
+# PriorityQueue     219,012 ops/sec  heap peaked at 140,979 entries
+# heapq + REMOVED   343,005 ops/sec  heap peaked at 140,979 entries
+# IndexedHeap       242,825 ops/sec  heap peaked at  10,425 entries
+
+# The workload keeps about 10,000 jobs scheduled and does 60% reschedules and
+# 10% cancels. heapq is still the fastest because its push and pop are C, and
+# PriorityQueue adds a lock to every call. But both of them end up holding 14
+# entries for every live job, and that keeps growing the longer it runs.
+# IndexedHeap holds exactly the live jobs. With fewer changes (or when memory
+# matters) heapq's recipe is fine, with many changes the stale entries are
+# what you pay for.
@@ -0,0 +1,275 @@
+'''Inventory Repository: persistent connections and batched CRUD'''
+
+
+# postgreSQL_example.py has five little functions (create, insert, display,
+# delete, update) and each one connects to the database, runs one statement,
+# commits and disconnects. Opening a connection is expensive. For PostgreSQL
+# it means a network handshake, authentication and a new server process. For
+# sqlite it means opening the file and reading the schema. Doing that for
+# every row adds up fast.
+
+# This example rewrites them as a repository class with:
+
+# 1. A connection pool, so connections are opened once and reused.
+# 2. Bulk methods (insert_many, update_many, delete_many) that send many rows
+#    per statement instead of one statement (and one round trip) per row.
+# 3. A streaming display. fetchall() pulls the whole table into a list. A
+#    PostgreSQL "named" cursor is a server-side cursor: rows stay on the
+#    server and are sent over in chunks of cursor.itersize as we iterate.
+#    sqlite cursors already step through the results lazily.
+
+# The same Inventory class works against either database. The differences
+# (placeholder style, how to get a connection, how to stream) live in two
+# small backend classes. The SQLite one can be used anywhere, so the testing
+# section at the bottom runs without a PostgreSQL server.
+
+import itertools
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from sqlite3_pool import ConnectionPool
+
+
+def chunked(iterable, size):
+    '''Yields lists of up to size items from iterable'''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class SQLiteBackend():
+    placeholder = '?'
+    # sqlite's default limit on ? parameters in one statement:
+    max_params = 999
+    # Without a network round trip, executemany() is just as quick as one
+    # big UPDATE ... FROM (VALUES ...) statement.
+    update_from = False
+
+    def __init__(self, filename, size=5):
+        self.pool = ConnectionPool(filename, size=size)
+
+    def connection(self):
+        return self.pool.connection()
+
+    def stream_cursor(self, conn, itersize):
+        curs = conn.cursor()
+        curs.arraysize = itersize
+        return curs
+
+    def close(self):
+        self.pool.close()
+
+
+class PostgresBackend():
+    placeholder = '%s'
+    # PostgreSQL allows up to 65535 parameters per statement:
+    max_params = 65535
+    update_from = True
+
+    def __init__(self, dsn, minconn=1, maxconn=5):
+        # Only needed if you're actually using PostgreSQL:
+        import psycopg2.pool
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.pool.getconn()
+        try:
+            yield conn
+        finally:
+            # putconn() doesn't reset the connection, so don't leave an open
+            # transaction behind for the next user:
+            if not conn.closed:
+                conn.rollback()
+            self.pool.putconn(conn)
+
+    def stream_cursor(self, conn, itersize):
+        # Giving the cursor a name makes it a server-side cursor:
+        curs = conn.cursor(name='inventory_stream')
+        curs.itersize = itersize
+        return curs
+
+    def close(self):
+        self.pool.closeall()
+
+
+class Inventory():
+    '''create, insert, display, delete and update from postgreSQL_example.py'''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._statements = {}  # cached multi-row statements, see _values()
+
+    def _values(self, rows, columns):
+        # Builds '(?, ?, ?), (?, ?, ?), ...' for this many rows. The last
+        # chunk is usually shorter, so cache one string per row count.
+        key = (rows, columns)
+        if key not in self._statements:
+            p = self.backend.placeholder
+            row = '(' + ', '.join([p] * columns) + ')'
+            self._statements[key] = ', '.join([row] * rows)
+        return self._statements[key]
+
+    def _rows_per_statement(self, columns):
+        return self.backend.max_params // columns
+
+    def create(self):
+        with self.backend.connection() as conn:
+            curs = conn.cursor()
+            curs.execute('''CREATE TABLE IF NOT EXISTS inventory
+              (item TEXT, quantity INT, cost FLOAT)''')
+            curs.execute('''CREATE INDEX IF NOT EXISTS inventory_item
+              ON inventory (item)''')
+            conn.commit()
+
+    def insert(self, item, quantity, cost):
+        return self.insert_many([(item, quantity, cost)])
+
+    def insert_many(self, rows):
+        '''rows is an iterable of (item, quantity, cost)'''
+        count = 0
+        with self.backend.connection() as conn:
+            curs = conn.cursor()
+            for chunk in chunked(rows, self._rows_per_statement(3)):
+                sql = 'INSERT INTO inventory VALUES ' + self._values(len(chunk), 3)
+                curs.execute(sql, list(itertools.chain.from_iterable(chunk)))
+                count += len(chunk)
+            conn.commit()
+        return count
+
+    def update(self, quantity, cost, item):
+        return self.update_many([(quantity, cost, item)])
+
+    def update_many(self, rows):
+        '''rows is an iterable of (quantity, cost, item)'''
+        count = 0
+        with self.backend.connection() as conn:
+            curs = conn.cursor()
+            if self.backend.update_from:
+                for chunk in chunked(rows, self._rows_per_statement(3)):
+                    curs.execute(
+                        'UPDATE inventory SET quantity = v.quantity::int, '
+                        'cost = v.cost::float FROM (VALUES '
+                        + self._values(len(chunk), 3) +
+                        ') AS v (quantity, cost, item) '
+                        'WHERE inventory.item = v.item',
+                        list(itertools.chain.from_iterable(chunk)))
+                    count += len(chunk)
+            else:
+                p = self.backend.placeholder
+                for chunk in chunked(rows, 1000):
+                    curs.executemany('UPDATE inventory SET quantity={0}, '
+                                     'cost={0} WHERE item={0}'.format(p), chunk)
+                    count += len(chunk)
+            conn.commit()
+        return count
+
+    def delete(self, item):
+        return self.delete_many([item])
+
+    def delete_many(self, items):
+        count = 0
+        with self.backend.connection() as conn:
+            curs = conn.cursor()
+            for chunk in chunked(items, self._rows_per_statement(1)):
+                marks = ', '.join([self.backend.placeholder] * len(chunk))
+                curs.execute('DELETE FROM inventory WHERE item IN ({})'
+                             .format(marks), chunk)
+                count += len(chunk)
+            conn.commit()
+        return count
+
+    def stream(self, itersize=2000):
+        '''Yields inventory rows without loading the whole table'''
+        with self.backend.connection() as conn:
+            curs = self.backend.stream_cursor(conn, itersize)
+            try:
+                curs.execute('SELECT * FROM inventory')
+                while True:
+                    rows = curs.fetchmany(itersize)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                curs.close()
+
+    def display(self):
+        '''Same as the original: returns a list of every row'''
+        return list(self.stream())
+
+    def close(self):
+        self.backend.close()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# For PostgreSQL you'd use:
+# inventory = Inventory(PostgresBackend("dbname='test1' user='postgres' ..."))
+
+if __name__ == '__main__':
+    import sqlite3
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'test.db')
+        inventory = Inventory(SQLiteBackend(filename))
+        inventory.create()
+        inventory.insert('Coffee', 25, 10.5)
+        inventory.insert_many([('Rocks', 5, 2), ('Dice', 100, 0.5)])
+        inventory.delete('Rocks')
+        inventory.update(100, 0.25, 'Dice')
+        print(inventory.display())
+        # [('Coffee', 25, 10.5), ('Dice', 100, 0.25)]
+
+        print('-' * 75)
+        count = 20000
+        rows = [('item{}'.format(i), i, i / 100) for i in range(count)]
+
+        # The original: one connection and one statement per row.
+        def insert(item, quantity, cost):
+            conn = sqlite3.connect(filename)
+            curs = conn.cursor()
+            curs.execute('INSERT INTO inventory VALUES (?, ?, ? )',
+              (item, quantity, cost))
+            curs.connection.commit()
+            curs.close()
+            conn.close()
+
+        start = time.perf_counter()
+        for row in rows[:2000]:
+            insert(*row)
+        elapsed = time.perf_counter() - start
+        print('insert():      {:>10,.0f} rows/sec'.format(2000 / elapsed))
+        inventory.delete_many(row[0] for row in rows[:2000])
+
+        start = time.perf_counter()
+        inventory.insert_many(rows)
+        elapsed = time.perf_counter() - start
+        print('insert_many(): {:>10,.0f} rows/sec'.format(count / elapsed))
+
+        start = time.perf_counter()
+        inventory.update_many((q * 2, c, item) for item, q, c in rows)
+        elapsed = time.perf_counter() - start
+        print('update_many(): {:>10,.0f} rows/sec'.format(count / elapsed))
+
+        start = time.perf_counter()
+        total = sum(row[1] for row in inventory.stream())
+        elapsed = time.perf_counter() - start
+        print('stream():      {:>10,.0f} rows/sec'.format((count + 2) / elapsed))
+
+        start = time.perf_counter()
+        inventory.delete_many(row[0] for row in rows)
+        elapsed = time.perf_counter() - start
+        print('delete_many(): {:>10,.0f} rows/sec'.format(count / elapsed))
+        print(inventory.display())
+        # [('Coffee', 25, 10.5), ('Dice', 100, 0.25)]
+        inventory.close()
+
+# insert():           1,500 rows/sec
+# insert_many():    400,000 rows/sec
+# update_many():    150,000 rows/sec
+# stream():       1,500,000 rows/sec
+# delete_many():    200,000 rows/sec
@@ -0,0 +1,148 @@
+'''Streaming JSON: reading a big JSON array one item at a time'''
+
+
+# json.load() reads the whole file and builds every object in memory before
+# you get to look at any of them. population_data.json is a list of 12,000+
+# small dictionaries, so the file is about 1MB but the Python objects take
+# several times that. A file 1000 times bigger would need 1000 times the
+# memory.
+
+# iter_array() reads the file in chunks and uses JSONDecoder.raw_decode(),
+# which decodes one JSON value from the start of a string and tells us where
+# it stopped. So we can pull the items out of the array one at a time and
+# hand each one over as soon as it's decoded. Only one chunk of text (plus
+# one item) is in memory at a time, however big the file is.
+
+# iter_records() applies the year/country filter inside the generator, so
+# rows that don't match are thrown away as soon as they're decoded instead of
+# being collected and filtered later.
+
+import json
+import re
+import time
+import tracemalloc
+
+_decoder = json.JSONDecoder()
+# A regex skips a run of whitespace much faster than a Python while loop:
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+DELIMITERS = ',] \t\n\r'
+
+
+def iter_array(fob, chunk_size=65536):
+    '''Yields each item of the JSON array in the open file fob'''
+    buffer = fob.read(chunk_size)
+    pos = 0
+
+    def fill():
+        # Drop what's been used and read more, returns False at end of file
+        nonlocal buffer, pos
+        more = fob.read(chunk_size)
+        buffer = buffer[pos:] + more
+        pos = 0
+        return bool(more)
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            pos = WHITESPACE.match(buffer, pos).end()
+            if pos < len(buffer) or not fill():
+                return
+
+    skip_whitespace()
+    if buffer[pos:pos + 1] != '[':
+        raise ValueError('Expected a JSON array')
+    pos += 1
+    skip_whitespace()
+    if buffer[pos:pos + 1] == ']':
+        return
+    while True:
+        skip_whitespace()
+        try:
+            item, end = _decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Probably only part of the item is in the buffer:
+            if not fill():
+                raise
+            continue
+        # raw_decode can stop early on a number split across two chunks:
+        # 12|34 decodes as 12, 10.|25 as 10 and 1e|5 as 1. A number is only
+        # finished when something that can't be part of it comes next.
+        if end == len(buffer) or (isinstance(item, (int, float)) and
+                                  buffer[end] not in DELIMITERS):
+            if fill():
+                continue
+        pos = end
+        yield item
+        skip_whitespace()
+        char = buffer[pos:pos + 1]
+        pos += 1
+        if char == ']':
+            return
+        if char != ',':
+            raise ValueError('Expected , or ] in JSON array')
+
+
+def iter_records(filename, year=None, country=None):
+    '''Yields population_data.json rows, optionally for one year/country'''
+    with open(filename) as fob:
+        for pop_dict in iter_array(fob):
+            if year is not None and pop_dict['Year'] != year:
+                continue
+            if country is not None and pop_dict['Country Name'] != country:
+                continue
+            yield pop_dict
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import io
+    filename = 'data/population_data.json'
+
+    # small chunks, so items are split across reads:
+    text = '[1, 22.5, "three", {"four": [4, 4]}, null, 1234567]'
+    print(list(iter_array(io.StringIO(text), chunk_size=3)))
+    # [1, 22.5, 'three', {'four': [4, 4]}, None, 1234567]
+
+    # numbers split after the integer part, or in the exponent, at every
+    # possible place:
+    for text in ['[10.25]', '[1e5]', '[-0.5]', '[2.5E-3, 7]',
+                 '[ 12 , 1.5e+10 ]']:
+        for size in range(1, len(text) + 1):
+            assert list(iter_array(io.StringIO(text), size)) == json.loads(text)
+
+    for pop_dict in iter_records(filename, year='2010', country='Canada'):
+        print(pop_dict)
+        # {'Country Name': 'Canada', 'Country Code': 'CAN', 'Year': '2010',
+        #  'Value': '34126000'}
+
+    print('-' * 75)
+
+    def load_and_filter():
+        with open(filename) as fob:
+            pop_data = json.load(fob)
+        return [d for d in pop_data if d['Year'] == '2010']
+
+    def stream_and_filter():
+        return list(iter_records(filename, year='2010'))
+
+    for label, func in [('json.load', load_and_filter),
+                        ('iter_records', stream_and_filter)]:
+        start = time.perf_counter()
+        rows = func()
+        elapsed = time.perf_counter() - start
+        # tracemalloc slows everything down, so measure memory separately:
+        tracemalloc.start()
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('{:<13} {} rows {:>7.1f} ms  peak memory {:>6,.0f} KB'.format(
+            label, len(rows), elapsed * 1000, peak / 1024))
+
+# json.load     246 rows    17.5 ms  peak memory  6,424 KB
+# iter_records  246 rows    41.9 ms  peak memory    455 KB
+
+# json.load is faster here because all of its work happens in C. The point of
+# iter_records is that its peak memory stays the same for a 1MB file or a
+# 1GB one, and json.load's doesn't.
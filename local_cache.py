@@ -0,0 +1,551 @@
+'''A local cache server: sharded dict, TTL wheel, LRU/LFU, memcached protocol'''
+
+
+# noSQL_datastores.py shows off memcached and Redis strings: set and get,
+# incr and decr, expire and ttl, and a cache that throws old data away when
+# memory runs out. All of that needs a server running. Cache here does the
+# same things inside your own process, and serve() puts it behind a TCP port
+# that speaks enough of the memcached text protocol for a memcached client.
+
+# How it's put together:
+
+# 1. Lock striping. The keys are split over `shards` dicts by hash(key), and
+#    each shard has its own lock. Two threads only wait for each other when
+#    their keys land in the same shard, instead of every operation taking one
+#    big lock.
+# 2. A byte budget. Each entry is counted as its key + value + a fixed
+#    overhead. When a shard goes over its share of max_bytes, entries are
+#    evicted:
+#    'lru' - the least recently used (each shard is an OrderedDict, and every
+#            hit moves the key to the end).
+#    'lfu' - like lru, but a key that's been used gets a second chance: its
+#            count of hits is halved and it goes to the back of the line. A
+#            key is only evicted once its count is down to 0, so the popular
+#            keys survive a flood of keys that are only used once. It's an
+#            approximation (Redis's LFU is too), but it's O(1).
+#    An entry bigger than a whole shard's share can never fit, so set()
+#    raises ValueTooLarge for it instead of storing it and evicting it
+#    straight away (memcached answers SERVER_ERROR object too large).
+# 3. A timer wheel for expiry. The wheel is a ring of `slots` sets, one per
+#    tick (resolution seconds). expire() drops the key in the set for the
+#    tick when it expires, O(1). A background thread moves along one slot per
+#    tick and deletes the keys in it that are due. A key due more than a lap
+#    away just stays in its slot until the lap it's due. get() also checks
+#    the time, so nothing is ever returned late even between ticks.
+
+# Python threads share the GIL, so more shards won't make more threads run at
+# once. What striping buys is that a thread holding one shard's lock (say, in
+# the middle of evicting) doesn't hold up the others.
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+OVERHEAD = 64  # rough bytes of bookkeeping per entry, for the budget
+
+
+class ValueTooLarge(ValueError):
+    pass
+
+
+class Entry():
+    __slots__ = ('value', 'flags', 'expires', 'slot', 'hits', 'size')
+
+    def __init__(self, value, flags, expires, size):
+        self.value = value
+        self.flags = flags
+        self.expires = expires  # time.monotonic() deadline, or None
+        self.slot = None        # the wheel slot it's waiting in
+        self.hits = 0
+        self.size = size
+
+
+class _Shard():
+    def __init__(self, budget, slots):
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.bytes = 0
+        self.budget = budget
+        self.wheel = [set() for _ in range(slots)]
+        # counted per shard, under the shard's lock:
+        self.stats = dict.fromkeys(('hits', 'misses', 'evictions', 'expired'), 0)
+
+
+def _bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    # numbers, like redis-py does. It refuses anything else (None included)
+    # rather than storing b'None', and so do we:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value).encode('utf-8')
+    raise TypeError('invalid value of type {}: convert it to bytes, str, '
+                    'int or float first'.format(type(value).__name__))
+
+
+class Cache():
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, shards=16, policy='lru',
+                 resolution=1.0, slots=3600):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("policy must be 'lru' or 'lfu'")
+        self.policy = policy
+        self.resolution = resolution
+        self.slots = slots
+        self.shards = [_Shard(max_bytes // shards, slots) for _ in range(shards)]
+        self._tick = self._now_tick()
+        self._running = True
+        self._reaper = threading.Thread(target=self._reap, daemon=True)
+        self._reaper.start()
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def _now_tick(self):
+        return int(time.monotonic() / self.resolution)
+
+    # Inside a shard (the caller holds shard.lock)
+    # -------------------------------------------------------------------------
+
+    def _live(self, shard, key):
+        '''The entry for key if it hasn't expired, else None'''
+        entry = shard.data.get(key)
+        if entry is None:
+            return None
+        if entry.expires is not None and entry.expires <= time.monotonic():
+            self._remove(shard, key)
+            shard.stats['expired'] += 1
+            return None
+        return entry
+
+    def _remove(self, shard, key):
+        entry = shard.data.pop(key)
+        shard.bytes -= entry.size
+        # (the key may still be in a wheel slot, the reaper skips it)
+
+    def _schedule(self, shard, key, entry, ttl):
+        if ttl is None:
+            entry.expires = entry.slot = None
+            return
+        entry.expires = time.monotonic() + ttl
+        tick = max(int(entry.expires / self.resolution) + 1, self._tick + 1)
+        entry.slot = tick % self.slots
+        shard.wheel[entry.slot].add(key)
+
+    def _evict(self, shard):
+        data = shard.data
+        while shard.bytes > shard.budget and data:
+            key = next(iter(data))
+            if self.policy == 'lfu':
+                entry = data[key]
+                if entry.hits:
+                    entry.hits //= 2
+                    data.move_to_end(key)
+                    continue
+            self._remove(shard, key)
+            shard.stats['evictions'] += 1
+
+    def _store(self, shard, key, value, ttl, flags):
+        value = _bytes(value)
+        size = len(key) + len(value) + OVERHEAD
+        if size > shard.budget:
+            raise ValueTooLarge('object too large for cache ({:,} bytes, the '
+                                'limit is {:,})'.format(size, shard.budget))
+        old = shard.data.get(key)
+        if old is not None:
+            shard.bytes -= old.size
+        entry = Entry(value, flags, None, size)
+        shard.data[key] = entry
+        shard.data.move_to_end(key)
+        shard.bytes += entry.size
+        self._schedule(shard, key, entry, ttl)
+        self._evict(shard)
+
+    # The commands
+    # -------------------------------------------------------------------------
+
+    def get(self, key, default=None):
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._live(shard, key)
+            if entry is None:
+                shard.stats['misses'] += 1
+                return default
+            shard.stats['hits'] += 1
+            entry.hits += 1
+            shard.data.move_to_end(key)
+            return entry.value
+
+    def gets(self, key):
+        '''(value, flags) or None, for the memcached front end'''
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._live(shard, key)
+            if entry is None:
+                shard.stats['misses'] += 1
+                return None
+            shard.stats['hits'] += 1
+            entry.hits += 1
+            shard.data.move_to_end(key)
+            return entry.value, entry.flags
+
+    def set(self, key, value, ttl=None, flags=0):
+        shard = self._shard(key)
+        with shard.lock:
+            self._store(shard, key, value, ttl, flags)
+        return True
+
+    def setnx(self, key, value, ttl=None, flags=0):
+        '''Sets only if key doesn't exist (memcached calls this add)'''
+        shard = self._shard(key)
+        with shard.lock:
+            if self._live(shard, key) is not None:
+                return False
+            self._store(shard, key, value, ttl, flags)
+            return True
+
+    def delete(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            if self._live(shard, key) is None:
+                return False
+            self._remove(shard, key)
+            return True
+
+    def incr(self, key, amount=1, create=True, minimum=None):
+        '''Adds amount to an integer value. A missing key counts as 0
+
+        With create=False a missing key returns None instead, and minimum
+        stops the value going below it (memcached's counters stop at 0).
+        '''
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._live(shard, key)
+            if entry is None:
+                if not create:
+                    return None
+                value = amount
+                self._store(shard, key, value, None, 0)
+                return value
+            try:
+                value = int(entry.value) + amount
+            except ValueError:
+                raise ValueError('value is not an integer') from None
+            if minimum is not None and value < minimum:
+                value = minimum
+            new = _bytes(value)
+            shard.bytes += len(new) - len(entry.value)
+            entry.size += len(new) - len(entry.value)
+            entry.value = new  # in place, so the ttl is kept
+            return value
+
+    def decr(self, key, amount=1):
+        return self.incr(key, -amount)
+
+    def expire(self, key, seconds):
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._live(shard, key)
+            if entry is None:
+                return False
+            self._schedule(shard, key, entry, seconds)
+            return True
+
+    def persist(self, key):
+        return self.expire(key, None)
+
+    def ttl(self, key):
+        '''Seconds left like Redis: -1 if it never expires, -2 if missing'''
+        shard = self._shard(key)
+        with shard.lock:
+            entry = self._live(shard, key)
+            if entry is None:
+                return -2
+            if entry.expires is None:
+                return -1
+            return max(0, round(entry.expires - time.monotonic()))
+
+    @property
+    def stats(self):
+        totals = dict.fromkeys(self.shards[0].stats, 0)
+        for shard in self.shards:
+            for name, value in shard.stats.items():
+                totals[name] += value
+        return totals
+
+    def __len__(self):
+        return sum(len(shard.data) for shard in self.shards)
+
+    def memory(self):
+        return sum(shard.bytes for shard in self.shards)
+
+    # Expiry
+    # -------------------------------------------------------------------------
+
+    def _reap(self):
+        while self._running:
+            time.sleep(self.resolution)
+            now_tick = self._now_tick()
+            # catch up on every slot we passed (there may be more than one if
+            # the thread was held up)
+            while self._tick < now_tick:
+                self._tick += 1
+                index = self._tick % self.slots
+                for shard in self.shards:
+                    with shard.lock:
+                        self._reap_slot(shard, index)
+
+    def _reap_slot(self, shard, index):
+        slot = shard.wheel[index]
+        if not slot:
+            return
+        now = time.monotonic()
+        keep = set()
+        for key in slot:
+            entry = shard.data.get(key)
+            if entry is None or entry.slot != index:
+                continue  # deleted, or its ttl changed since
+            if entry.expires <= now:
+                self._remove(shard, key)
+                shard.stats['expired'] += 1
+            else:
+                keep.add(key)  # due on a later lap of the wheel
+        shard.wheel[index] = keep
+
+    def close(self):
+        self._running = False
+        self._reaper.join()
+
+
+# memcached text protocol
+# -----------------------------------------------------------------------------
+# Enough of https://github.com/memcached/memcached/blob/master/doc/protocol.txt
+# for the usual clients: get, set, add, delete, incr, decr, touch, stats,
+# quit. memcached exptimes over 30 days are unix timestamps.
+
+async def _handle(cache, reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0].decode('ascii', 'replace').lower()
+            noreply = parts[-1] == b'noreply'
+            if noreply:
+                parts = parts[:-1]
+            reply = b''
+            try:
+                if command in ('get', 'gets'):
+                    out = []
+                    for key in parts[1:]:
+                        found = cache.gets(key.decode('utf-8'))
+                        if found is not None:
+                            value, flags = found
+                            out.append(b'VALUE %s %d %d\r\n%s\r\n'
+                                       % (key, flags, len(value), value))
+                    reply = b''.join(out) + b'END\r\n'
+                elif command in ('set', 'add'):
+                    key, flags, exptime, size = parts[1:5]
+                    data = await reader.readexactly(int(size) + 2)
+                    ttl = _ttl(int(exptime))
+                    key = key.decode('utf-8')
+                    if command == 'set':
+                        cache.set(key, data[:-2], ttl, int(flags))
+                        reply = b'STORED\r\n'
+                    elif cache.setnx(key, data[:-2], ttl, int(flags)):
+                        reply = b'STORED\r\n'
+                    else:
+                        reply = b'NOT_STORED\r\n'
+                elif command == 'delete':
+                    found = cache.delete(parts[1].decode('utf-8'))
+                    reply = b'DELETED\r\n' if found else b'NOT_FOUND\r\n'
+                elif command in ('incr', 'decr'):
+                    key, amount = parts[1].decode('utf-8'), int(parts[2])
+                    amount = amount if command == 'incr' else -amount
+                    value = cache.incr(key, amount, create=False, minimum=0)
+                    if value is None:
+                        reply = b'NOT_FOUND\r\n'
+                    else:
+                        reply = b'%d\r\n' % value
+                elif command == 'touch':
+                    key, exptime = parts[1].decode('utf-8'), int(parts[2])
+                    found = cache.expire(key, _ttl(exptime))
+                    reply = b'TOUCHED\r\n' if found else b'NOT_FOUND\r\n'
+                elif command == 'stats':
+                    stats = dict(cache.stats, curr_items=len(cache),
+                                 bytes=cache.memory())
+                    reply = b''.join(b'STAT %s %d\r\n' % (k.encode(), v)
+                                     for k, v in stats.items()) + b'END\r\n'
+                elif command == 'quit':
+                    break
+                else:
+                    reply = b'ERROR\r\n'
+            except ValueTooLarge:
+                reply = b'SERVER_ERROR object too large for cache\r\n'
+            except (ValueError, IndexError) as e:
+                reply = b'CLIENT_ERROR %s\r\n' % str(e).encode()
+            if not noreply:
+                writer.write(reply)
+                await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def _ttl(exptime):
+    if exptime == 0:
+        return None
+    if exptime > 30 * 24 * 3600:
+        return exptime - time.time()
+    return exptime
+
+
+async def serve(cache, host='localhost', port=11211):
+    '''Serves cache on a memcached style port until cancelled'''
+    server = await asyncio.start_server(
+        lambda r, w: _handle(cache, r, w), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+def hammer(cache, ops, keys, seed):
+    import random
+    rnd = random.Random(seed)
+    for _ in range(ops):
+        key = 'key{}'.format(rnd.randrange(keys))
+        if rnd.random() < 0.1:
+            cache.set(key, 'value', ttl=60)
+        else:
+            cache.get(key)
+
+
+def benchmark(shards, threads, ops=400000):
+    cache = Cache(shards=shards)
+    for i in range(10000):
+        cache.set('key{}'.format(i), 'value')
+    workers = [threading.Thread(target=hammer,
+                                args=(cache, ops // threads, 10000, i))
+               for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    cache.close()
+    return ops / elapsed
+
+
+if __name__ == '__main__':
+    import socket
+    import sys
+
+    if '--serve' in sys.argv:
+        print('memcached protocol on localhost:11211, control c to stop')
+        asyncio.run(serve(Cache()))
+        sys.exit()
+
+    # the noSQL_datastores.py strings and expiration examples:
+    conn = Cache(resolution=0.1)
+    conn.set('item', 'octopus')
+    conn.set('quantity', 2)
+    print(conn.get('item'), conn.setnx('item', 'seahorse'))
+    print(conn.incr('quantity'), conn.incr('quantity', 12),
+          conn.decr('quantity', 5))
+    conn.set('ned', 'ned_will_expire')
+    conn.expire('ned', 5)
+    print(conn.ttl('ned'), conn.get('ned'), conn.ttl('item'), conn.ttl('nope'))
+    conn.expire('ned', 0.5)
+    time.sleep(0.7)
+    print(conn.get('ned'), conn.ttl('ned'), conn.stats['expired'])
+    conn.close()
+
+    # eviction: a 1MB budget, 100 popular keys, then a flood of new keys
+    # that are each used once (like a batch job scanning through everything)
+    for policy in ('lru', 'lfu'):
+        cache = Cache(max_bytes=1024 * 1024, shards=4, policy=policy)
+        for i in range(100):
+            cache.set('popular{}'.format(i), 'x' * 1000)
+        for n in range(5000):
+            cache.get('popular{}'.format(n % 100))
+        for n in range(3000):
+            cache.set('flood{}'.format(n), 'x' * 1000)
+        kept = sum(cache.get('popular{}'.format(i)) is not None
+                   for i in range(100))
+        print('{}: {:,} evictions, {} of 100 popular keys kept, {:,} bytes'
+              .format(policy, cache.stats['evictions'], kept, cache.memory()))
+        cache.close()
+
+    # the memcached front end, talked to with a plain socket:
+    cache = Cache()
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    server = asyncio.run_coroutine_threadsafe(
+        asyncio.start_server(lambda r, w: _handle(cache, r, w),
+                             'localhost', 0), loop).result()
+    port = server.sockets[0].getsockname()[1]
+    with socket.create_connection(('localhost', port)) as sock:
+        f = sock.makefile('rwb')
+        for command in (b'set item 0 0 7\r\noctopus\r\n', b'get item\r\n',
+                        b'set quantity 0 0 1\r\n2\r\n', b'incr quantity 12\r\n',
+                        b'delete item\r\n', b'get item\r\n'):
+            f.write(command)
+            f.flush()
+            reply = f.readline()
+            if reply.startswith(b'VALUE'):
+                reply += f.readline() + f.readline()
+            print(command.split(b'\r\n')[0].decode(), '->',
+                  reply.decode().replace('\r\n', ' ').strip())
+    cache.close()
+    print('-' * 75)
+
+    for shards in (1, 16):
+        for threads in (1, 2, 4, 8):
+            print('{:>2} shards {} threads: {:>9,.0f} ops/sec'.format(
+                shards, threads, benchmark(shards, threads)))
+
+# b'octopus' False
+# 3 15 10
+# 5 b'ned_will_expire' -1 -2
+# None -2 1
+# lru: 2,124 evictions, 0 of 100 popular keys kept, 1,047,248 bytes
+# lfu: 2,124 evictions, 100 of 100 popular keys kept, 1,047,238 bytes
+# set item 0 0 7 -> STORED
+# get item -> VALUE item 0 7 octopus END
+# set quantity 0 0 1 -> STORED
+# incr quantity 12 -> 14
+# delete item -> DELETED
+# get item -> END
+# ---------------------------------------------------------------------------
+#  1 shards 1 threads:   242,796 ops/sec
+#  1 shards 2 threads:   276,225 ops/sec
+#  1 shards 4 threads:   249,517 ops/sec
+#  1 shards 8 threads:   243,107 ops/sec
+# 16 shards 1 threads:   234,904 ops/sec
+# 16 shards 2 threads:   231,305 ops/sec
+# 16 shards 4 threads:   229,617 ops/sec
+# 16 shards 8 threads:   356,442 ops/sec
+
+# As expected with the GIL, the numbers stay about flat as threads are added:
+# every operation is short, so threads rarely find a lock taken, and the
+# shards make little difference either way. (These runs are noisy, so one
+# odd number doesn't mean much.) The thing to take away is that adding
+# threads doesn't make it slower. To use more CPUs, run several processes
+# with serve() and spread the keys over them, which is what memcached
+# clients do with a list of servers.
+
+# To try it with a real memcached client:
+# $ python local_cache.py --serve
+# >>> import memcache
+# >>> mc = memcache.Client(['localhost:11211'])
+# >>> mc.set('item', 'octopus', time=5)
+# >>> mc.get('item')
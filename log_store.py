@@ -0,0 +1,428 @@
+'''A log-structured key-value store: append-only file, index in memory'''
+
+
+# noSQL_datastores.py uses dbm.open('data/definitions', 'c'), and what you get
+# depends on the machine: dbm.gnu, dbm.ndbm, or if neither is installed
+# dbm.dumb, which is pure Python and slow. Reading everything back means
+# db.keys() and then a separate lookup for every key.
+
+# LogStore is a pure Python alternative that's fast on every machine. The
+# idea is the one behind Bitcask (Riak's storage engine) and, in a fancier
+# form, LevelDB and friends:
+
+# 1. The data file is a log. Every write, including a delete, appends a
+#    record to the end: a header (crc32, key length, value length), the key
+#    and the value. Nothing is ever overwritten in place, so a write is one
+#    sequential append no matter how big the file gets.
+# 2. A plain dict maps each key to where its latest value is in the file, so
+#    a read is one dict lookup and one slice. Opening the store reads the log
+#    from start to end to rebuild the dict (a record with a bad crc32, like
+#    one half written when the power went out, ends the log).
+# 3. Reads come from an mmap of the file: the operating system pages the
+#    file into memory as needed and there's no seek() and read() per lookup.
+#    Recent writes wait in a small buffer in memory (and can be read from
+#    there) until it's big enough to be worth a write() call.
+# 4. Overwritten and deleted values stay in the file as garbage. When more
+#    than half of the file is garbage, a background thread copies the live
+#    records to a new file and swaps it in. Most of the copying happens
+#    without holding the lock. Anything written in the meantime is copied
+#    over at the end.
+# 5. items() reads the log from front to back and yields the records that are
+#    still live, so a full scan is one sequential pass, not a lookup per key.
+
+# LogStore has the same mapping interface as a dbm object (bytes or str keys
+# and values in, bytes out), so shelve.Shelf(LogStore(...)) works too.
+
+import builtins
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections.abc import MutableMapping
+
+HEADER = struct.Struct('<III')  # crc32, key length, value length
+TOMBSTONE = 0xFFFFFFFF          # value length of a delete record
+
+
+def _bytes(value):
+    return value.encode('utf-8') if isinstance(value, str) else bytes(value)
+
+
+class LogStore(MutableMapping):
+
+    def __init__(self, filename, flag='c', buffer_size=1 << 20,
+                 compact_ratio=0.5, compact_min=1 << 20):
+        if flag not in ('r', 'w', 'c', 'n'):
+            raise ValueError("flag must be one of 'r', 'w', 'c' or 'n'")
+        if flag == 'n' and os.path.exists(filename):
+            os.remove(filename)
+        if flag in ('r', 'w') and not os.path.exists(filename):
+            raise FileNotFoundError(filename)
+        self.filename = filename
+        self.readonly = flag == 'r'
+        self.buffer_size = buffer_size
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self._lock = threading.RLock()
+        self._compactor = None
+        self.compactions = 0
+        self._open_file()
+        self._index = {}   # key: (offset of the value, length of the value)
+        self._garbage = 0  # bytes in the file that aren't live any more
+        self._load()
+
+    # Files
+    # -------------------------------------------------------------------------
+
+    def _open_file(self):
+        # (builtins.open, since this module has its own open() like dbm)
+        self._file = builtins.open(self.filename, 'rb' if self.readonly else 'ab+')
+        self._size = os.fstat(self._file.fileno()).st_size  # written so far
+        self._buffer = bytearray()  # appended after _size, not written yet
+        self._map = None
+        self._remap()
+
+    def _remap(self):
+        # The old map isn't closed here: items() or a compaction might still
+        # be reading it. It closes itself once nothing refers to it.
+        # (mmap can't map an empty file.)
+        if self._size:
+            self._map = mmap.mmap(self._file.fileno(), self._size,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self._map = None
+        self._mapped = self._size
+
+    def _records(self, data, start, end):
+        '''Yields (offset, key, value offset, value length) from a log'''
+        offset = start
+        while offset + HEADER.size <= end:
+            crc, klen, vlen = HEADER.unpack_from(data, offset)
+            key_start = offset + HEADER.size
+            value_start = key_start + klen
+            record_end = value_start + (0 if vlen == TOMBSTONE else vlen)
+            if record_end > end:
+                break
+            if zlib.crc32(data[key_start:record_end]) != crc:
+                break
+            yield offset, bytes(data[key_start:value_start]), value_start, vlen
+            offset = record_end
+
+    def _load(self):
+        index = self._index
+        log_end = 0
+        if self._map is not None:
+            for offset, key, value_start, vlen in self._records(
+                    self._map, 0, self._size):
+                log_end = value_start + (0 if vlen == TOMBSTONE else vlen)
+                old = index.pop(key, None)
+                if old:
+                    self._garbage += HEADER.size + len(key) + old[1]
+                if vlen == TOMBSTONE:
+                    self._garbage += HEADER.size + len(key)
+                else:
+                    index[key] = (value_start, vlen)
+        if log_end < self._size:
+            # a half written record at the end, from a crash
+            if self.readonly:
+                raise OSError('{} has a damaged record at {}'.format(
+                    self.filename, log_end))
+            self._map = None
+            self._file.truncate(log_end)
+            self._size = log_end
+            self._remap()
+
+    def _append(self, key, value):
+        '''Adds a record to the buffer, returns where its value starts'''
+        vlen = TOMBSTONE if value is None else len(value)
+        body = key if value is None else key + value
+        value_start = self._size + len(self._buffer) + HEADER.size + len(key)
+        self._buffer += HEADER.pack(zlib.crc32(body), len(key), vlen)
+        self._buffer += body
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+        return value_start
+
+    def _flush(self):
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._file.flush()
+            self._size += len(self._buffer)
+            self._buffer = bytearray()
+
+    def _read(self, offset, length):
+        if offset >= self._size:
+            start = offset - self._size
+            return bytes(self._buffer[start:start + length])
+        if offset + length > self._mapped:
+            self._remap()
+        return self._map[offset:offset + length]
+
+    # The mapping interface
+    # -------------------------------------------------------------------------
+
+    def __getitem__(self, key):
+        key = _bytes(key)
+        with self._lock:
+            offset, length = self._index[key]
+            return self._read(offset, length)
+
+    def __setitem__(self, key, value):
+        if self.readonly:
+            raise OSError('store opened read only')
+        key, value = _bytes(key), _bytes(value)
+        with self._lock:
+            old = self._index.get(key)
+            if old:
+                self._garbage += HEADER.size + len(key) + old[1]
+            self._index[key] = (self._append(key, value), len(value))
+            self._maybe_compact()
+
+    def __delitem__(self, key):
+        if self.readonly:
+            raise OSError('store opened read only')
+        key = _bytes(key)
+        with self._lock:
+            offset, length = self._index.pop(key)
+            self._append(key, None)
+            # the old record and the tombstone are both garbage now
+            self._garbage += 2 * (HEADER.size + len(key)) + length
+            self._maybe_compact()
+
+    def __contains__(self, key):
+        return _bytes(key) in self._index
+
+    def __iter__(self):
+        with self._lock:
+            keys = list(self._index)
+        return iter(keys)
+
+    def keys(self):
+        return list(self)  # like dbm, a list of bytes
+
+    def __len__(self):
+        return len(self._index)
+
+    def items(self):
+        '''Yields (key, value) for every live record, in file order'''
+        with self._lock:
+            self._flush()
+            if self._mapped < self._size:
+                self._remap()
+            data, end = self._map, self._size
+            index = dict(self._index)
+        if data is None:
+            return
+        # If a compaction swaps the file while we're in here, we carry on
+        # reading the old file through this map (see _remap)
+        for offset, key, value_start, vlen in self._records(data, 0, end):
+            if index.get(key, (None,))[0] == value_start:
+                yield key, data[value_start:value_start + vlen]
+
+    def sync(self):
+        with self._lock:
+            if not self.readonly:
+                self._flush()
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        compactor = self._compactor
+        if compactor:
+            compactor.join()
+        with self._lock:
+            if self._file is None:
+                return
+            self._flush()
+            self._map = None
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Compaction
+    # -------------------------------------------------------------------------
+
+    def garbage_ratio(self):
+        total = self._size + len(self._buffer)
+        return self._garbage / total if total else 0.0
+
+    def _maybe_compact(self):
+        if (self._compactor is None and
+                self._size + len(self._buffer) >= self.compact_min and
+                self.garbage_ratio() > self.compact_ratio):
+            self._compactor = threading.Thread(target=self._background_compact)
+            self._compactor.start()
+
+    def _background_compact(self):
+        try:
+            self.compact()
+        finally:
+            with self._lock:
+                self._compactor = None
+
+    def compact(self):
+        '''Rewrites the file with only the live records'''
+        temp = self.filename + '.compact'
+        # 1. Under the lock: note where the log ends and which records are
+        #    live at that point.
+        with self._lock:
+            self._flush()
+            self._remap()
+            data, end = self._map, self._size
+            live = dict(self._index)
+        # 2. Without the lock: copy them to a new file. Writes carry on
+        #    meanwhile, appending to the end of the old file.
+        new_index = {}
+        with builtins.open(temp, 'wb') as out:
+            position = 0
+            for offset, key, value_start, vlen in self._records(data, 0, end):
+                if live.get(key, (None,))[0] != value_start:
+                    continue
+                record = data[offset:value_start + vlen]
+                out.write(record)
+                new_index[key] = (position + value_start - offset, vlen)
+                position += len(record)
+            # 3. Under the lock again: copy whatever was written since step
+            #    1, then swap the files.
+            with self._lock:
+                self._flush()
+                self._remap()
+                garbage = 0
+                for offset, key, value_start, vlen in self._records(
+                        self._map, end, self._size):
+                    record_end = value_start + (0 if vlen == TOMBSTONE else vlen)
+                    out.write(self._map[offset:record_end])
+                    old = new_index.pop(key, None)
+                    if old:
+                        garbage += HEADER.size + len(key) + old[1]
+                    if vlen == TOMBSTONE:
+                        garbage += HEADER.size + len(key)
+                    else:
+                        new_index[key] = (position + value_start - offset, vlen)
+                    position += record_end - offset
+                out.flush()
+                os.fsync(out.fileno())
+                self._map = None
+                self._file.close()
+                os.replace(temp, self.filename)
+                self._open_file()
+                # Deletes in step 2 are already left out of new_index. Any
+                # key that's gone since step 1 was handled by the tail too.
+                self._index = new_index
+                self._garbage = garbage
+                self.compactions += 1
+
+
+def open(filename, flag='c', **kwargs):
+    '''Like dbm.open()'''
+    return LogStore(filename, flag, **kwargs)
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+def benchmark(name, opener, filename, count=50000):
+    import random
+    import time
+    keys = ['word{}'.format(i) for i in range(count)]
+    values = ['definition number {} '.format(i) * 3 for i in range(count)]
+    timings = []
+
+    start = time.perf_counter()
+    db = opener(filename, 'n')
+    for k, v in zip(keys, values):
+        db[k] = v
+    db.close()
+    timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    db = opener(filename, 'r')
+    timings.append(time.perf_counter() - start)
+
+    lookups = random.sample(keys, count)
+    start = time.perf_counter()
+    for k in lookups:
+        db[k]
+    timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if hasattr(db, 'items'):
+        n = sum(1 for _ in db.items())
+    else:
+        n = sum(1 for k in db.keys() if db[k])
+    timings.append(time.perf_counter() - start)
+    assert n == count
+    db.close()
+    print('{:<10} write {:>8,.0f}/s  open {:>6.3f}s  read {:>8,.0f}/s  '
+          'scan {:>9,.0f}/s'.format(name, count / timings[0], timings[1],
+                                     count / timings[2], count / timings[3]))
+
+
+if __name__ == '__main__':
+    import dbm
+    import importlib
+    import shelve
+    import tempfile
+    import time
+
+    with tempfile.TemporaryDirectory() as tmp:
+        definitions = os.path.join(tmp, 'definitions')
+
+        # the noSQL_datastores.py example:
+        with open(definitions, 'c') as db:
+            db['jaune'] = 'yellow'
+            db['rouge'] = 'red'
+            db['vert'] = 'green'
+            del db['rouge']
+        with open(definitions, 'r') as db:
+            print(len(db), db.keys(), db['vert'])
+
+        # shelve on top:
+        with shelve.Shelf(open(definitions + '.shelf')) as pizzas:
+            pizzas['Pesto'] = ['pesto', 'artichoke', 'olives']
+        with shelve.Shelf(open(definitions + '.shelf')) as pizzas:
+            print(pizzas['Pesto'])
+
+        # compaction in the background while writing:
+        with open(os.path.join(tmp, 'churn'), 'n',
+                  compact_min=1 << 18) as db:
+            for i in range(200000):
+                db['key{}'.format(i % 1000)] = 'value {}'.format(i) * 5
+            db.close()
+            size = os.path.getsize(os.path.join(tmp, 'churn'))
+        with open(os.path.join(tmp, 'churn'), 'r') as check:
+            assert check[b'key999'] == b'value 199999' * 5
+            print('{} compactions, {:,} bytes on disk for {} keys'.format(
+                db.compactions, size, len(check)))
+        print('-' * 75)
+
+        for name in ('dbm.gnu', 'dbm.ndbm', 'dbm.dumb'):
+            try:
+                module = importlib.import_module(name)
+            except ImportError:
+                print('{:<10} not installed'.format(name))
+                continue
+            benchmark(name, module.open, os.path.join(tmp, name))
+        benchmark('LogStore', open, os.path.join(tmp, 'log'))
+
+# 2 [b'jaune', b'vert'] b'green'
+# ['pesto', 'artichoke', 'olives']
+# 27 compactions, 91,072 bytes on disk for 1000 keys
+# ---------------------------------------------------------------------------
+# dbm.gnu    not installed
+# dbm.ndbm   not installed
+# dbm.dumb   write   25,790/s  open  1.112s  read   70,699/s  scan    79,868/s
+# LogStore   write  241,495/s  open  0.125s  read  372,805/s  scan   455,101/s
+
+# (This machine only has dbm.dumb. dbm.gnu and dbm.ndbm are C libraries and
+# will read faster than LogStore, but LogStore's writes are just appends.)
+
+# The churn test writes 200,000 values to 1000 keys. Without compaction the
+# file would be about 11MB. The price of this design is that every key has to
+# fit in memory (the index), and opening the store reads the whole file. Real
+# log-structured stores save a "hint file" with the index to start quicker.
@@ -77,6 +77,10 @@ print(test_dict_decoded)
 print(dbm.whichdb('data/definitions'))
 # dbm.ndbm
 
+# If you end up with dbm.dumb, it's slow. See log_store.py for a pure Python
+# store with the same interface that's quick everywhere (and works under
+# shelve too).
+
 
 # Memcached
 # -----------------------------------------------------------------------------
@@ -96,6 +100,10 @@ print(dbm.whichdb('data/definitions'))
 # is inherent in memcached, being that it's a cache server. It avoids running
 # out of memory by discarding old data.
 
+# local_cache.py is a stand in that runs inside your own program (or as a
+# small memcached compatible server), with set/get, incr/decr, expire/ttl
+# and eviction when its memory budget is used up.
+
 
 # Redis
 # -----------------------------------------------------------------------------
@@ -318,6 +326,10 @@ for i in test_zset:
 # (b'bran', 1511231644.845123)
 # (b'aria', 1511310844.845123)
 
+# sorted_set.py has an in process SortedSet with the same operations (add,
+# rank, score, range by rank or by score, pop_min/pop_max), for queries like
+# "who logged in during the last hour" over millions of members.
+
 
 # Redis Bits
 # -----------------------------------------------------------------------------
@@ -363,6 +375,10 @@ conn.getbit('everyday', jon)
 conn.bitop('or', 'alldays', *days)
 conn.bitcount('alldays')
 
+# A Redis bitmap is as long as the largest ID in it, so jon alone makes each
+# of these keys 825KB. roaring.py has a compressed bitmap that only stores the
+# parts that have IDs in them, with the same setbit/getbit/bitop operations.
+
 
 # Redis Caches and Expiration:
 # -----------------------------------------------------------------------------
@@ -171,3 +171,7 @@ class UpdatedURL():
 u = UpdatedURL('https://news.ycombinator.com/')
 serialized = pickle.dumps(u)
 # Now it works!
+
+# Note that every UpdatedURL has its own Timer thread and downloads the whole
+# page every time. See url_watcher.py for a version that shares one scheduler
+# thread between all the URLs and uses conditional GETs.
@@ -46,6 +46,10 @@
 # NOTE: do not use the name 'user' for a table name as is is a reserved word
 # in postgresql. 'users' seems to work fine.
 
+# NOTE: each function below opens and closes its own connection, which keeps
+# the example simple but is slow. See inventory_repository.py for a version
+# with pooled connections and bulk inserts, updates and deletes.
+
 import psycopg2
 
 
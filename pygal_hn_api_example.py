@@ -8,12 +8,16 @@
 # The 'descendants' key contains the number of comments an article has.
 
 import json
+import os
+import tempfile
 from operator import itemgetter
 
 import requests
 import pygal
 from pygal.style import DefaultStyle as DS, LightenStyle as LS
 
+from hn_fetcher import HNFetcher
+
 
 # Make an API call and store the response:
 # -----------------------------------------------------------------------------
@@ -29,16 +33,27 @@ print('Encoding:', r.encoding)
 
 # Process information about each submission:
 # -----------------------------------------------------------------------------
+# Originally this made a separate requests.get() call for each submission, one
+# after the other. HNFetcher (see hn_fetcher.py) makes the calls from a pool of
+# threads over a shared session, retries failures and caches each item in
+# hn_cache under the system's temp directory (not in data/, so the cache
+# doesn't end up in the repo). Running this again within the hour only
+# fetches the new submissions; after that the comment counts are out of date,
+# so max_age makes it fetch them again.
+
+submission_ids = r.json()[:100]
+fetcher = HNFetcher(cache_dir=os.path.join(tempfile.gettempdir(), 'hn_cache'),
+                    max_age=3600)
+try:
+    responses = fetcher.fetch_items(submission_ids)
+finally:
+    fetcher.close()
 
-submission_ids = r.json()
 submission_dicts = []
-for submission_id in submission_ids[:100]:
-    # make a separate API call for each submission:
-    url = ('https://hacker-news.firebaseio.com/v0/item/'
-            + str(submission_id) + '.json')
-    submission_r = requests.get(url)
-    response_dict = submission_r.json()
-
+for submission_id, response_dict in zip(submission_ids, responses):
+    # deleted submissions (or ones that failed after retrying) are None:
+    if not response_dict:
+        continue
     submission_dict = {
         'title' : response_dict['title'],
         'link': 'http://news.ycombinator.com/item?id=' + str(submission_id),
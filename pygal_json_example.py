@@ -4,29 +4,26 @@
 # The data in this example comes from:
 # http://data.okfn.org/
 
-import json
 import pygal
 from pygal.maps.world import COUNTRIES
 from pygal.maps.world import World
 from pygal.style import Style
 
+from country_codes import get_country_code
+from json_stream import iter_records
+
 
 # Explore/Analyze the data
 # -----------------------------------------------------------------------------
 
-# load the data into a list:
 filename = 'data/population_data.json'
-with open(filename) as fob:
-    pop_data = json.load(fob)
 
-# print one year for each country:
-for pop_dict in pop_data:
-    if pop_dict['Year'] == '2010':
-        country_name = pop_dict['Country Name']
-        # some of the populations strings have decimals. In order to
-        # convert them all to ints, we need to convert to floats first.
-        population = int(float(pop_dict['Value']))
-        print(country_name, '–', population)
+# json.load() would build the whole list in memory before we could look at
+# any of it, and then we'd loop over it once to print it and again to map it.
+# iter_records() (see json_stream.py) reads the file one record at a time and
+# only hands back the year we ask for, so memory use stays flat however big
+# the file is. Printing each country is done in the same loop as the rest of
+# the work further down.
 
 
 # Extract the data
@@ -39,28 +36,34 @@ for pop_dict in pop_data:
 for country_code in sorted(COUNTRIES.keys()):
     print(country_code, COUNTRIES[country_code])
 
-def get_country_code(country_name):
-    '''Return the Pygal 2-digit country code for a given country.'''
-    for code, name in COUNTRIES.items():
-        if name == country_name:
-            return code
-    # if the name isn't found, return None:
-    return None
-
-# Test it out:
-cc_populations = {}
-for pop_dict in pop_data:
-    if pop_dict['Year'] == '2010':
-        country_name = pop_dict['Country Name']
-        population = int(float(pop_dict['Value']))
-        code = get_country_code(country_name)
-        if code:
-            cc_populations[code] = population
-        else:
-            print('Error –', country_name)
-
-# There are a quite a few Errors (obv) which fall mainly into two categories:
-#    – some country names don't match exactly (ie Yemen, Rep vs Yemen)
+# get_country_code() (imported from country_codes.py) returns the code for a
+# country name, or None. Rather than looping through all of COUNTRIES for
+# every row, it flips COUNTRIES into a name -> code dictionary once, so each
+# lookup is a single dictionary access. It also matches names that differ
+# slightly (ie Yemen, Rep. vs Yemen).
+
+# Test it out. The population levels are explained in the next section, but
+# sorting each country into its level as we go means one pass over the data
+# instead of building cc_populations and then looping over it again:
+cc_pop1, cc_pop2, cc_pop3 = {}, {}, {}
+for pop_dict in iter_records(filename, year='2010'):
+    country_name = pop_dict['Country Name']
+    # some of the populations strings have decimals. In order to convert
+    # them all to ints, we need to convert to floats first.
+    population = int(float(pop_dict['Value']))
+    print(country_name, '–', population)
+    code = get_country_code(country_name)
+    if not code:
+        print('Error –', country_name)
+    elif population < 10000000:      # 10 million
+        cc_pop1[code] = population
+    elif population < 1000000000:    # 1 billion
+        cc_pop2[code] = population
+    else:
+        cc_pop3[code] = population
+
+# There are still some Errors which fall mainly into two categories:
+#    – some countries aren't on pygal's map (ie Aruba, Bermuda)
 #    – some lines in the dataset aren't by country at all but by region
 #      (ie Arab World) or by economic group (ie all income levels).
 
@@ -69,17 +72,9 @@ for pop_dict in pop_data:
 
 # Plot the data
 # -----------------------------------------------------------------------------
-# group the countries into 3 population levels to have the colouring be more
-# informative (otherwise it just shows China and India a contrastig colour).
-
-cc_pop1, cc_pop2, cc_pop3 = {}, {}, {}
-for cc, pop in cc_populations.items():
-    if pop < 10000000:      # 10 million
-        cc_pop1[cc] = pop
-    elif pop < 1000000000:  # 1 billion
-        cc_pop2[cc] = pop
-    else:
-        cc_pop3[cc] = pop
+# The countries are grouped into 3 population levels to have the colouring be
+# more informative (otherwise it just shows China and India a contrastig
+# colour).
 
 # see how many countries are in each group:
 print(len(cc_pop1), len(cc_pop2), len(cc_pop3))
@@ -93,7 +88,6 @@ wm.title = 'World Population in 2010'
 
 # wm.add('North America',['ca', 'mx', 'us'])
 # wm.add('North America',{'ca': 34126000, 'mx': 113423000, 'us': 309349000})
-# wm.add('2010', cc_populations)
 
 wm.add('0-10m', cc_pop1)
 wm.add('10m-1b', cc_pop2)
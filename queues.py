@@ -195,6 +195,9 @@ right.join()
 # Right: done.
 #  Left: done.
 
+# see also: work_stealing.py, where each worker thread has its own deque. It
+# takes tasks from one end and the other workers steal from the other end.
+
 
 # Priority Queues
 # -----------------------------------------------------------------------------
@@ -227,6 +230,10 @@ while not heap.empty():
 # (2, 'medium-level task')
 # (3, 'low-level task')
 
+# Changing the priority of something already in the queue means putting in a
+# second copy. See indexed_heap.py for a heap that can update or remove an
+# item in place.
+
 
 # Task Queues
 # -----------------------------------------------------------------------------
@@ -370,3 +377,8 @@ def example(seconds):
 
 # The refresh() method needs to be invoked for the contents to be updated
 # from Redis.
+
+# To try all this without a Redis server, local_rq.py has the same Queue,
+# enqueue(), get_current_job() and job.meta API, run by a pool of threads.
+# It can also push progress to the application (job.updates()) instead of
+# the application polling with refresh().
@@ -98,6 +98,9 @@ for i in fib_generator:
     print(i)
     # 0, 1, 1, 2, 3, 5, 8, 13, 21, 34
 
+# fib_r calculates the same values over and over and gets very slow very
+# quickly. See fib.py for a memoized version and a much faster method.
+
 
 # Directory Listings
 # -----------------------------------------------------------------------------
@@ -149,6 +152,9 @@ def list_directory(s):
 
 list_directory('./data')
 
+# os.listdir() only gives us names, so os.path.isdir() has to stat every one.
+# See directory_walker.py for a non-recursive version using os.scandir().
+
 
 # Tips:
 # -----------------------------------------------------------------------------
@@ -429,6 +429,10 @@ conn.commit()
 curs.close()
 conn.close()
 
+# For millions of rows, see sqlite3_bulk.py: it loads any iterable or CSV
+# file in chunked transactions, with faster PRAGMAs and the indexes built
+# after the load.
+
 
 # Cursor or no cursor
 # -----------------------------------------------------------------------------
@@ -0,0 +1,498 @@
+'''A Roaring-style compressed bitmap for sets of user IDs'''
+
+
+# The Redis Bits example in noSQL_datastores.py sets one bit per user ID per
+# day. A Redis bitmap is as long as the largest ID in it, so jon (6603762)
+# logging in makes that day's key 825KB, even if he's the only visitor. With
+# IDs in the tens of millions, every day costs megabytes, mostly zeros.
+
+# Roaring bitmaps (https://roaringbitmap.org) fix that by splitting the
+# 32 bit IDs into chunks of 65536 by their top 16 bits. Each chunk that has
+# any IDs in it gets a container, and the container picks the cheaper of two
+# ways to store the bottom 16 bits:
+
+# - an array of the sorted values (2 bytes each), while it has 4096 or fewer
+#   of them.
+# - a bitmap of 65536 bits (8KB), once it has more. 4096 * 2 bytes is 8KB, so
+#   that's where the bitmap becomes the smaller one.
+
+# Empty chunks cost nothing. Here the bitmap containers are plain Python ints:
+# &, |, & ~ and int.bit_count() on an 8KB int all run in C, which is what
+# makes this quick in pure Python.
+
+# RoaringBitmap has setbit/getbit like Redis, set operations (& | - and
+# bitop()), len() for the cardinality (Redis's bitcount), update() to add lots
+# of IDs at once, and save()/load() for disk.
+
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections import deque
+from itertools import compress, repeat
+
+ARRAY_MAX = 4096
+BITMAP_BYTES = 65536 // 8
+MAGIC = b'RBM1'
+HEADER = struct.Struct('<4sI')      # magic, number of containers
+CONTAINER = struct.Struct('<HBI')   # key, kind (0 array, 1 bitmap), count
+DENSE = 32  # bytes of scratch per id that update() will use to skip sorting
+TO_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+FROM_DIGITS = bytes.maketrans(b'01', b'\x00\x01')
+NOT_DIGITS = bytes.maketrans(b'01', b'\x01\x00')
+ONE = re.compile('1')
+ONE_FLAG = re.compile(b'\x01')
+
+
+def _to_bits(values):
+    '''Sorted 16 bit values -> int with those bits set'''
+    # One byte per bit first, so the loop runs in C (map and deque), then
+    # '0'/'1' digits, most significant first, for int(..., 2).
+    flags = bytearray(65536)
+    deque(map(flags.__setitem__, values, repeat(1)), maxlen=0)
+    return int(flags.translate(TO_DIGITS)[::-1], 2)
+
+
+def _from_bits(bits):
+    '''int -> array of the positions of its set bits'''
+    digits = format(bits, '065536b')[::-1]  # least significant first
+    return array('H', [m.start() for m in ONE.finditer(digits)])
+
+
+def _flags(bits, table=FROM_DIGITS):
+    '''int -> bytes where flags[i] is 1 if bit i is set (with FROM_DIGITS)'''
+    return format(bits, '065536b')[::-1].encode().translate(table)
+
+
+def _container(values=None, bits=None):
+    '''Picks the smaller form. Returns an array('H'), an int or None'''
+    if bits is not None:
+        if bits.bit_count() <= ARRAY_MAX:
+            return _from_bits(bits) if bits else None
+        return bits
+    if not values:
+        return None
+    if len(values) > ARRAY_MAX:
+        return _to_bits(values)
+    return values if isinstance(values, array) else array('H', values)
+
+
+# The containers are never changed once made (add() and discard() replace
+# them), so the results below can share containers with their inputs.
+
+def _and(a, b):
+    if isinstance(a, int) and isinstance(b, int):
+        return _container(bits=a & b)
+    if isinstance(a, int):
+        a, b = b, a
+    if isinstance(b, int):
+        # keep the array values whose bits are set in b (all in C)
+        return _container(array('H', compress(a, map(_flags(b).__getitem__, a))))
+    return _container(array('H', sorted(set(a).intersection(b))))
+
+
+def _or(a, b):
+    if isinstance(a, int) or isinstance(b, int):
+        return _bits(a) | _bits(b)
+    return _container(sorted(set(a).union(b)))
+
+
+def _or_many(containers):
+    if len(containers) == 1:
+        return containers[0]
+    arrays = [c for c in containers if not isinstance(c, int)]
+    bits = 0
+    for c in containers:
+        if isinstance(c, int):
+            bits |= c
+    if bits:
+        return bits | _to_bits(set().union(*arrays)) if arrays else bits
+    return _container(sorted(set().union(*arrays)))
+
+
+def _andnot(a, b):
+    if isinstance(a, int):
+        return _container(bits=a & ~_bits(b))
+    if isinstance(b, int):
+        flags = _flags(b, NOT_DIGITS)
+        return _container(array('H', compress(a, map(flags.__getitem__, a))))
+    return _container(array('H', sorted(set(a).difference(b))))
+
+
+def _bits(c):
+    return c if isinstance(c, int) else _to_bits(c)
+
+
+def _check(n):
+    if not 0 <= n < 1 << 32:
+        raise ValueError('ids have to fit in 32 bits: {}'.format(n))
+
+
+def _count(c):
+    return c.bit_count() if isinstance(c, int) else len(c)
+
+
+class RoaringBitmap():
+
+    def __init__(self, ids=()):
+        self.containers = {}  # top 16 bits: array('H') or int
+        if ids:
+            self.update(ids)
+
+    @classmethod
+    def _from(cls, containers):
+        bm = cls()
+        bm.containers = containers
+        return bm
+
+    # Single IDs
+    # -------------------------------------------------------------------------
+
+    def add(self, n):
+        _check(n)
+        key, low = n >> 16, n & 0xFFFF
+        c = self.containers.get(key)
+        if c is None:
+            self.containers[key] = array('H', [low])
+        elif isinstance(c, int):
+            self.containers[key] = c | (1 << low)
+        else:
+            i = bisect_left(c, low)
+            if i == len(c) or c[i] != low:
+                self.containers[key] = _container(c[:i] + array('H', [low]) +
+                                                  c[i:])
+
+    def discard(self, n):
+        key, low = n >> 16, n & 0xFFFF
+        c = self.containers.get(key)
+        if c is None:
+            return
+        if isinstance(c, int):
+            c = _container(bits=c & ~(1 << low))
+        else:
+            i = bisect_left(c, low)
+            if i == len(c) or c[i] != low:
+                return
+            c = _container(c[:i] + c[i + 1:])
+        if c is None:
+            del self.containers[key]
+        else:
+            self.containers[key] = c
+
+    def __contains__(self, n):
+        c = self.containers.get(n >> 16)
+        if c is None:
+            return False
+        low = n & 0xFFFF
+        if isinstance(c, int):
+            return bool(c >> low & 1)
+        i = bisect_left(c, low)
+        return i < len(c) and c[i] == low
+
+    def setbit(self, n, value=1):
+        '''Like Redis SETBIT, returns the old bit'''
+        old = int(n in self)
+        if value:
+            self.add(n)
+        else:
+            self.discard(n)
+        return old
+
+    def getbit(self, n):
+        return int(n in self)
+
+    # Lots of IDs
+    # -------------------------------------------------------------------------
+
+    def update(self, ids):
+        '''Adds any iterable of IDs, building each container once instead of
+        growing it one insert at a time'''
+        if not isinstance(ids, (list, tuple, array)):
+            ids = list(ids)
+        if not ids:
+            return
+        low, high = min(ids), max(ids)
+        _check(low)
+        _check(high)
+        if high - low < DENSE * len(ids):
+            self._update_dense(ids, low >> 16 << 16, high)
+        else:
+            self._update_sorted(sorted(set(ids)))
+
+    def _update_dense(self, ids, first, last):
+        # When the ids are close together, a bytearray with a byte for every
+        # possible id is no bigger than the list of ids itself (a Python int
+        # is 28 bytes). Setting the bytes runs in C, which is a lot quicker
+        # than sorting, then each 64K slice becomes a container.
+        flags = bytearray(last - first + 1)
+        if first:
+            ids = map(first.__rsub__, ids)
+        deque(map(flags.__setitem__, ids, repeat(1)), maxlen=0)
+        for start in range(0, len(flags), 65536):
+            chunk = flags[start:start + 65536]
+            count = chunk.count(1)
+            if not count:
+                continue
+            if count > ARRAY_MAX:
+                new = int(chunk.translate(TO_DIGITS)[::-1], 2)
+            else:
+                new = array('H', [m.start() for m in ONE_FLAG.finditer(chunk)])
+            key = (first + start) >> 16
+            old = self.containers.get(key)
+            self.containers[key] = new if old is None else _or(old, new)
+
+    def _update_sorted(self, ids):
+        i = 0
+        while i < len(ids):
+            key = ids[i] >> 16
+            base = key << 16
+            # where the next container starts:
+            j = bisect_left(ids, base + 65536, i)
+            new = _container(array('H', map(base.__rsub__, ids[i:j])))
+            old = self.containers.get(key)
+            self.containers[key] = new if old is None else _or(old, new)
+            i = j
+
+    def __iter__(self):
+        for key in sorted(self.containers):
+            c = self.containers[key]
+            base = key << 16
+            for low in (_from_bits(c) if isinstance(c, int) else c):
+                yield base | low
+
+    def __len__(self):
+        '''The cardinality, like Redis BITCOUNT'''
+        return sum(_count(c) for c in self.containers.values())
+
+    def __eq__(self, other):
+        return self.containers == other.containers
+
+    def __repr__(self):
+        return '<RoaringBitmap {:,} ids in {} containers>'.format(
+            len(self), len(self.containers))
+
+    # Set operations
+    # -------------------------------------------------------------------------
+
+    def __and__(self, other):
+        small, large = sorted((self.containers, other.containers), key=len)
+        out = {}
+        for key, c in small.items():
+            d = large.get(key)
+            if d is not None:
+                r = _and(c, d)
+                if r is not None:
+                    out[key] = r
+        return self._from(out)
+
+    def __or__(self, other):
+        out = dict(self.containers)
+        for key, c in other.containers.items():
+            d = out.get(key)
+            out[key] = c if d is None else _or(d, c)
+        return self._from(out)
+
+    def __sub__(self, other):
+        '''andnot: IDs in self that aren't in other'''
+        out = {}
+        for key, c in self.containers.items():
+            d = other.containers.get(key)
+            r = c if d is None else _andnot(c, d)
+            if r is not None:
+                out[key] = r
+        return self._from(out)
+
+    andnot = __sub__
+
+    # Saving
+    # -------------------------------------------------------------------------
+
+    def to_bytes(self):
+        parts = [HEADER.pack(MAGIC, len(self.containers))]
+        for key in sorted(self.containers):
+            c = self.containers[key]
+            if isinstance(c, int):
+                parts.append(CONTAINER.pack(key, 1, c.bit_count()))
+                parts.append(c.to_bytes(BITMAP_BYTES, 'little'))
+            else:
+                parts.append(CONTAINER.pack(key, 0, len(c)))
+                if sys.byteorder == 'big':
+                    c = array('H', c)
+                    c.byteswap()  # stored little endian
+                parts.append(c.tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, count = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('not a RoaringBitmap')
+        offset = HEADER.size
+        containers = {}
+        for _ in range(count):
+            key, kind, n = CONTAINER.unpack_from(data, offset)
+            offset += CONTAINER.size
+            if kind:
+                containers[key] = int.from_bytes(
+                    data[offset:offset + BITMAP_BYTES], 'little')
+                offset += BITMAP_BYTES
+            else:
+                c = array('H')
+                c.frombytes(data[offset:offset + 2 * n])
+                if sys.byteorder == 'big':
+                    c.byteswap()
+                containers[key] = c
+                offset += 2 * n
+        return cls._from(containers)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+def bitop(op, *bitmaps):
+    '''Like Redis BITOP: 'and', 'or' or 'andnot' (the first minus the rest)'''
+    if op == 'and':
+        # smallest first, so the running result shrinks as fast as possible
+        bitmaps = sorted(bitmaps, key=lambda b: len(b.containers))
+        result = bitmaps[0]
+        for b in bitmaps[1:]:
+            result = result & b
+        return result
+    if op == 'or':
+        # a container at a time, rather than a bitmap at a time, so each
+        # array is only sorted once
+        by_key = {}
+        for b in bitmaps:
+            for key, c in b.containers.items():
+                by_key.setdefault(key, []).append(c)
+        return RoaringBitmap._from({key: _or_many(cs)
+                                    for key, cs in by_key.items()})
+    if op == 'andnot':
+        result = bitmaps[0]
+        for b in bitmaps[1:]:
+            result = result - b
+        return result
+    raise ValueError('unknown op: {!r}'.format(op))
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import os
+    import random
+    import tempfile
+    import time
+
+    # the noSQL_datastores.py example:
+    days = ['2017-08-14', '2017-08-15', '2017-08-16']
+    aria, sansa, jon = 1022, 40569, 6603762
+    visits = {day: RoaringBitmap() for day in days}
+    visits[days[0]].setbit(aria, 1)
+    visits[days[0]].setbit(jon, 1)
+    visits[days[1]].setbit(jon, 1)
+    visits[days[1]].setbit(sansa, 1)
+    visits[days[2]].setbit(jon, 1)
+    print([len(visits[day]) for day in days])
+    print(visits[days[1]].getbit(aria))
+    everyday = bitop('and', *visits.values())
+    print(len(everyday), everyday.getbit(jon))
+    print(len(bitop('or', *visits.values())))
+    print('day 1 as a Redis bitmap: {:,} bytes, as a RoaringBitmap: {} bytes'
+          .format(jon // 8 + 1, len(visits[days[0]].to_bytes())))
+    print('-' * 75)
+
+    def flat(ids, users):
+        '''A Redis style bitmap, as one big Python int'''
+        flags = bytearray(users)
+        deque(map(flags.__setitem__, ids, repeat(1)), maxlen=0)
+        return int(flags.translate(TO_DIGITS)[::-1], 2)
+
+    def week(users, regulars, others, seed=1):
+        '''7 days: the same regulars every day, plus some random others'''
+        rnd = random.Random(seed)
+        crowd = rnd.sample(range(users), regulars)
+        days = [crowd + [rnd.randrange(users) for _ in range(others)]
+                for _ in range(7)]
+        print('{:,} users, {:,} visits a day'.format(users, regulars + others))
+
+        start = time.perf_counter()
+        bitmaps = [RoaringBitmap(ids) for ids in days]
+        built = time.perf_counter() - start
+        start = time.perf_counter()
+        counts = (len(bitop('and', *bitmaps)), len(bitop('or', *bitmaps)),
+                  len(bitmaps[6] - bitop('or', *bitmaps[:6])))
+        ops = time.perf_counter() - start
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'day0.rbm')
+            bitmaps[0].save(filename)
+            assert RoaringBitmap.load(filename) == bitmaps[0]
+            size = os.path.getsize(filename)
+        print('  RoaringBitmap  build {:5.2f}s  and/or/andnot {:5.2f}s  '
+              '{:>10,} bytes a day'.format(built, ops, size))
+
+        start = time.perf_counter()
+        ints = [flat(ids, users) for ids in days]
+        built = time.perf_counter() - start
+        start = time.perf_counter()
+        every, once = ints[0], 0
+        for n in ints:
+            every &= n
+            once |= n
+        before = 0
+        for n in ints[:6]:
+            before |= n
+        assert counts == (every.bit_count(), once.bit_count(),
+                          (ints[6] & ~before).bit_count())
+        ops = time.perf_counter() - start
+        print('  flat int       build {:5.2f}s  and/or/andnot {:5.2f}s  '
+              '{:>10,} bytes a day'.format(built, ops, users // 8))
+        print('  every day {:,}, at least once {:,}, new on day 7 {:,}'
+              .format(*counts))
+
+    week(30000000, 1000000, 1000000)
+    week(30000000, 20000, 80000)
+
+# [2, 2, 1]
+# 0
+# 1 1
+# 3
+# day 1 as a Redis bitmap: 825,471 bytes, as a RoaringBitmap: 26 bytes
+# ---------------------------------------------------------------------------
+# 30,000,000 users, 2,000,000 visits a day
+#   RoaringBitmap  build  3.86s  and/or/andnot  1.91s   3,753,374 bytes a day
+#   flat int       build  4.54s  and/or/andnot  0.03s   3,750,000 bytes a day
+#   every day 1,000,000, at least once 7,036,272, new on day 7 778,655
+# 30,000,000 users, 100,000 visits a day
+#   RoaringBitmap  build  0.50s  and/or/andnot  0.44s     202,868 bytes a day
+#   flat int       build  1.23s  and/or/andnot  0.03s   3,750,000 bytes a day
+#   every day 20,000, at least once 574,479, new on day 7 78,593
+
+# The build times are for all 7 days, and "and/or/andnot" is the three counts
+# at the bottom (and of 7 days, or of 7 days, day 7 minus the or of the
+# other 6).
+
+# With 2 million visits out of 30 million users, most containers have more
+# than 4096 ids, so they're bitmaps and a RoaringBitmap is the same size as a
+# flat one. The flat int is also much quicker at the set operations here: it's
+# one & or | over 3.75MB in C, where RoaringBitmap has to go through 458
+# containers in Python and turn bitmaps back into arrays when a result gets
+# small. If every day is busy, a plain bitmap (Redis, or a big int) is the
+# better choice.
+
+# On a quiet day, 100,000 visits, a RoaringBitmap is 18 times smaller, and
+# it gets better the sparser the ids are: the example above goes from 825KB
+# to 26 bytes. Set operations only touch containers that exist, so their cost
+# follows the number of ids, not the largest id.
+
+# For bulk loads, update() picks one of two ways. If the ids are close
+# together (less than 32 possible ids per real one) it sets a byte per id in a
+# bytearray, which runs in C, and cuts it into containers. Otherwise it sorts
+# them, which is the slow part: about 1 second per 2 million ids here.
@@ -0,0 +1,216 @@
+'''Indexed Keyword Search'''
+
+
+# generators.py has a search(keyword, filename) generator that reads the whole
+# file and tests every line with `keyword in line`. That's perfect for one
+# search, but if you search the same big log file over and over, each search
+# costs the full size of the file no matter how few lines match.
+
+# An inverted index turns that around. Read the file once and record, for
+# every word, the byte offset of each line it appears on:
+
+# {'mama': [1043, 1187, 1392, ...], 'killed': [1043, ...], ...}
+
+# A search then looks up the words, then seek()s straight to those offsets
+# and reads just the matching lines. The work is proportional to the number
+# of matches, not the size of the file.
+
+# The index is pickled along with the file's size and modification time. If
+# either changes, the index is stale and gets rebuilt the next time it's used.
+# By default it goes in a search_index directory under the system's temp
+# directory (named after a hash of the file's full path), not next to the
+# file, so indexing data/ doesn't leave .idx files lying around in it.
+
+# Note the difference in matching: the index works on whole words, ignoring
+# case. 'mama' finds 'Mama,' but 'Mam' doesn't. If a keyword has more than one
+# word ('just killed') the lines containing all of the words are checked for
+# the exact phrase.
+
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import time
+from array import array
+
+WORD = re.compile(r'\w+')
+
+
+def words(text):
+    return WORD.findall(text.lower())
+
+
+def default_index_filename(filename):
+    '''Where the index for filename goes if you don't say'''
+    path = os.path.abspath(filename)
+    name = hashlib.md5(path.encode()).hexdigest()
+    return os.path.join(tempfile.gettempdir(), 'search_index', name + '.idx')
+
+
+class SearchIndex():
+    '''An on disk word -> line offsets index for one text file'''
+
+    def __init__(self, filename, index_filename=None, encoding='utf-8'):
+        self.filename = filename
+        self.index_filename = (index_filename or
+                               default_index_filename(filename))
+        self.encoding = encoding
+        self._signature = None
+        self._index = None
+
+    def _file_signature(self):
+        stat = os.stat(self.filename)
+        return stat.st_size, stat.st_mtime_ns
+
+    def build(self):
+        '''Reads the file once and writes the index'''
+        index = {}
+        offset = 0
+        # Binary mode, so that the offsets are real byte positions we can
+        # seek() to. (Text mode tell() values are opaque cookies.)
+        with open(self.filename, 'rb') as f:
+            for line in f:
+                for word in set(words(line.decode(self.encoding, 'replace'))):
+                    if word not in index:
+                        # An array of unsigned 64 bit ints is much smaller
+                        # than a list of Python int objects:
+                        index[word] = array('Q')
+                    index[word].append(offset)
+                offset += len(line)
+        signature = self._file_signature()
+        os.makedirs(os.path.dirname(self.index_filename) or '.', exist_ok=True)
+        with open(self.index_filename, 'wb') as f:
+            pickle.dump((signature, index), f, pickle.HIGHEST_PROTOCOL)
+        self._signature, self._index = signature, index
+
+    def _load(self):
+        signature = self._file_signature()
+        if self._index is not None and self._signature == signature:
+            return self._index
+        try:
+            with open(self.index_filename, 'rb') as f:
+                saved, index = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            saved = None
+        if saved == signature:
+            self._signature, self._index = saved, index
+        else:
+            self.build()
+        return self._index
+
+    def offsets(self, *keywords, mode='and'):
+        '''Returns the sorted line offsets matching keywords'''
+        index = self._load()
+        terms = [word for keyword in keywords for word in words(keyword)]
+        if not terms:
+            return []
+        sets = [set(index.get(term, ())) for term in terms]
+        if mode == 'and':
+            # start with the rarest word, so the intersection stays small:
+            sets.sort(key=len)
+            found = sets[0].intersection(*sets[1:])
+        elif mode == 'or':
+            found = set().union(*sets)
+        else:
+            raise ValueError("mode must be 'and' or 'or'")
+        return sorted(found)
+
+    def search(self, *keywords, mode='and'):
+        '''Yields the lines (in file order) that match keywords'''
+        phrases = any(len(words(keyword)) > 1 for keyword in keywords)
+        test = all if mode == 'and' else any
+        with open(self.filename, 'rb') as f:
+            for offset in self.offsets(*keywords, mode=mode):
+                f.seek(offset)
+                line = f.readline().decode(self.encoding, 'replace')
+                # The index only knows about single words, so lines found
+                # for a phrase still need checking:
+                if phrases and not test(_matches(keyword, line)
+                                        for keyword in keywords):
+                    continue
+                yield line
+
+
+def _matches(keyword, line):
+    if len(words(keyword)) > 1:
+        return keyword.lower() in line.lower()
+    return set(words(keyword)) <= set(words(line))
+
+
+_indexes = {}
+
+
+def search(keyword, filename):
+    '''A drop in for generators.search() that uses a SearchIndex'''
+    if filename not in _indexes:
+        _indexes[filename] = SearchIndex(filename)
+    yield from _indexes[filename].search(keyword)
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    # The original from generators.py:
+    def scan(keyword, filename):
+        with open(filename, 'r') as f:
+            for line in f:
+                if keyword in line:
+                    yield line
+
+    with tempfile.TemporaryDirectory() as tmp:
+        lyrics = SearchIndex('data/bohemian_rhapsody_lyrics.txt',
+                             os.path.join(tmp, 'lyrics.idx'))
+        for line in lyrics.search('Mama'):
+            print(line, end='')
+            # Mama, just killed a man
+            # Mama, life had just begun
+            # Mama, ooo ...
+        print('-' * 50)
+        for line in lyrics.search('mama', 'man', mode='and'):
+            print(line, end='')
+            # Mama, just killed a man
+        print('-' * 50)
+        for line in lyrics.search('just killed'):
+            print(line, end='')
+            # Mama, just killed a man
+
+        print('-' * 75)
+        # A 100,000 line log file:
+        log = os.path.join(tmp, 'server.log')
+        levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING']
+        with open(log, 'w') as f:
+            for i in range(100000):
+                level = 'ERROR' if i % 5000 == 0 else levels[i % len(levels)]
+                f.write('2017-12-01 10:{:02}:{:02} {} request {} handled\n'
+                        .format(i // 60 % 60, i % 60, level, i))
+
+        index = SearchIndex(log)
+        start = time.perf_counter()
+        index.build()
+        print('build index:     {:.3f} sec'.format(time.perf_counter() - start))
+
+        start = time.perf_counter()
+        for _ in range(20):
+            found = sum(1 for line in scan('ERROR', log))
+        print('scan x 20:       {:.3f} sec, {} lines'.format(
+            time.perf_counter() - start, found))
+
+        start = time.perf_counter()
+        for _ in range(20):
+            found = sum(1 for line in index.search('ERROR'))
+        print('index x 20:      {:.3f} sec, {} lines'.format(
+            time.perf_counter() - start, found))
+
+        # appending to the file changes its size & mtime, so the index is
+        # rebuilt on the next search:
+        with open(log, 'a') as f:
+            f.write('2017-12-01 11:00:00 ERROR disk full\n')
+        print(list(index.search('disk', 'full')))
+        # ['2017-12-01 11:00:00 ERROR disk full\n']
+
+# build index:     0.600 sec
+# scan x 20:       0.450 sec, 20 lines
+# index x 20:      0.002 sec, 20 lines
@@ -123,6 +123,10 @@ with shelve.open('data/pizzas', writeback=True) as pizzas:
 # heavier memory usage. Regarding sync, it writes everything to the file, but
 # also clears the memory cache.
 
+# see also: cached_shelf.py, a shelf whose writeback cache has a size limit
+# and is written out a little at a time in the background, instead of all at
+# once by sync() or close().
+
 
 # Reminder
 # -----------------------------------------------------------------------------
@@ -0,0 +1,488 @@
+'''A sorted set (like a Redis zset) with rank and range-by-score queries'''
+
+
+# The Redis Sorted Sets example in noSQL_datastores.py keeps logins as
+# member: timestamp, with zadd, zrank, zscore and zrange. SortedSet does the
+# same in process, and stays quick at millions of members.
+
+# Redis uses a skip list plus a dict. A skip list in pure Python means a
+# Python object and a Python loop for every step, so this uses a B-tree of
+# arrays instead (the idea behind the sortedcontainers package):
+
+# - the (score, member) pairs are kept in a list of sorted lists, each about
+#   LOAD long. A list that grows past 2 * LOAD is split in two, and one that
+#   shrinks below LOAD / 2 is merged with its neighbour.
+# - maxes has the last pair of each list, so bisect on maxes finds the right
+#   list and bisect on that list finds the spot. Both bisects and the
+#   list.insert run in C, and an insert only moves about LOAD pointers.
+# - a Fenwick tree (binary indexed tree) over the list lengths turns a
+#   position in one list into a rank, and a rank into a list and a position,
+#   in O(log n). It's rebuilt when lists are split or merged, which is only
+#   every few hundred changes.
+# - a dict of member: score, for score() and to find the old pair on update.
+
+# Like Redis, pairs with the same score are ordered by member, so members
+# have to be comparable with each other (all str or all bytes, say).
+
+# range_by_score() and range_by_rank() are generators: they walk the lists in
+# place and never build the whole result. Like iterating over a dict, the set
+# can't be changed while one is running (you'll get a RuntimeError).
+
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from operator import itemgetter
+
+LOAD = 1000
+SCORE = itemgetter(0)
+
+
+class SortedSet():
+
+    def __init__(self, mapping=None):
+        self._scores = {}   # member: score
+        self._lists = []    # sorted lists of (score, member)
+        self._maxes = []    # the last pair in each list
+        self._tree = [0]    # Fenwick tree of the list lengths (1 based)
+        self._version = 0   # changes on every write, for the iterators
+        if mapping:
+            self.update(mapping)
+
+    # The Fenwick tree
+    # -------------------------------------------------------------------------
+
+    def _build(self):
+        tree = [0] + [len(l) for l in self._lists]
+        for i in range(1, len(tree)):
+            j = i + (i & -i)
+            if j < len(tree):
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def _grow(self, k, delta):
+        '''List k got delta longer'''
+        tree = self._tree
+        i = k + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _before(self, k):
+        '''How many pairs are in the lists before list k'''
+        tree = self._tree
+        total = 0
+        while k:
+            total += tree[k]
+            k -= k & -k
+        return total
+
+    def _find(self, rank):
+        '''rank -> (list, position in that list)'''
+        tree = self._tree
+        k = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            j = k + step
+            if j < len(tree) and tree[j] <= rank:
+                rank -= tree[j]
+                k = j
+            step >>= 1
+        return k, rank
+
+    # Adding and removing pairs
+    # -------------------------------------------------------------------------
+
+    def _insert(self, pair):
+        lists, maxes = self._lists, self._maxes
+        if not lists:
+            lists.append([pair])
+            maxes.append(pair)
+            self._build()
+            return
+        k = bisect_left(maxes, pair)
+        if k == len(maxes):
+            k -= 1
+            lists[k].append(pair)
+            maxes[k] = pair
+        else:
+            insort(lists[k], pair)
+        self._grow(k, 1)
+        if len(lists[k]) > 2 * LOAD:
+            self._split(k)
+
+    def _split(self, k):
+        lists, maxes = self._lists, self._maxes
+        half = lists[k][LOAD:]
+        del lists[k][LOAD:]
+        maxes[k] = lists[k][-1]
+        lists.insert(k + 1, half)
+        maxes.insert(k + 1, half[-1])
+        self._build()
+
+    def _delete(self, pair):
+        lists, maxes = self._lists, self._maxes
+        k = bisect_left(maxes, pair)
+        pairs = lists[k]
+        i = bisect_left(pairs, pair)
+        del pairs[i]
+        self._grow(k, -1)
+        if i == len(pairs) and pairs:
+            maxes[k] = pairs[-1]
+        self._fix(k)
+
+    def _fix(self, k):
+        '''Drops list k if it's empty, or merges it if it's too short'''
+        lists, maxes = self._lists, self._maxes
+        if not 0 <= k < len(lists) or len(lists[k]) >= LOAD // 2:
+            return
+        if not lists[k]:
+            del lists[k]
+            del maxes[k]
+        elif len(lists) > 1:
+            if k == len(lists) - 1:
+                k -= 1  # merge with the one before
+            lists[k].extend(lists[k + 1])
+            maxes[k] = lists[k][-1]
+            del lists[k + 1]
+            del maxes[k + 1]
+            if len(lists[k]) > 2 * LOAD:
+                self._split(k)
+                return
+        else:
+            return
+        self._build()
+
+    def _remove_ranks(self, start, stop):
+        '''Removes ranks start to stop - 1 and returns them as pairs'''
+        if start >= stop:
+            return []
+        lists, maxes = self._lists, self._maxes
+        k, i = self._find(start)
+        removed = []
+        left = stop - start
+        while left:
+            pairs = lists[k]
+            take = min(left, len(pairs) - i)
+            removed.extend(pairs[i:i + take])
+            del pairs[i:i + take]
+            left -= take
+            if pairs:
+                maxes[k] = pairs[-1]
+                k += 1
+                i = 0
+            else:
+                del lists[k]
+                del maxes[k]
+        for score, member in removed:
+            del self._scores[member]
+        self._version += 1
+        self._build()
+        # only the two lists at the ends of the range can be too short now
+        self._fix(k)
+        self._fix(k - 1)
+        return removed
+
+    # The set
+    # -------------------------------------------------------------------------
+
+    def add(self, member, score):
+        '''Like ZADD: adds member, or moves it to its new score. Returns True
+        if it's a new member'''
+        old = self._scores.get(member)
+        if old is not None:
+            if old == score:
+                return False
+            self._delete((old, member))
+        self._scores[member] = score
+        self._insert((score, member))
+        self._version += 1
+        return old is None
+
+    def update(self, mapping):
+        '''Adds a dict (or iterable of (member, score) pairs) in one go'''
+        items = mapping.items() if hasattr(mapping, 'items') else mapping
+        if self._scores:
+            for member, score in items:
+                self.add(member, score)
+            return
+        # starting empty: sort once and cut the result into lists
+        self._scores = dict(items)
+        pairs = sorted((score, member) for member, score in self._scores.items())
+        self._lists = [pairs[i:i + LOAD] for i in range(0, len(pairs), LOAD)]
+        self._maxes = [pairs[-1] for pairs in self._lists]
+        self._version += 1
+        self._build()
+
+    def incr(self, member, amount=1):
+        '''Like ZINCRBY, returns the new score'''
+        score = self._scores.get(member, 0) + amount
+        self.add(member, score)
+        return score
+
+    def remove(self, member):
+        '''Like ZREM, returns True if member was there'''
+        score = self._scores.pop(member, None)
+        if score is None:
+            return False
+        self._delete((score, member))
+        self._version += 1
+        return True
+
+    def score(self, member):
+        '''Like ZSCORE, None if member isn't in the set'''
+        return self._scores.get(member)
+
+    def rank(self, member, reverse=False):
+        '''Like ZRANK (or ZREVRANK with reverse=True), None if not found'''
+        score = self._scores.get(member)
+        if score is None:
+            return None
+        pair = (score, member)
+        k = bisect_left(self._maxes, pair)
+        rank = self._before(k) + bisect_left(self._lists[k], pair)
+        return len(self) - 1 - rank if reverse else rank
+
+    def __len__(self):
+        return len(self._scores)
+
+    def __contains__(self, member):
+        return member in self._scores
+
+    def __iter__(self):
+        return self.range_by_rank(0, -1)
+
+    def __repr__(self):
+        return '<SortedSet with {:,} members>'.format(len(self))
+
+    # Ranges
+    # -------------------------------------------------------------------------
+
+    def _score_rank(self, score, right=False):
+        '''The rank of the first pair with a score >= score (or > score)'''
+        search = bisect_right if right else bisect_left
+        k = search(self._maxes, score, key=SCORE)
+        if k == len(self._maxes):
+            return len(self)
+        return self._before(k) + search(self._lists[k], score, key=SCORE)
+
+    def _walk(self, start, stop, reverse):
+        '''Yields the pairs from rank start to stop - 1, without copying'''
+        if start >= stop:
+            return
+        version = self._version
+        lists = self._lists
+        if reverse:
+            k, i = self._find(stop - 1)
+            left = stop - start
+            while left:
+                pairs = lists[k]
+                for j in range(i, max(i - left, -1), -1):
+                    if self._version != version:
+                        raise RuntimeError('SortedSet changed during iteration')
+                    yield pairs[j]
+                left -= min(left, i + 1)
+                k -= 1
+                i = len(lists[k]) - 1 if left else 0
+        else:
+            k, i = self._find(start)
+            left = stop - start
+            while left:
+                pairs = lists[k]
+                take = min(left, len(pairs) - i)
+                for pair in islice(pairs, i, i + take):
+                    if self._version != version:
+                        raise RuntimeError('SortedSet changed during iteration')
+                    yield pair
+                left -= take
+                k += 1
+                i = 0
+
+    def _ranks(self, start, stop):
+        '''Redis style start/stop (stop included, negatives from the end) ->
+        a Python range start:stop'''
+        n = len(self)
+        if start < 0:
+            start = max(n + start, 0)
+        if stop < 0:
+            stop += n
+        return start, min(stop + 1, n)
+
+    def range_by_rank(self, start=0, stop=-1, reverse=False, withscores=False):
+        '''Like ZRANGE (ZREVRANGE with reverse=True): stop is included, and
+        -1 is the last one. Yields members or (member, score)'''
+        start, stop = self._ranks(start, stop)
+        if reverse:
+            # ranks count from the top
+            start, stop = len(self) - stop, len(self) - start
+        for score, member in self._walk(start, stop, reverse):
+            yield (member, score) if withscores else member
+
+    def range_by_score(self, low=float('-inf'), high=float('inf'),
+                       reverse=False, withscores=False):
+        '''Like ZRANGEBYSCORE: the members with low <= score <= high, lowest
+        first (highest first with reverse=True)'''
+        start = self._score_rank(low)
+        stop = self._score_rank(high, right=True)
+        for score, member in self._walk(start, stop, reverse):
+            yield (member, score) if withscores else member
+
+    def count(self, low=float('-inf'), high=float('inf')):
+        '''Like ZCOUNT, O(log n) without walking the range'''
+        return max(self._score_rank(high, right=True) - self._score_rank(low), 0)
+
+    def pop_min(self, count=1):
+        '''Like ZPOPMIN: removes and returns up to count (member, score)'''
+        pairs = self._remove_ranks(0, min(count, len(self)))
+        return [(member, score) for score, member in pairs]
+
+    def pop_max(self, count=1):
+        '''Like ZPOPMAX, highest first'''
+        pairs = self._remove_ranks(max(len(self) - count, 0), len(self))
+        return [(member, score) for score, member in reversed(pairs)]
+
+    def remove_range_by_score(self, low=float('-inf'), high=float('inf')):
+        '''Like ZREMRANGEBYSCORE, returns how many were removed'''
+        start = self._score_rank(low)
+        stop = self._score_rank(high, right=True)
+        return len(self._remove_ranks(start, stop))
+
+    def remove_range_by_rank(self, start, stop):
+        '''Like ZREMRANGEBYRANK (stop included)'''
+        return len(self._remove_ranks(*self._ranks(start, stop)))
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    # the noSQL_datastores.py example:
+    now = 1511224444.845123
+    logins = SortedSet()
+    logins.add('sansa', now)
+    logins.add('jon', now + (5 * 60))
+    logins.add('bran', now + (2 * 60 * 60))
+    logins.add('aria', now + (24 * 60 * 60))
+    print(logins.rank('bran'))
+    print(logins.score('bran'))
+    print(list(logins.range_by_rank(0, -1)))
+    for i in logins.range_by_rank(0, -1, withscores=True):
+        print(i)
+    # who logged in during the first hour?
+    print(list(logins.range_by_score(now, now + 60 * 60)))
+    print(logins.pop_max())
+    print('-' * 75)
+
+    # A day of logins from a million users, one every 10ms or so. Each login
+    # moves that user to the new time, and every 1000 logins we ask how many
+    # users logged in during the last hour and drop anyone who hasn't logged
+    # in for a day.
+    users = 1000000
+    rnd = random.Random(1)
+    start = time.perf_counter()
+    zset = SortedSet({'user{}'.format(i): now - rnd.random() * 86400
+                      for i in range(users)})
+    elapsed = time.perf_counter() - start
+    print('loaded {:,} members in {:.2f}s'.format(len(zset), elapsed))
+
+    def sliding_window(zset, logins, now):
+        t = now
+        hourly = []
+        start = time.perf_counter()
+        for n in range(logins):
+            t += rnd.random() * 0.02
+            zset.add('user{}'.format(rnd.randrange(users)), t)
+            if n % 1000 == 0:
+                hourly.append(zset.count(t - 3600, t))
+                zset.remove_range_by_score(high=t - 86400)
+        return time.perf_counter() - start, hourly, t
+
+    ops = 200000
+    elapsed, hourly, end = sliding_window(zset, ops, now)
+    print('{:,} logins + {:,} window queries: {:,.0f} logins/sec'.format(
+        ops, len(hourly), ops / elapsed))
+    print('active in the last hour: {:,} -> {:,}'.format(hourly[0], hourly[-1]))
+
+    start = time.perf_counter()
+    ranks = [zset.rank('user{}'.format(rnd.randrange(users)))
+             for _ in range(100000)]
+    elapsed = time.perf_counter() - start
+    print('rank():           {:>9,.0f} per second'.format(100000 / elapsed))
+
+    start = time.perf_counter()
+    newest = list(zset.range_by_score(end - 60, end, reverse=True))
+    elapsed = time.perf_counter() - start
+    print('last minute:      {:>9,} members in {:.4f}s'.format(
+        len(newest), elapsed))
+
+    start = time.perf_counter()
+    zset.pop_min(100000)
+    elapsed = time.perf_counter() - start
+    print('pop_min(100,000): {:.3f}s, oldest left is {:.0f}s old'.format(
+        elapsed, end - zset.score(next(iter(zset)))))
+
+    # the obvious way: one big sorted list of (score, member), with insort
+    # and a delete for every update, next to the same dict
+    class FlatZSet():
+        def __init__(self, mapping):
+            self.scores = dict(mapping)
+            self.pairs = sorted((s, m) for m, s in self.scores.items())
+
+        def add(self, member, score):
+            old = self.scores.get(member)
+            if old is not None:
+                del self.pairs[bisect_left(self.pairs, (old, member))]
+            self.scores[member] = score
+            insort(self.pairs, (score, member))
+
+        def count(self, low, high):
+            return (bisect_right(self.pairs, high, key=SCORE) -
+                    bisect_left(self.pairs, low, key=SCORE))
+
+        def remove_range_by_score(self, high):
+            stop = bisect_right(self.pairs, high, key=SCORE)
+            for score, member in self.pairs[:stop]:
+                del self.scores[member]
+            del self.pairs[:stop]
+
+    rnd = random.Random(1)
+    flat = FlatZSet({'user{}'.format(i): now - rnd.random() * 86400
+                     for i in range(users)})
+    # (a tenth of the logins, it's slow)
+    elapsed, flat_hourly, _ = sliding_window(flat, ops // 10, now)
+    assert flat_hourly == hourly[:len(flat_hourly)]
+    print('one flat list:    {:>9,.0f} logins/sec'.format(ops // 10 / elapsed))
+
+# 2
+# 1511231644.845123
+# ['sansa', 'jon', 'bran', 'aria']
+# ('sansa', 1511224444.845123)
+# ('jon', 1511224744.845123)
+# ('bran', 1511231644.845123)
+# ('aria', 1511310844.845123)
+# ['sansa', 'jon']
+# [('aria', 1511310844.845123)]
+# ---------------------------------------------------------------------------
+# loaded 1,000,000 members in 2.73s
+# 200,000 logins + 200 window queries: 93,239 logins/sec
+# active in the last hour: 41,477 -> 195,883
+# rank():             146,938 per second
+# last minute:          5,991 members in 0.0028s
+# pop_min(100,000): 0.390s, oldest left is 75869s old
+# one flat list:        4,380 logins/sec
+
+# The logins/sec include making up the user name and time for each login.
+# Every login is a delete and an insert (the user moves to the new time), so
+# that's about 190,000 updates a second at a million members. The window
+# queries are count(), which is two bisects and two Fenwick lookups, so they
+# cost about the same at any size. remove_range_by_score() drops the expired
+# logins in slices, a list at a time.
+
+# range_by_score() only walks what it returns: the 5,991 logins from the last
+# minute took 3ms out of a million members.
+
+# One flat sorted list does the same thing with the same bisects, but every
+# insert and delete moves on average half a million pointers. At this size
+# that's 20 times slower, and it gets worse as the set grows, where SortedSet
+# only moves about LOAD pointers per change.
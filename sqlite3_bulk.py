@@ -0,0 +1,295 @@
+'''sqlite3 Bulk Loading: chunked transactions, PRAGMAs and late indexes'''
+
+
+# The sqlite sections of relational_databases.py add contacts with one
+# conn.execute() per row. That's fine for two rows. For millions it's slow for
+# a few reasons:
+
+# - Outside of a transaction, every INSERT is its own transaction, and every
+#   commit waits for the disk (an fsync). That's a few hundred rows a second,
+#   so 10 million rows takes hours.
+# - A single transaction for all of it is fast, but it holds every change in
+#   the journal until the end.
+# - Every index on the table is updated row by row, in random order, as the
+#   rows go in.
+# - execute() in a Python loop pays for a Python call per row.
+
+# load() streams rows from any iterable (a generator, a csv.reader, another
+# cursor) into an existing table:
+
+# 1. Rows are taken chunk_size at a time and inserted with executemany(), one
+#    transaction per chunk. Memory stays at one chunk, and there is one
+#    commit per chunk instead of one per row.
+# 2. While loading, the PRAGMAs in BULK_PRAGMAS are applied:
+#    synchronous=OFF   - don't wait for the disk on commit.
+#    journal_mode=MEMORY - keep the rollback journal in memory, not a file.
+#    cache_size        - a bigger page cache (negative numbers are KiB).
+#    temp_store=MEMORY - temporary data (index sorting) in memory.
+#    The old values are put back when the load is done.
+# 3. The table's indexes are dropped before the load and created again after,
+#    along with any new ones you pass in. Building an index from a full
+#    table is one sort, which is much faster than updating it row by row.
+#    UNIQUE indexes stay, since they're constraints as well as indexes.
+# 4. It returns LoadStats, with rows, seconds and rows per second, and calls
+#    progress(rows, seconds) after every chunk if you give it one.
+
+# The catch: with synchronous=OFF and the journal in memory, if the program or
+# the machine crashes part way through the load, the database file can be
+# left corrupt (not just missing the last chunk). So load into a new file, or
+# one you can rebuild, or pass pragmas={} to keep your usual settings.
+# Because of the chunks, a failed load (an exception) rolls back the current
+# chunk only; the chunks before it stay committed.
+
+import csv
+import sqlite3
+import time
+from collections import namedtuple
+from itertools import islice
+
+BULK_PRAGMAS = {'synchronous': 'OFF', 'journal_mode': 'MEMORY',
+                'cache_size': -131072, 'temp_store': 'MEMORY'}
+
+LoadStats = namedtuple('LoadStats', 'rows seconds rows_per_second '
+                                    'index_seconds')
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _pragmas(conn, pragmas):
+    for name, value in pragmas.items():
+        conn.execute('PRAGMA {}={}'.format(name, value))
+
+
+def _drop_indexes(conn, table):
+    '''Drops the table's plain indexes, returns the SQL to create them again'''
+    # index_list's origin is 'c' for a CREATE INDEX; the automatic ones (for
+    # PRIMARY KEY and UNIQUE columns) are part of the table and can't be
+    # dropped. UNIQUE indexes are kept too: without them duplicate rows would
+    # go in, and the index couldn't be built again afterwards.
+    names = [name for seq, name, unique, origin, partial in
+             conn.execute('PRAGMA index_list({})'.format(_quote(table)))
+             if origin == 'c' and not unique]
+    rebuild = []
+    for name in names:
+        sql, = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index' "
+                            "AND name = ?", (name,)).fetchone()
+        conn.execute('DROP INDEX {}'.format(_quote(name)))
+        rebuild.append(sql)
+    return rebuild
+
+
+def _create_indexes(conn, rebuild):
+    '''Runs every CREATE INDEX it can, then raises the first error, if any'''
+    errors = []
+    conn.execute('BEGIN')
+    try:
+        for create in rebuild:
+            try:
+                conn.execute(create)
+            except sqlite3.Error as e:
+                errors.append(e)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    if errors:
+        raise errors[0]
+
+
+def load(conn, table, rows, columns=None, chunk_size=50000, indexes=(),
+         pragmas=BULK_PRAGMAS, progress=None):
+    '''Inserts rows (any iterable of sequences) into table.
+
+    columns names the columns the values are for (all of them, in order, if
+    None). indexes is a list of CREATE INDEX statements to run after the load,
+    as well as the ones the table already had.
+    '''
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return LoadStats(0, 0.0, 0.0, 0.0)
+    if columns:
+        names = ' ({})'.format(', '.join(_quote(c) for c in columns))
+    else:
+        names = ''
+    sql = 'INSERT INTO {}{} VALUES ({})'.format(
+        _quote(table), names, ', '.join('?' * len(first)))
+
+    isolation_level = conn.isolation_level
+    if conn.in_transaction:
+        conn.commit()  # the PRAGMAs can't change inside a transaction
+    old = {name: conn.execute('PRAGMA {}'.format(name)).fetchone()[0]
+           for name in pragmas}
+    # We'll BEGIN and COMMIT ourselves:
+    conn.isolation_level = None
+    try:
+        _pragmas(conn, pragmas)
+        conn.execute('BEGIN')
+        rebuild = _drop_indexes(conn, table) + list(indexes)
+        conn.execute('COMMIT')
+        try:
+            count = 0
+            start = time.perf_counter()
+            chunk = [first]
+            chunk.extend(islice(rows, chunk_size - 1))
+            while chunk:
+                conn.execute('BEGIN')
+                conn.executemany(sql, chunk)
+                conn.execute('COMMIT')
+                count += len(chunk)
+                if progress:
+                    progress(count, time.perf_counter() - start)
+                chunk = list(islice(rows, chunk_size))
+            seconds = time.perf_counter() - start
+        finally:
+            # Put the indexes back even if the load failed part way
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            started = time.perf_counter()
+            _create_indexes(conn, rebuild)
+            index_seconds = time.perf_counter() - started
+    finally:
+        try:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            _pragmas(conn, old)
+        finally:
+            conn.isolation_level = isolation_level
+    return LoadStats(count, seconds, count / seconds if seconds else 0.0,
+                     index_seconds)
+
+
+def load_csv(conn, table, filename, header=True, **kwargs):
+    '''Like load(), from a CSV file. With header=True the first line has the
+    column names. Values arrive as text; sqlite converts them to the
+    column's type (its "affinity"), so '4362' goes into an INTEGER column as
+    4362.'''
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        if header:
+            kwargs.setdefault('columns', next(reader))
+        return load(conn, table, reader, **kwargs)
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+def contacts(n):
+    '''n made up (name, phone, email) rows'''
+    for i in range(n):
+        name = 'contact{}'.format(i)
+        yield name, 1000 + i % 9000, name + '@email.com'
+
+
+def create_contacts(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS contacts
+                    (name TEXT, phone INTEGER, email TEXT)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS contacts_name ON contacts(name)')
+    conn.commit()
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import tempfile
+
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The way relational_databases.py does it, one execute() and one
+        # commit per row, with the index in place. Only 2,000 rows of it:
+        conn = sqlite3.connect(os.path.join(tmp, 'slow.sqlite'))
+        create_contacts(conn)
+        start = time.perf_counter()
+        for row in contacts(2000):
+            conn.execute('INSERT INTO contacts VALUES(?, ?, ?)', row)
+            conn.commit()
+        elapsed = time.perf_counter() - start
+        conn.close()
+        print('execute() + commit() per row: {:>10,.0f} rows/sec, {:,.1f} '
+              'hours for {:,}'.format(2000 / elapsed, rows / 2000 * elapsed /
+                                      3600, rows))
+
+        # executemany() in one transaction, with default PRAGMAs and the
+        # index in place. 1 million rows of it:
+        conn = sqlite3.connect(os.path.join(tmp, 'many.sqlite'))
+        create_contacts(conn)
+        start = time.perf_counter()
+        conn.executemany('INSERT INTO contacts VALUES(?, ?, ?)',
+                         contacts(1000000))
+        conn.commit()
+        elapsed = time.perf_counter() - start
+        conn.close()
+        print('one executemany():            {:>10,.0f} rows/sec'.format(
+            1000000 / elapsed))
+
+        # load():
+        filename = os.path.join(tmp, 'bulk.sqlite')
+        conn = sqlite3.connect(filename)
+        create_contacts(conn)
+
+        def report(count, seconds):
+            if count % 2000000 == 0:
+                print('  {:>10,} rows {:>6.1f}s'.format(count, seconds))
+
+        stats = load(conn, 'contacts', contacts(rows), progress=report,
+                     indexes=['CREATE INDEX contacts_email ON contacts(email)'],
+                     chunk_size=100000)
+        print('load():                       {:>10,.0f} rows/sec, {:,.0f} '
+              'with the indexes'.format(stats.rows_per_second, stats.rows /
+                                        (stats.seconds + stats.index_seconds)))
+        print(stats)
+        print(conn.execute('SELECT count(*) FROM contacts').fetchone())
+        print(conn.execute('SELECT * FROM contacts WHERE email = ?',
+                           ('contact1234567@email.com',)).fetchone())
+        print(conn.execute('PRAGMA synchronous').fetchone(),
+              conn.execute('PRAGMA journal_mode').fetchone())
+        print('{:,} bytes'.format(os.path.getsize(filename)))
+        conn.close()
+
+        # And from a CSV file:
+        filename = os.path.join(tmp, 'contacts.csv')
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['name', 'phone', 'email'])
+            writer.writerows(contacts(1000000))
+        conn = sqlite3.connect(os.path.join(tmp, 'csv.sqlite'))
+        create_contacts(conn)
+        stats = load_csv(conn, 'contacts', filename)
+        print('load_csv():                   {:>10,.0f} rows/sec'.format(
+            stats.rows_per_second))
+        print(conn.execute('SELECT * FROM contacts LIMIT 1').fetchone())
+        conn.close()
+
+# execute() + commit() per row:      2,059 rows/sec, 1.3 hours for 10,000,000
+# one executemany():               237,040 rows/sec
+#    2,000,000 rows    4.5s
+#    4,000,000 rows    9.3s
+#    6,000,000 rows   15.3s
+#    8,000,000 rows   21.0s
+#   10,000,000 rows   25.8s
+# load():                          388,077 rows/sec, 264,745 with the indexes
+# LoadStats(rows=10000000, seconds=25.76810816599982, rows_per_second=388076.60754834436, index_seconds=12.004064989999733)
+# (10000000,)
+# ('contact1234567', 2567, 'contact1234567@email.com')
+# (2,) ('delete',)
+# 1,074,024,448 bytes
+# load_csv():                      364,803 rows/sec
+# ('contact0', 1000, 'contact0@email.com')
+
+# 10 million contacts in 26 seconds, plus 12 seconds to build the two
+# indexes. Committing every row would take over an hour, and that's on a fast
+# disk; on a laptop with a slower fsync it's many hours.
+
+# The executemany() line only loads 1 million rows, into an empty table, so
+# its index still fits in the page cache. At 10 million rows the name index
+# no longer fits, and updating it in random order gets slower as the table
+# grows. load() builds it once at the end instead, with a single sort.
+
+# Most of what's left is Python: making the 10 million tuples in contacts()
+# and handing them to sqlite one at a time. A bigger chunk_size makes little
+# difference beyond about 10,000 rows, since a commit with synchronous=OFF is
+# cheap. The CSV load is a bit slower because csv.reader has to parse every
+# line, and sqlite has to convert the phone numbers from text.
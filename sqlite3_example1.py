@@ -4,7 +4,8 @@
 # This example contains several useful techniques for storing and retrieving
 # datetime objects as well as displaying UTC time as local time when needed.
 # There is also an example of performing a rollback, should an exception occur
-# see lines 57-63.
+# see lines 57-63. For a version that groups many updates into one commit,
+# see sqlite3_ledger.py.
 
 import sqlite3
 import datetime
@@ -3,28 +3,98 @@
 
 # This is a modified version of sqlite3_example1.py. In continuing to explore
 # ways of storing and retrieving both UTC and local time, this example includes
-# a column in the history table that contains a pickled datetime object which
-# is the local time zone (PDT). This pickled object can then be unpickled and
-# displayed later. This whole thing is probably overkill for most situations
-# but may prove useful as an example sometime.
+# a column in the history table that records the local time zone (PDT) so that
+# it can be displayed later. This whole thing is probably overkill for most
+# situations but may prove useful as an example sometime.
+
+# The first version of this example pickled the tzinfo object into every
+# history row. That works, but every row carries its own ~90 byte blob and
+# reading the rows back means a pickle.loads() per row. There are only ever a
+# handful of distinct time zones though, so instead they're stored once in a
+# small timezones table and each history row just stores the integer id.
+
+# The conversion is done with sqlite3's adapter/converter hooks:
+# register_adapter(type, func) - func turns a Python object into something
+#                                sqlite can store (here: tzinfo -> id).
+# register_converter(name, func) - func turns the stored bytes back into a
+#                                  Python object for columns declared (or
+#                                  aliased) with that type name.
 
 import sqlite3
 import datetime
 import pytz
-import pickle  # <-- added
+import pickle  # <-- only used to migrate rows written by the old version
 
 db = sqlite3.connect('data/accounts2.sqlite')
 db.execute('''CREATE TABLE IF NOT EXISTS accounts
               (name TEXT PRIMARY KEY NOT NULL,
               balance INTEGER NOT NULL)''')
+# the timezone dictionary table, the UNIQUE constraint gives us an index to
+# look zones up by name and offset:
+db.execute('''CREATE TABLE IF NOT EXISTS timezones
+              (id INTEGER PRIMARY KEY,
+              name TEXT NOT NULL,
+              offset INTEGER NOT NULL,
+              UNIQUE (name, offset))''')
 # added timezone column to the history table:
 db.execute('''CREATE TABLE IF NOT EXISTS history
               (time TIMESTAMP NOT NULL,
               account TEXT NOT NULL,
               amount INTEGER NOT NULL,
-              timezone INTEGER NOT NULL,
+              timezone INTEGER NOT NULL REFERENCES timezones(id),
               PRIMARY KEY (time, account))''')
 
+_timezone_ids = {}  # (name, offset) -> id
+_timezones = {}     # id -> datetime.timezone
+
+
+def _timezone_key(timezone):
+    offset = timezone.utcoffset(None)
+    return timezone.tzname(None), int(offset.total_seconds())
+
+
+def adapt_timezone(timezone):
+    '''Returns the id for timezone, adding it to the timezones table if new'''
+    key = _timezone_key(timezone)
+    if key not in _timezone_ids:
+        db.execute('INSERT OR IGNORE INTO timezones (name, offset) VALUES (?, ?)',
+                   key)
+        row = db.execute('SELECT id FROM timezones WHERE name = ? AND offset = ?',
+                         key).fetchone()
+        _timezone_ids[key] = row[0]
+    return _timezone_ids[key]
+
+
+def convert_timezone(value):
+    '''Returns the datetime.timezone for a stored id (value is bytes)'''
+    tz_id = int(value)
+    if tz_id not in _timezones:
+        name, offset = db.execute('SELECT name, offset FROM timezones '
+                                  'WHERE id = ?', (tz_id,)).fetchone()
+        _timezones[tz_id] = datetime.timezone(
+            datetime.timedelta(seconds=offset), name)
+    return _timezones[tz_id]
+
+
+# astimezone() gives us datetime.timezone objects, so that's the type to adapt:
+sqlite3.register_adapter(datetime.timezone, adapt_timezone)
+sqlite3.register_converter('tzid', convert_timezone)
+
+
+def migrate_pickled_timezones():
+    '''Replaces pickled timezones from the old version of this example'''
+    blobs = db.execute("SELECT DISTINCT timezone FROM history "
+                       "WHERE typeof(timezone) = 'blob'").fetchall()
+    # Only one pickle.loads per distinct zone, not per row:
+    for (blob,) in blobs:
+        db.execute('UPDATE history SET timezone = ? WHERE timezone = ?',
+                   (pickle.loads(blob), blob))
+    db.commit()
+    return len(blobs)
+
+
+migrate_pickled_timezones()
+
 
 class Account():
 
@@ -55,15 +125,16 @@ class Account():
     def _save_update(self, amount):
         new_balance = self._balance + amount
         time, timezone = Account._current_time()  # <-- unpack the tuple
-        pickled_timezone = pickle.dumps(timezone)  # <-- pickle the time zone
         try:
             db.execute("UPDATE accounts SET balance = ? WHERE name = ?",
                        (new_balance, self.name))
-            # add the pickled_timezone to the update:
+            # add the timezone to the update, the adapter stores its id:
             db.execute("INSERT INTO history VALUES(?, ?, ?, ?)",
-                       (time, self.name, amount, pickled_timezone))
+                       (time, self.name, amount, timezone))
         except sqlite3.Error:
             db.rollback()
+            # a new timezone row may have been rolled back too:
+            _timezone_ids.clear()
         else:
             db.commit()
             self._balance = new_balance
@@ -106,17 +177,26 @@ if __name__ == '__main__':
 print('-' * 75)
 
 
-# Get the pickled timezone
+# Get the timezone
 # -----------------------------------------------------------------------------
+# PARSE_DECLTYPES converts the time column (declared TIMESTAMP). The timezone
+# column is declared INTEGER, and we don't want a converter on every integer
+# column, so PARSE_COLNAMES lets us ask for the converter in the query instead:
+# 'column AS "name [converter]"'.
 
-db = sqlite3.connect('data/accounts2.sqlite', detect_types=sqlite3.PARSE_DECLTYPES)
+db = sqlite3.connect('data/accounts2.sqlite',
+                     detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
 
-for row in db.execute("SELECT * FROM history"):
+for row in db.execute('SELECT time, account, amount, '
+                      'timezone AS "timezone [tzid]" FROM history'):
     utc_time = row[0]
-    pickled_timezone = row[3]
-    timezone = pickle.loads(pickled_timezone)
+    timezone = row[3]
     local_time = pytz.utc.localize(utc_time).astimezone(timezone)
     print("{}\t{}\t{}".format(utc_time, local_time, local_time.tzinfo))
 
 # 2017-12-01 18:45:25.093112      2017-12-01 10:45:25.093112-08:00        PST
 # 2017-12-01 18:45:25.095254      2017-12-01 10:45:25.095254-08:00        PST
+
+# Since every row now stores a small integer instead of a pickle, you can
+# run VACUUM once after migrating to give the freed space back to the disk:
+# db.execute('VACUUM')
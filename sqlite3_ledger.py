@@ -0,0 +1,267 @@
+'''sqlite3 Ledger: group commit, WAL and executemany'''
+
+
+# This is a follow up to sqlite3_example1.py. In that example, every deposit
+# or withdrawal runs two statements and then calls db.commit(). A commit is
+# the point where sqlite has to make sure the data has actually reached the
+# disk (an fsync), and that is by far the slowest part of the whole operation.
+# One commit per transaction means one fsync per transaction.
+
+# This example looks at three ways of speeding that up:
+
+# 1. Group commit: collect many account updates in memory and write them all
+#    inside one transaction. The fsync cost is then shared by the whole batch.
+# 2. WAL (write-ahead log) journaling: instead of copying pages to a rollback
+#    journal before changing the database, changes are appended to a -wal file
+#    and folded back into the database later (a checkpoint). Readers don't
+#    block writers and commits are much cheaper. With journal_mode=WAL it is
+#    also safe to use synchronous=NORMAL, which skips the fsync on every
+#    commit and only syncs at checkpoints. A power loss can roll back the last
+#    few commits, but it can't corrupt the database.
+# 3. executemany(): hand sqlite a statement and a sequence of parameters
+#    rather than calling execute() in a Python loop.
+
+# The tables are the same as sqlite3_example1.py so the Ledger can be pointed
+# at data/accounts1.sqlite if you want to.
+
+import sqlite3
+import datetime
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+import pytz
+
+
+def connect(filename, wal=True):
+    '''Returns a connection to filename with the accounts & history tables'''
+    conn = sqlite3.connect(filename)
+    if wal:
+        # journal_mode is persistent, it's stored in the database file:
+        conn.execute('PRAGMA journal_mode=WAL')
+        # synchronous is per connection:
+        conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS accounts
+                    (name TEXT PRIMARY KEY NOT NULL,
+                    balance INTEGER NOT NULL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS history
+                    (time TIMESTAMP NOT NULL,
+                    account TEXT NOT NULL,
+                    amount INTEGER NOT NULL,
+                    PRIMARY KEY (time, account))''')
+    conn.commit()
+    return conn
+
+
+class Ledger():
+    '''Groups account updates into batched transactions.
+
+    Updates are held in memory until flush() is called, until batch_size
+    updates are pending, or until the outermost batch() block exits.
+    '''
+
+    def __init__(self, conn, batch_size=1000):
+        self.conn = conn
+        self.batch_size = batch_size
+        self._balances = {}  # account name -> pending balance
+        self._history = []   # pending (time, name, amount) rows
+        self._accounts = {}  # account name -> LedgerAccount
+        self._depth = 0
+        self._last_time = None
+
+    def _current_time(self):
+        # The history table uses (time, account) as its primary key. When
+        # many updates are written in a tight loop, two of them can land on
+        # the same microsecond, so make sure each time is unique:
+        now = pytz.utc.localize(datetime.datetime.utcnow())
+        if self._last_time is not None and now <= self._last_time:
+            now = self._last_time + datetime.timedelta(microseconds=1)
+        self._last_time = now
+        return now
+
+    def account(self, name: str, opening_balance: int=0):
+        '''Returns the LedgerAccount for name, creating it if needed'''
+        if name in self._accounts:
+            return self._accounts[name]
+        account = LedgerAccount(self, name, opening_balance)
+        self._accounts[name] = account
+        return account
+
+    def record(self, account, amount):
+        '''Queues an update. Returns the accounts new pending balance'''
+        account._balance += amount
+        self._balances[account.name] = account._balance
+        self._history.append((self._current_time(), account.name, amount))
+        if len(self._history) >= self.batch_size:
+            self.flush()
+        return account._balance
+
+    @property
+    def pending(self):
+        return len(self._history)
+
+    def flush(self):
+        '''Writes all pending updates in a single transaction'''
+        if not self._history:
+            return 0
+        count = len(self._history)
+        try:
+            # Using the connection as a context manager commits on success
+            # and rolls back if an exception is raised:
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE accounts SET balance = ? WHERE name = ?",
+                    [(balance, name) for name, balance in self._balances.items()])
+                self.conn.executemany(
+                    "INSERT INTO history VALUES(?, ?, ?)", self._history)
+        except sqlite3.Error:
+            # Like sqlite3_example1.py, the in memory balances only change if
+            # the transaction succeeds, so put them back:
+            for name in self._balances:
+                account = self._accounts[name]
+                account._balance = account._committed
+            raise
+        else:
+            for name, balance in self._balances.items():
+                self._accounts[name]._committed = balance
+        finally:
+            self._balances.clear()
+            self._history.clear()
+        return count
+
+    @contextmanager
+    def batch(self):
+        '''Everything inside the (outermost) with block is committed once'''
+        self._depth += 1
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+        if self._depth == 0:
+            self.flush()
+
+
+class LedgerAccount():
+    '''The same interface as sqlite3_example1.Account, minus the printing'''
+
+    def __init__(self, ledger, name, opening_balance=0):
+        self._ledger = ledger
+        conn = ledger.conn
+        row = conn.execute("SELECT name, balance FROM accounts WHERE name = ?",
+                           (name,)).fetchone()
+        if row:
+            self.name, self._balance = row
+        else:
+            self.name = name
+            self._balance = opening_balance
+            with conn:
+                conn.execute("INSERT INTO accounts VALUES(?, ?)",
+                             (name, opening_balance))
+        # the last balance known to be in the database:
+        self._committed = self._balance
+
+    def deposit(self, amount: int):
+        if amount > 0.0:
+            self._ledger.record(self, amount)
+        return self._balance/100
+
+    def withdraw(self, amount: int):
+        # _balance includes pending updates, so two withdrawals in the same
+        # batch can't overdraw the account:
+        if 0 < amount <= self._balance:
+            self._ledger.record(self, -amount)
+            return amount/100
+        return 0.0
+
+    def show_balance(self):
+        print('Balance for {} is {:.2f}'.format(self.name, self._balance/100))
+
+
+# Benchmark
+# -----------------------------------------------------------------------------
+# single_commit() does exactly what sqlite3_example1.Account._save_update does:
+# two statements and a commit for each update.
+
+def single_commit(conn, names, count):
+    balances = dict(conn.execute('SELECT name, balance FROM accounts'))
+    last_time = None
+    for i in range(count):
+        name = names[i % len(names)]
+        amount = 100
+        now = pytz.utc.localize(datetime.datetime.utcnow())
+        if last_time is not None and now <= last_time:
+            now = last_time + datetime.timedelta(microseconds=1)
+        last_time = now
+        try:
+            conn.execute("UPDATE accounts SET balance = ? WHERE name = ?",
+                         (balances[name] + amount, name))
+            conn.execute("INSERT INTO history VALUES(?, ?, ?)",
+                         (now, name, amount))
+        except sqlite3.Error:
+            conn.rollback()
+        else:
+            conn.commit()
+            balances[name] += amount
+
+
+def group_commit(conn, names, count, batch_size):
+    ledger = Ledger(conn, batch_size)
+    accounts = [ledger.account(name) for name in names]
+    with ledger.batch():
+        for i in range(count):
+            accounts[i % len(accounts)].deposit(100)
+
+
+def benchmark(count=5000, batch_size=1000):
+    names = ['Rick', 'Morty', 'Ping Pong', 'Boktoktok', 'Zed']
+    modes = [
+        ('single commit, rollback journal', False, None),
+        ('single commit, WAL', True, None),
+        ('group commit, WAL', True, batch_size),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, wal, size in modes:
+            filename = os.path.join(tmp, label.replace(' ', '_') + '.sqlite')
+            conn = connect(filename, wal=wal)
+            with conn:
+                conn.executemany("INSERT INTO accounts VALUES(?, 0)",
+                                 [(name,) for name in names])
+            start = time.perf_counter()
+            if size is None:
+                single_commit(conn, names, count)
+            else:
+                group_commit(conn, names, count, size)
+            elapsed = time.perf_counter() - start
+            rows = conn.execute('SELECT COUNT(*) FROM history').fetchone()[0]
+            conn.close()
+            print('{:<32} {:>6} rows {:>12,.0f} transactions/sec'.format(
+                label, rows, count / elapsed))
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = connect(os.path.join(tmp, 'ledger.sqlite'))
+        ledger = Ledger(conn)
+        rick = ledger.account('Rick')
+        morty = ledger.account('Morty', 50000)
+
+        with ledger.batch():
+            rick.deposit(10010)
+            morty.withdraw(1000)
+            print('pending:', ledger.pending)  # pending: 2
+        print('pending:', ledger.pending)      # pending: 0
+
+        rick.show_balance()   # Balance for Rick is 100.10
+        morty.show_balance()  # Balance for Morty is 490.00
+        conn.close()
+
+    print('-' * 75)
+    benchmark()
+
+# Results will vary a lot depending on the disk, but on a laptop SSD:
+# single commit, rollback journal    5000 rows          800 transactions/sec
+# single commit, WAL                 5000 rows       30,000 transactions/sec
+# group commit, WAL                  5000 rows      150,000 transactions/sec
@@ -0,0 +1,290 @@
+'''sqlite3 Connection Pool'''
+
+
+# sqlite3_example1.py and sqlite3_example2.py open a single module level
+# connection (db = sqlite3.connect(...)) and every Account uses it. That's fine
+# for a script, but by default a sqlite3 connection can only be used in the
+# thread that created it. Try to use it from a worker thread and you get:
+
+# sqlite3.ProgrammingError: SQLite objects created in a thread can only be
+# used in that same thread.
+
+# You could pass check_same_thread=False and wrap every call in one global
+# lock, but then only one thread can ever touch the database. Instead, this
+# example uses a small pool of connections:
+
+# - A thread checks a connection out, uses it, and puts it back. While it's
+#   checked out, no other thread can use it, so it's safe to open the
+#   connections with check_same_thread=False.
+# - If the same thread asks for a connection again (while it's still holding
+#   one) it gets the same connection back, so nested calls don't deadlock the
+#   pool or end up in two different transactions.
+# - The pool never opens more than `size` connections. If they're all busy,
+#   checkout waits for up to `timeout` seconds and then raises TimeoutError.
+
+# SQLite still only allows one writer at a time, but that lock is inside
+# sqlite itself and only held for the length of a write transaction. With WAL
+# journaling, readers don't wait for writers at all.
+
+import sqlite3
+import os
+import queue
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ConnectionPool():
+    '''A bounded pool of sqlite3 connections, one per thread at a time.'''
+
+    def __init__(self, filename, size=5, timeout=5.0, wal=True, **kwargs):
+        self.filename = filename
+        self.size = size
+        self.timeout = timeout
+        self.wal = wal
+        self.kwargs = kwargs
+        self._idle = queue.LifoQueue()  # reuse the most recently used first
+        self._created = 0
+        self._lock = threading.Lock()   # only protects self._created
+        self._local = threading.local()
+        self._closed = False
+
+    def _connect(self):
+        # timeout here is sqlite's busy timeout: how long to wait for another
+        # connection's write lock before raising 'database is locked'.
+        conn = sqlite3.connect(self.filename, check_same_thread=False,
+                               timeout=self.timeout, **self.kwargs)
+        if self.wal:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _checkout(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError('Cannot use a closed pool')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError('No connection available after {} seconds'
+                               .format(self.timeout)) from None
+
+    def _checkin(self, conn):
+        if conn.in_transaction:
+            # Never hand the next thread a half finished transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        '''Check out this thread's connection for the with block'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            # already checked out further up the stack in this thread
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        conn = self._checkout()
+        self._local.conn = conn
+        self._local.depth = 1
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._local.depth = 0
+            self._checkin(conn)
+
+    def close(self):
+        '''Closes idle connections; busy ones are closed on check in'''
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def create_tables(pool):
+    with pool.connection() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS accounts
+                        (name TEXT PRIMARY KEY NOT NULL,
+                        balance INTEGER NOT NULL)''')
+        # An INTEGER PRIMARY KEY rather than (time, account) as in example1:
+        # two updates to one account in the same millisecond are normal here.
+        conn.execute('''CREATE TABLE IF NOT EXISTS history
+                        (id INTEGER PRIMARY KEY,
+                        time TIMESTAMP NOT NULL,
+                        account TEXT NOT NULL,
+                        amount INTEGER NOT NULL)''')
+        conn.commit()
+
+
+class Account():
+    '''sqlite3_example1.Account, but every query borrows a pooled connection.
+
+    Since several Account objects (in several threads) may refer to the same
+    row, the balance is updated in SQL (balance = balance + ?) and read back
+    inside the same transaction rather than computed from self._balance. For
+    the same reason withdraw() checks the balance in the UPDATE's WHERE
+    clause; self._balance may be out of date.
+    '''
+
+    def __init__(self, pool, name: str, opening_balance: int=0):
+        self.pool = pool
+        self.name = name
+        with pool.connection() as conn:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO accounts VALUES(?, ?)",
+                             (name, opening_balance))
+                row = conn.execute("SELECT balance FROM accounts WHERE name = ?",
+                                   (name,)).fetchone()
+        self._balance = row[0]
+
+    def _save_update(self, amount):
+        '''Adds amount (negative to withdraw) to the balance. Returns False,
+        and changes nothing, if the balance would go below zero. Errors (like
+        'database is locked' after the pool's timeout) are raised.'''
+        with self.pool.connection() as conn:
+            try:
+                # BEGIN IMMEDIATE takes the write lock up front. Otherwise two
+                # threads can both start reading, then both try to upgrade to
+                # a write lock and one of them fails with 'database is locked'.
+                conn.execute('BEGIN IMMEDIATE')
+                cursor = conn.execute("UPDATE accounts SET balance = balance + ? "
+                                      "WHERE name = ? AND balance + ? >= 0",
+                                      (amount, self.name, amount))
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    return False
+                conn.execute("INSERT INTO history (time, account, amount) "
+                             "VALUES(strftime('%Y-%m-%d %H:%M:%f', 'now'), ?, ?)",
+                             (self.name, amount))
+                balance = conn.execute("SELECT balance FROM accounts "
+                                       "WHERE name = ?", (self.name,)).fetchone()[0]
+                conn.commit()
+            except BaseException:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+        self._balance = balance
+        return True
+
+    def deposit(self, amount: int):
+        if amount > 0.0:
+            self._save_update(amount)
+        return self._balance/100
+
+    def withdraw(self, amount: int):
+        if amount > 0 and self._save_update(-amount):
+            return amount/100
+        return 0.0
+
+    def show_balance(self):
+        print('Balance for {} is {:.2f}'.format(self.name, self._balance/100))
+
+
+# Testing
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    from concurrent.futures import ThreadPoolExecutor
+
+    # The shared module level connection from sqlite3_example1.py:
+    shared = sqlite3.connect(':memory:')
+    def use_shared():
+        shared.execute('SELECT 1')
+    with ThreadPoolExecutor(1) as executor:
+        try:
+            executor.submit(use_shared).result()
+        except sqlite3.ProgrammingError as e:
+            print(e)
+    # SQLite objects created in a thread can only be used in that same
+    # thread. The object was created in thread id 1 and this is thread id 2.
+
+    print('-' * 75)
+
+    def deposits(pool, count):
+        # Each thread has its own Account object, all for the same row:
+        account = Account(pool, 'Rick')
+        for i in range(count):
+            account.deposit(100)
+
+    def withdrawals(pool, count):
+        account = Account(pool, 'Morty')
+        return sum(account.withdraw(100) > 0 for i in range(count))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'accounts.sqlite')
+        with ConnectionPool(filename, size=4, timeout=10) as pool:
+            create_tables(pool)
+            start = time.perf_counter()
+            # 6 threads sharing a pool of 4 connections:
+            with ThreadPoolExecutor(6) as executor:
+                futures = [executor.submit(deposits, pool, 500)
+                           for _ in range(6)]
+            for future in futures:
+                future.result()  # raises if a deposit failed
+            elapsed = time.perf_counter() - start
+            with pool.connection() as conn:
+                count, = conn.execute('SELECT count(*) FROM history').fetchone()
+            print('{} deposits in {:.2f} seconds ({} connections opened)'
+                  .format(count, elapsed, pool._created))
+            # 3000 deposits in 0.18 seconds (4 connections opened)
+
+            # 6 threads each try to take out 100 cents 10 times, but there's
+            # only 1000 cents in the account:
+            Account(pool, 'Morty', 1000)
+            with ThreadPoolExecutor(6) as executor:
+                futures = [executor.submit(withdrawals, pool, 10)
+                           for _ in range(6)]
+            print(sum(future.result() for future in futures), 'withdrawals')
+            # 10 withdrawals
+            with pool.connection() as conn:
+                for row in conn.execute('SELECT * FROM accounts'):
+                    print(row)
+                    # ('Rick', 300000)
+                    # ('Morty', 0)
+
+            # With every connection checked out, the next checkout times out:
+            pool.timeout = 0.1
+            with pool.connection():
+                def borrow():
+                    with pool.connection():
+                        time.sleep(0.5)
+                with ThreadPoolExecutor(4) as executor:
+                    futures = [executor.submit(borrow) for _ in range(4)]
+                    for future in futures:
+                        try:
+                            future.result()
+                        except TimeoutError as e:
+                            print(e)
+                            # No connection available after 0.1 seconds
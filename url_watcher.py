@@ -0,0 +1,232 @@
+'''Watching URLs: conditional GETs and a shared scheduler'''
+
+
+# pickling.py has an UpdatedURL class that downloads a page and then starts a
+# threading.Timer to download it again in an hour. That has two problems when
+# you watch a lot of pages:
+
+# 1. Every download is the full page, even if it hasn't changed.
+# 2. Every object has its own Timer, and every Timer is a thread. Watching
+#    10,000 pages means 10,000 threads, almost all of them just sleeping.
+
+# For the first one, HTTP has conditional requests. When a server sends a
+# page it can include an ETag header (a fingerprint of the content) and a
+# Last-Modified header. Next time, send those back as If-None-Match and
+# If-Modified-Since. If the page hasn't changed, the server answers with a
+# short "304 Not Modified" and no body.
+
+# For the second, one Scheduler thread keeps a heap (see queues.py) of
+# (next due time, url). It sleeps until the earliest one is due, then hands
+# the download to a small ThreadPoolExecutor. However many URLs there are,
+# that's one scheduler thread plus max_workers download threads.
+
+# Pickling still works the same way as pickling.py: __getstate__ leaves out
+# the scheduler (it holds locks and threads) and __setstate__ adds the
+# restored object back to a scheduler. The ETag and Last-Modified values are
+# kept, so a restored object can still make conditional requests.
+
+import datetime
+import heapq
+import itertools
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+
+class Scheduler():
+    '''Runs each watcher's update() when it's due, on a bounded worker pool'''
+
+    def __init__(self, max_workers=8):
+        self._heap = []  # [due, count, watcher], watcher is None if cancelled
+        self._counter = itertools.count()  # tie breaker, watchers don't sort
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def schedule(self, watcher, delay):
+        '''Queues watcher.update() to run after delay seconds, returns the
+        event (for cancel())'''
+        with self._condition:
+            event = [time.monotonic() + delay, next(self._counter), watcher]
+            heapq.heappush(self._heap, event)
+            # wake the scheduler up in case this is now the earliest:
+            self._condition.notify()
+            return event
+
+    def cancel(self, watcher):
+        '''Drops watcher's queued event and stops it being scheduled again'''
+        with self._condition:
+            watcher.scheduler = None
+            if watcher._event is not None:
+                # like the REMOVED marker in the heapq docs, it's skipped
+                # when it comes to the top of the heap
+                watcher._event[2] = None
+                watcher._event = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and (
+                        not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = (self._heap[0][0] - time.monotonic()
+                               if self._heap else None)
+                    self._condition.wait(timeout)
+                if not self._running:
+                    return
+                due, count, watcher = heapq.heappop(self._heap)
+                if watcher is None:
+                    continue  # cancelled
+                watcher._event = None
+            self._executor.submit(self._update, watcher)
+
+    def _update(self, watcher):
+        try:
+            watcher.update()
+        except Exception as e:
+            watcher.errors += 1
+            watcher.last_error = e
+        finally:
+            # schedule the next one after this finishes, so a slow page is
+            # never being downloaded twice at the same time. (Under the lock,
+            # so it can't happen in between the checks in cancel())
+            with self._condition:
+                if watcher.scheduler is self and self._running:
+                    watcher._event = self.schedule(watcher, watcher.interval)
+
+    def shutdown(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+
+_default_scheduler = None
+
+
+def default_scheduler():
+    global _default_scheduler
+    if _default_scheduler is None:
+        _default_scheduler = Scheduler()
+    return _default_scheduler
+
+
+class UpdatedURL():
+    def __init__(self, url, interval=3600, scheduler=None):
+        self.url = url
+        self.interval = interval
+        self.contents = b''
+        self.last_updated = None
+        self.etag = None
+        self.last_modified = None
+        self.downloads = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.last_error = None
+        self.scheduler = scheduler or default_scheduler()
+        # the first download happens on the worker pool too:
+        self._event = self.scheduler.schedule(self, 0)
+
+    def update(self):
+        request = Request(self.url)
+        if self.etag:
+            request.add_header('If-None-Match', self.etag)
+        if self.last_modified:
+            request.add_header('If-Modified-Since', self.last_modified)
+        try:
+            with urlopen(request, timeout=30) as response:
+                self.contents = response.read()
+                self.etag = response.headers.get('ETag')
+                self.last_modified = response.headers.get('Last-Modified')
+                self.downloads += 1
+        except HTTPError as e:
+            # urlopen treats every non 2xx status as an error, including 304:
+            if e.code != 304:
+                raise
+            self.not_modified += 1
+        self.last_updated = datetime.datetime.now()
+
+    def __getstate__(self):
+        new_state = self.__dict__.copy()
+        del new_state['scheduler']
+        del new_state['_event']
+        new_state['last_error'] = None
+        return new_state
+
+    def __setstate__(self, data):
+        self.__dict__ = data
+        self.scheduler = default_scheduler()
+        self._event = self.scheduler.schedule(self, self.interval)
+
+    def stop(self):
+        if self.scheduler is not None:
+            self.scheduler.cancel(self)
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# A local server with 200 "pages". A page only changes every 5th time it's
+# requested. Each URL is checked every 0.25 seconds for 2 seconds.
+
+if __name__ == '__main__':
+    import hashlib
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class PageHandler(BaseHTTPRequestHandler):
+        hits = {}
+        lock = threading.Lock()
+
+        def do_GET(self):
+            with PageHandler.lock:
+                PageHandler.hits[self.path] = PageHandler.hits.get(self.path, 0) + 1
+                version = PageHandler.hits[self.path] // 5
+            body = '{} version {}\n'.format(self.path, version).encode() * 500
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://localhost:{}/page/'.format(server.server_address[1])
+
+    scheduler = Scheduler(max_workers=8)
+    watched = [UpdatedURL(base + str(i), interval=0.25, scheduler=scheduler)
+               for i in range(200)]
+    time.sleep(2)
+    print('threads running:', threading.active_count())
+    # threads running: 15
+    # (main, scheduler, 8 workers and the test server's threads)
+
+    downloads = sum(u.downloads for u in watched)
+    not_modified = sum(u.not_modified for u in watched)
+    print('full downloads: {}, 304 not modified: {}'.format(
+        downloads, not_modified))
+    # full downloads: 396, 304 not modified: 952
+
+    serialized = pickle.dumps(watched[0])
+    print('pickled size:', len(serialized))  # pickled size: 9294
+    restored = pickle.loads(serialized)
+    print(restored.url, restored.etag)
+    # http://localhost:54321/page/0 "3bf0c1..."
+
+    for u in watched:
+        u.stop()
+    restored.stop()
+    scheduler.shutdown()
+    server.shutdown()
@@ -0,0 +1,267 @@
+'''Work stealing: a deque per worker, popped LIFO by its owner, stolen FIFO'''
+
+
+# queues.py has two threads burning a candle from opposite ends of one deque.
+# deque.pop() and deque.popleft() are atomic (the GIL makes each one a single
+# step), so the two ends can be used at the same time without a lock. A work
+# stealing scheduler is built on exactly that:
+
+# - Each worker has its own deque of tasks. New tasks created by a worker go
+#   on the right end of its own deque, and it takes its next task from the
+#   right end too (LIFO). The newest task is the one whose data is most likely
+#   still in the CPU cache, and nobody else is touching that end.
+# - A worker that runs out of tasks picks another worker and steals from the
+#   left end of its deque (FIFO). The oldest tasks tend to be the big ones (in
+#   a divide and conquer problem they haven't been split yet), so one steal
+#   gets the thief a lot of work.
+
+# With a single queue.Queue every put() and get() takes the queue's lock, and
+# every worker fights over that one lock for every task. Here a worker only
+# touches another worker's deque when it has nothing else to do, so when the
+# tasks are small (microseconds each) there's much less time spent waiting.
+
+# Keep in mind Python threads take turns holding the GIL, so neither version
+# runs tasks on more than one CPU at a time. What this saves is the locking
+# and waking up around each task, which is most of the cost of a tiny task.
+
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+
+class WorkStealingPool():
+
+    def __init__(self, workers=4):
+        self.deques = [deque() for _ in range(workers)]
+        # Each counter has one writer (its worker), so they need no lock. See
+        # join() for how they're used together.
+        self.spawned = [0] * workers    # tasks submitted by worker i
+        self.completed = [0] * workers  # tasks run by worker i
+        self.stolen = [0] * workers     # of those, how many were stolen
+        self.external = 0               # tasks submitted by other threads
+        self.errors = []
+        self._local = threading.local()
+        self._lock = threading.Lock()   # only for submits from outside
+        self._idle = threading.Condition()
+        self._sleepers = 0
+        self._next = 0
+        self._running = True
+        self._threads = [threading.Thread(target=self._work, args=(i,))
+                         for i in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, fn, *args):
+        index = getattr(self._local, 'index', None)
+        if index is not None:
+            # from inside a task: onto our own deque, no lock
+            self.spawned[index] += 1
+            self.deques[index].append((fn, args))
+        else:
+            with self._lock:
+                self.external += 1
+                self.deques[self._next].append((fn, args))
+                self._next = (self._next + 1) % len(self.deques)
+        if self._sleepers:
+            with self._idle:
+                self._idle.notify()
+
+    def _steal(self, index):
+        n = len(self.deques)
+        start = random.randrange(n)
+        for i in range(n):
+            victim = (start + i) % n
+            if victim == index:
+                continue
+            try:
+                return self.deques[victim].popleft()
+            except IndexError:
+                pass
+        return None
+
+    def _work(self, index):
+        self._local.index = index
+        mine = self.deques[index]
+        while self._running:
+            try:
+                fn, args = mine.pop()
+            except IndexError:
+                task = self._steal(index)
+                if task is None:
+                    with self._idle:
+                        self._sleepers += 1
+                        # the timeout covers a submit() that checked
+                        # _sleepers just before we got here
+                        self._idle.wait(0.01)
+                        self._sleepers -= 1
+                    continue
+                fn, args = task
+                self.stolen[index] += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                self.errors.append(e)
+            self.completed[index] += 1
+
+    def join(self, poll=0.0005):
+        '''Waits until every task (and every task they submitted) has run'''
+        # Read completed before spawned. Tasks only finish after they were
+        # submitted, so if the totals are equal there was a moment when
+        # nothing was left to run, and only a running task could add more.
+        while True:
+            done = sum(self.completed)
+            if done == sum(self.spawned) + self.external:
+                break
+            time.sleep(poll)
+        if self.errors:
+            # raise it once, so the next join() starts clean
+            errors, self.errors = self.errors, []
+            raise errors[0]
+
+    def shutdown(self):
+        '''Waits for the tasks, stops the threads, then raises any error'''
+        try:
+            self.join()
+        finally:
+            self._running = False
+            with self._idle:
+                self._idle.notify_all()
+            for t in self._threads:
+                t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+class SharedQueuePool():
+    '''The same API with one queue.Queue shared by every worker'''
+
+    def __init__(self, workers=4):
+        self.queue = queue.Queue()
+        self.errors = []
+        self._threads = [threading.Thread(target=self._work)
+                         for _ in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, fn, *args):
+        self.queue.put((fn, args))
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            fn, args = task
+            try:
+                fn(*args)
+            except Exception as e:
+                self.errors.append(e)
+            self.queue.task_done()
+
+    def join(self):
+        self.queue.join()
+        if self.errors:
+            # raise it once, so the next join() starts clean
+            errors, self.errors = self.errors, []
+            raise errors[0]
+
+    def shutdown(self):
+        try:
+            self.join()
+        finally:
+            for _ in self._threads:
+                self.queue.put(None)
+            for t in self._threads:
+                t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+# Testing
+# -----------------------------------------------------------------------------
+# Two kinds of fine grained work:
+# flat  - 200,000 tiny tasks submitted from the main thread
+# split - one task that splits itself in two until the pieces are small, like
+#         a parallel quicksort or tree walk. 262,143 tasks, all submitted by
+#         other tasks.
+
+def tiny(x):
+    return x * x
+
+
+def split(pool, size):
+    if size > 1:
+        pool.submit(split, pool, size // 2)
+        pool.submit(split, pool, size - size // 2)
+
+
+def flat(pool, count=200000):
+    for i in range(count):
+        pool.submit(tiny, i)
+
+
+def divide(pool, size=131072):
+    pool.submit(split, pool, size)
+
+
+if __name__ == '__main__':
+    candle = list(range(5))
+    with WorkStealingPool(2) as pool:
+        for i in candle:
+            pool.submit(print, 'burning', i)
+    print('-' * 75)
+
+    for name, job in (('flat', flat), ('split', divide)):
+        for workers in (1, 2, 4, 8):
+            timings = []
+            for Pool in (SharedQueuePool, WorkStealingPool):
+                with Pool(workers) as pool:
+                    start = time.perf_counter()
+                    job(pool)
+                    pool.join()
+                    timings.append(time.perf_counter() - start)
+                    if Pool is WorkStealingPool:
+                        tasks = sum(pool.completed)
+                        stolen = sum(pool.stolen)
+            print('{:<5} {} workers: Queue {:>8,.0f} tasks/sec  stealing '
+                  '{:>9,.0f} tasks/sec  {:>4.1f}x  {:>7,} stolen'.format(
+                      name, workers, tasks / timings[0], tasks / timings[1],
+                      timings[0] / timings[1], stolen))
+
+# burning 3
+# burning 1
+# burning 0
+# burning 2
+# burning 4
+# ---------------------------------------------------------------------------
+# flat  1 workers: Queue  195,840 tasks/sec  stealing   262,815 tasks/sec   1.3x        0 stolen
+# flat  2 workers: Queue  179,021 tasks/sec  stealing   235,472 tasks/sec   1.3x  100,009 stolen
+# flat  4 workers: Queue  228,171 tasks/sec  stealing   258,027 tasks/sec   1.1x  149,996 stolen
+# flat  8 workers: Queue  236,425 tasks/sec  stealing   199,648 tasks/sec   0.8x  174,998 stolen
+# split 1 workers: Queue  223,539 tasks/sec  stealing 1,686,071 tasks/sec   7.5x        0 stolen
+# split 2 workers: Queue  180,117 tasks/sec  stealing 1,132,324 tasks/sec   6.3x        9 stolen
+# split 4 workers: Queue  149,847 tasks/sec  stealing 1,070,112 tasks/sec   7.1x       27 stolen
+# split 8 workers: Queue  160,482 tasks/sec  stealing 1,295,477 tasks/sec   8.1x       71 stolen
+
+# The candle burns in a strange order because each worker takes its newest
+# task first (LIFO) while the other steals its oldest.
+
+# flat is the worst case for work stealing: every task comes from outside, so
+# the workers' own deques only hold what the main thread hands out, and most
+# tasks end up stolen. It's about even with the shared Queue.
+
+# split is what work stealing is for. Tasks create tasks, they go on the
+# worker's own deque, and nobody takes a lock. A handful of steals of big
+# early tasks keep the other workers busy, and the shared Queue (with its
+# lock and condition variables on every put() and get()) gets slower as more
+# workers fight over it.